@@ -1,51 +1,147 @@
-import logging, os
-from logging.handlers import SMTPHandler, RotatingFileHandler
-from flask import Flask
+import os
+import sqlite3
+import sqlalchemy as sqla
+from flask import Flask, current_app, has_app_context
+from jinja2 import FileSystemBytecodeCache
 from config import Config
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate 
 from flask_login import LoginManager
 from flask_mail import Mail
+from app.replicas import ReplicaRouter, RoutingSession
 
 
-web_app = Flask(__name__)
-web_app.config.from_object(Config)
-
-db = SQLAlchemy(web_app)
-Migrate = Migrate(web_app, db)
-
-login_manager = LoginManager(web_app)
-login_manager.login_view = 'login' #type: ignore
-
-
-mail = Mail(web_app)
-
-if not web_app.debug:
-    if web_app.config['MAIL_SERVER']:
-        auth = None
-        if web_app.config['MAIL_USERNAME'] and web_app.config['MAIL_PASSWORD']:
-            auth = (web_app.config['MAIL_USERNAME'], web_app.config['MAIL_PASSWORD'])
-        secure = None
-        if web_app.config['MAIL_USE_TLS']:
-            secure = ()
-        mail_handler = SMTPHandler(
-            mailhost=(web_app.config['MAIL_SERVER'], web_app.config['MAIL_PORT']),
-            fromaddr='no-reply@' + web_app.config['MAIL_SERVER'],
-            toaddrs=web_app.config['ADMINS'], subject='Microblog Failure',
-            credentials=auth, secure=secure)
-        mail_handler.setLevel(logging.ERROR)
-        web_app.logger.addHandler(mail_handler)
-    
-    if not os.path.exists('logs'):
-        os.mkdir('logs')
-    
-    file_handler = RotatingFileHandler('logs/sandbox.log', maxBytes=1024, backupCount=5)
-    file_handler.setFormatter(logging.Formatter(
-        '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
-    file_handler.setLevel(logging.INFO)
-    web_app.logger.addHandler(file_handler)
-
-    web_app.logger.setLevel(logging.INFO)
-    web_app.logger.info('Microblog startup')
-
-from app import routes, models, errors
+@sqla.event.listens_for(sqla.engine.Engine, 'connect')
+def configure_sqlite(dbapi_connection, connection_record):
+    # engines are only used inside an app context, which carries the settings
+    if not isinstance(dbapi_connection, sqlite3.Connection) or not has_app_context():
+        return
+    config = current_app.config
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout = {int(config['SQLITE_BUSY_TIMEOUT'])}")
+    cursor.execute(f"PRAGMA journal_mode = {config['SQLITE_JOURNAL_MODE']}")
+    cursor.execute(f"PRAGMA synchronous = {config['SQLITE_SYNCHRONOUS']}")
+    cursor.execute(f"PRAGMA mmap_size = {int(config['SQLITE_MMAP_SIZE'])}")
+    cursor.close()
+
+
+# feeds are streamed, so templates keep rendering after the request's session is removed;
+# objects loaded in the view must stay readable after a commit
+db = SQLAlchemy(session_options={'expire_on_commit': False, 'class_': RoutingSession})
+migrate = Migrate()
+replicas = ReplicaRouter()
+
+login_manager = LoginManager()
+login_manager.login_view = 'auth.login' #type: ignore
+
+mail = Mail()
+
+from app.profiling import RequestProfiler
+profiler = RequestProfiler()
+
+from app.cache import Cache
+cache = Cache()
+
+from app.avatars import AvatarCache
+avatars = AvatarCache()
+
+from app.hashing import PasswordHasher
+hasher = PasswordHasher()
+
+from app.ratelimit import RateLimiter
+limiter = RateLimiter()
+
+from app.tokens import ResetTokenService
+reset_tokens = ResetTokenService()
+
+from app.timelines import TimelineMaintenance
+timelines = TimelineMaintenance()
+
+from app.tracking import LastSeenTracker
+tracker = LastSeenTracker()
+
+
+def create_app(config_class=Config):
+    app = Flask(__name__)
+    app.config.from_object(config_class)
+    app.config.setdefault('TIMELINE_LENGTH', 800)
+    # an account stops fanning out above TIMELINE_CELEBRITY_THRESHOLD followers and only starts
+    # again below TIMELINE_DEMOTE_THRESHOLD, so one hovering at the line doesn't flip back and forth
+    app.config.setdefault('TIMELINE_CELEBRITY_THRESHOLD', 10000)
+    app.config.setdefault('TIMELINE_DEMOTE_THRESHOLD', app.config['TIMELINE_CELEBRITY_THRESHOLD'] * 9 // 10)
+
+    # engine configuration. every SQLite connection is opened in WAL mode with synchronous=NORMAL,
+    # a memory-mapped read window and a busy timeout, so readers never wait on the writer and
+    # writers queue on the lock instead of failing with "database is locked". pool sizing and
+    # pre-ping come from Config as well (they don't apply to in-memory databases, which
+    # share a single connection)
+    app.config.setdefault('SQLITE_JOURNAL_MODE', 'WAL')
+    app.config.setdefault('SQLITE_SYNCHRONOUS', 'NORMAL')
+    app.config.setdefault('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)
+    app.config.setdefault('SQLITE_BUSY_TIMEOUT', 5000)
+    app.config.setdefault('DB_POOL_SIZE', 10)
+    app.config.setdefault('DB_MAX_OVERFLOW', 20)
+    app.config.setdefault('DB_POOL_TIMEOUT', 10)
+    app.config.setdefault('DB_POOL_RECYCLE', -1)
+    app.config.setdefault('DB_POOL_PRE_PING', False)
+
+    database_url = sqla.engine.make_url(app.config.get('SQLALCHEMY_DATABASE_URI') or 'sqlite://')
+    if database_url.get_backend_name() != 'sqlite' or database_url.database not in (None, '', ':memory:'):
+        engine_options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+        engine_options.setdefault('pool_size', app.config['DB_POOL_SIZE'])
+        engine_options.setdefault('max_overflow', app.config['DB_MAX_OVERFLOW'])
+        engine_options.setdefault('pool_timeout', app.config['DB_POOL_TIMEOUT'])
+        engine_options.setdefault('pool_recycle', app.config['DB_POOL_RECYCLE'])
+        engine_options.setdefault('pool_pre_ping', app.config['DB_POOL_PRE_PING'])
+
+    # compiled templates are kept on disk, so a restarted worker loads them instead of
+    # parsing every template again; `flask compile-templates` fills the cache ahead of time
+    app.config.setdefault('TEMPLATE_BYTECODE_CACHE_DIR', os.path.join(app.instance_path, 'jinja'))
+    if app.config['TEMPLATE_BYTECODE_CACHE_DIR']:
+        os.makedirs(app.config['TEMPLATE_BYTECODE_CACHE_DIR'], exist_ok=True)
+        app.jinja_options = dict(app.jinja_options,
+                                 bytecode_cache=FileSystemBytecodeCache(app.config['TEMPLATE_BYTECODE_CACHE_DIR']))
+
+    replicas.init_app(app)
+    db.init_app(app)
+    migrate.init_app(app, db)
+    login_manager.init_app(app)
+
+    # binding these is cheap: SMTP connections, mail workers and the log files and threads
+    # are only set up once the app first sends mail or logs a record
+    mail.init_app(app)
+    from app.email import mail_queue
+    mail_queue.init_app(app)
+    if not app.debug and not app.testing:
+        from app.logs import init_logging
+        init_logging(app)
+
+    profiler.init_app(app)
+    cache.init_app(app)
+    avatars.init_app(app)
+    hasher.init_app(app)
+    limiter.init_app(app)
+    reset_tokens.init_app(app)
+    timelines.init_app(app)
+    tracker.init_app(app)
+    from app.search import search_index
+    search_index.init_app(app)
+
+    from app.errors import bp as errors_bp
+    app.register_blueprint(errors_bp)
+
+    from app.auth import bp as auth_bp
+    app.register_blueprint(auth_bp)
+
+    from app.main import bp as main_bp
+    app.register_blueprint(main_bp)
+
+    app.config.setdefault('API_POSTS_PER_PAGE', 25)
+    app.config.setdefault('API_MAX_PER_PAGE', 100)
+    from app.api import bp as api_bp
+    app.register_blueprint(api_bp, url_prefix='/api/v1')
+
+    return app
+
+
+from app import models
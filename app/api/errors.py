@@ -0,0 +1,29 @@
+from flask import jsonify, request
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import HTTP_STATUS_CODES
+from app.api import bp
+
+'''
+errors from the API are JSON like the rest of it. the blueprint handler covers aborts inside
+API views; the app-wide handlers in app.errors check api_request() for the rest, since a URL
+under the prefix that matches no route, or a 404/500 with a handler of its own, never reaches
+a blueprint handler
+'''
+
+
+def error_response(status, message=None):
+    payload = {'error': HTTP_STATUS_CODES.get(status, 'Unknown error')}
+    if message:
+        payload['message'] = message
+    response = jsonify(payload)
+    response.status_code = status
+    return response
+
+
+def api_request():
+    return request.blueprint == 'api' or request.path.startswith('/api/')
+
+
+@bp.errorhandler(HTTPException)
+def http_error(error):
+    return error_response(error.code, error.description)
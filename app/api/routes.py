@@ -0,0 +1,122 @@
+import json
+from datetime import timezone
+from functools import wraps
+import sqlalchemy as sqla
+from flask import request, current_app
+from flask_login import current_user
+from app import db
+from app.api import bp
+from app.api.errors import error_response
+from app.conditional import conditional, make_etag
+from app.main.routes import page_urls
+from app.models import User, Post, avatar_url
+from app.pagination import paginate_keyset
+from app.replicas import read_only
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+'''
+JSON feeds for clients that would otherwise scrape the HTML pages. a page selects only the
+columns behind the requested ?fields= (all of them by default) as plain rows, without loading
+Post or User objects, and is encoded in one go. pages are keyset-paginated like the
+HTML feeds, ?limit= posts at a time up to API_MAX_PER_PAGE, and the "next" and "prev" links
+carry the cursors. bodies are encoded with orjson when it is installed; naive timestamps are
+UTC
+'''
+
+# field: (columns it needs besides the keys, value from a row)
+FIELDS = {
+    'id': ((), lambda row: row.post_id),
+    'body': ((Post.body,), lambda row: row.body),
+    'timestamp': ((), lambda row: row.timestamp),
+    'author': ((User.login,), lambda row: row.login),
+    'avatar': ((User.email_digest, User.email), lambda row: avatar_url(row.email, row.email_digest, 48)),
+}
+# always selected: the cursors are built from timestamp and post_id
+KEYS = (Post.post_id, Post.timestamp, Post.user_id)
+
+
+def _default(value):
+    if hasattr(value, 'isoformat'):
+        if getattr(value, 'tzinfo', True) is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def dumps(value):
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_NAIVE_UTC)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=_default).encode('utf-8')
+
+
+def authenticated(view):
+    # flask_login.login_required redirects to the login form, which an API client can't use
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return error_response(401)
+        return view(*args, **kwargs)
+    return wrapped
+
+
+def page_response(posts, fields, next_url, prev_url):
+    # the page is already loaded, so one dumps call, which also gives the response a
+    # Content-Length, beats encoding it post by post
+    getters = [(field, FIELDS[field][1]) for field in fields]
+    page = {'posts': [{field: getter(row) for field, getter in getters} for row in posts.items],
+            'next': next_url, 'prev': prev_url}
+    return current_app.response_class(dumps(page), mimetype='application/json')
+
+
+def post_page(query, endpoint, **values):
+    names = request.args.get('fields')
+    fields = list(dict.fromkeys(names.split(','))) if names else list(FIELDS)
+    unknown = [field for field in fields if field not in FIELDS]
+    if unknown:
+        return error_response(400, f'unknown fields: {", ".join(unknown)}')
+    try:
+        per_page = int(request.args.get('limit', current_app.config['API_POSTS_PER_PAGE']))
+    except ValueError:
+        per_page = 0  # turned away below like any other bad limit, instead of the default
+    if not 0 < per_page <= current_app.config['API_MAX_PER_PAGE']:
+        return error_response(400, f'limit must be between 1 and {current_app.config["API_MAX_PER_PAGE"]}')
+
+    columns = [*KEYS, *(column for field in fields for column in FIELDS[field][0])]
+    query = query.with_only_columns(*columns)
+    if any(column.class_ is User for column in columns):
+        query = query.join(User, User.id == Post.user_id)
+    posts = paginate_keyset(query, request.args.get('cursor'), per_page, rows=True)
+    values.update((name, request.args[name]) for name in ('fields', 'limit') if name in request.args)
+    next_url, prev_url = page_urls(posts, endpoint, **values)
+
+    # the rows hold every value the page shows, author fields included, so they are the validator
+    etag = make_etag(current_user.id, request.full_path, [tuple(row) for row in posts.items])
+    return conditional(etag, lambda: page_response(posts, fields, next_url, prev_url))
+
+
+@bp.route('/feed')
+@read_only
+@authenticated
+def feed():
+    return post_page(current_user.home_timeline(), 'api.feed')
+
+
+@bp.route('/explore')
+@read_only
+@authenticated
+def explore():
+    return post_page(sqla.select(Post), 'api.explore')
+
+
+@bp.route('/users/<login>/posts')
+@read_only
+@authenticated
+def user_posts(login):
+    user_id = db.session.scalar(sqla.select(User.id).where(User.login == login))
+    if user_id is None:
+        return error_response(404, f'user {login} not found')
+    return post_page(sqla.select(Post).where(Post.user_id == user_id), 'api.user_posts', login=login)
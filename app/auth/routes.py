@@ -0,0 +1,81 @@
+import sqlalchemy as sqla
+from flask import render_template, flash, redirect, url_for, request
+from app import db, limiter, reset_tokens
+from app.auth import bp
+from app.forms import LoginForm, RegistrationForm, ResetPasswordRequestForm, ResetPasswordForm
+from app.models import User
+from app.email import send_password_reset_email
+from flask_login import current_user, login_user, logout_user, login_required
+from urllib.parse import urlsplit
+
+@bp.route('/register', methods=['GET', 'POST'])
+def register():
+    if current_user.is_authenticated:
+        return redirect(url_for('main.index'))
+    form = RegistrationForm()
+    if form.validate_on_submit():
+        visitor = User(login=str(form.login.data), email=str(form.email.data))
+        visitor.set_password(form.password.data)
+        db.session.add(visitor)
+        db.session.commit()
+        flash('Congratulations, you are now a registered user!')
+        return redirect(url_for('auth.login'))
+    return render_template('register.html', title='Register', form=form)
+
+@bp.route("/login", methods=['GET', 'POST'])
+def login():
+    if current_user.is_authenticated:
+        return redirect(url_for('main.index'))
+    form = LoginForm()
+    if form.validate_on_submit():
+        limiter.check('login', request.remote_addr, form.login.data)
+        visitor = db.session.scalar(sqla.select(User).where(User.login == form.login.data))
+        if visitor is None or not visitor.check_password(form.password.data):
+            flash('Invalid login or password')
+            return redirect(url_for('auth.login'))
+        db.session.commit() # keeps a hash upgraded by check_password
+        flash(f'Login requested for user {form.login.data}, rememberMe={form.rememberMe.data}')
+        login_user(visitor, remember=form.rememberMe.data)
+        next_page = request.args.get('next')
+        if not next_page or urlsplit(next_page).netloc != '':
+            next_page = url_for('main.index')
+        return redirect(url_for('main.index'))
+    return render_template("login.html", title="Login", form=form)
+
+@bp.route('/logout')
+@login_required
+def logout():
+    logout_user()
+    return redirect(url_for('main.index'))
+
+@bp.route('/reset_password_request', methods=['GET', 'POST'])
+def reset_password_request():
+    if current_user.is_authenticated:
+        return redirect(url_for('main.index'))
+    form = ResetPasswordRequestForm()
+    if form.validate_on_submit():
+        limiter.check('reset_password_request', request.remote_addr, form.email.data)
+        user = db.session.scalar(
+            sqla.select(User).where(User.email == form.email.data))
+        if user:
+            send_password_reset_email(user)
+        flash('Check your email for the instructions to reset your password')
+        return redirect(url_for('auth.login'))
+    return render_template('reset_password_request.html', title='Reset Password', form=form)
+
+@bp.route('/reset_password/<token>', methods=['GET', 'POST'])
+def reset_password(token):
+    if current_user.is_authenticated:
+        return redirect(url_for('main.index'))
+    claims = reset_tokens.verify(token)
+    if not claims:
+        return redirect(url_for('main.index'))
+    form = ResetPasswordForm()
+    if form.validate_on_submit():
+        user = db.session.get(User, claims['user_id'])
+        if user is None or not user.reset_password(claims, form.password2.data):
+            return redirect(url_for('main.index'))
+        db.session.commit()
+        flash('Your password has been reset')
+        return redirect(url_for('main.home_page'))
+    return render_template('reset_password.html', form=form)
@@ -0,0 +1,122 @@
+import os
+import re
+import struct
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict
+from flask import current_app
+
+'''
+identicon avatars generated locally instead of linking to Gravatar. an avatar is a 5x5
+mirrored grid drawn from the md5 digest of the user's email, rendered as a PNG at one of
+AVATAR_SIZES (requests are rounded up to the next size) and kept on disk under
+AVATAR_CACHE_DIR/<size>/<digest>.png. at most AVATAR_CACHE_MAX_FILES files are kept; the
+least recently served ones are deleted first
+'''
+
+DIGEST = re.compile(r'^[0-9a-f]{32}$')
+
+
+def png(width, height, rows):
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    raw = b''.join(b'\x00' + row for row in rows)
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw, 9))
+            + chunk(b'IEND', b''))
+
+
+def identicon(digest, size):
+    data = bytes.fromhex(digest)
+    colour = bytes((data[0] // 2 + 64, data[1] // 2 + 64, data[2] // 2 + 64))
+    background = b'\xf0\xf0\xf0'
+    # 15 bits pick the cells of the left three columns; the right two mirror them
+    bits = int.from_bytes(data[3:5], 'big')
+    cells = [[bool(bits >> (column * 5 + row) & 1) for column in (0, 1, 2, 1, 0)] for row in range(5)]
+    cell = size // 6
+    margin = (size - cell * 5) // 2
+    blank = background * size
+    rows = [blank] * margin
+    for row in cells:
+        line = background * margin + b''.join((colour if on else background) * cell for on in row)
+        line += background * (size - margin - cell * 5)
+        rows.extend([line] * cell)
+    rows.extend([blank] * (size - len(rows)))
+    return png(size, size, rows)
+
+
+class AvatarIndex:
+    # the files of one app's cache directory, least recently served first
+    def __init__(self):
+        self.files = None
+        self.lock = threading.Lock()
+
+
+class AvatarCache:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('AVATAR_SIZES', (32, 48, 64, 128, 256))
+        app.config.setdefault('AVATAR_CACHE_DIR', os.path.join(app.instance_path, 'avatars'))
+        app.config.setdefault('AVATAR_CACHE_MAX_FILES', 20000)
+        app.config.setdefault('AVATAR_MAX_AGE', 365 * 24 * 3600)
+        app.extensions['avatars'] = AvatarIndex()
+
+    def bucket(self, size):
+        sizes = current_app.config['AVATAR_SIZES']
+        return next((bucket for bucket in sizes if bucket >= size), sizes[-1])
+
+    def load_index(self, index):
+        # files survive restarts; their mtimes give the initial recency order
+        directory = current_app.config['AVATAR_CACHE_DIR']
+        found = []
+        for size in current_app.config['AVATAR_SIZES']:
+            folder = os.path.join(directory, str(size))
+            if os.path.isdir(folder):
+                found.extend((entry.stat().st_mtime, entry.path)
+                             for entry in os.scandir(folder) if entry.name.endswith('.png'))
+        index.files = OrderedDict((path, None) for mtime, path in sorted(found))
+
+    def open(self, digest, size):
+        # returns the cached PNG for digest at the bucket for size, opened for reading and
+        # generating it on a miss. the file is opened while the index is locked, so another
+        # request's eviction can only unlink it after that, and the open handle still reads
+        index = current_app.extensions['avatars']
+        size = self.bucket(size)
+        path = os.path.join(current_app.config['AVATAR_CACHE_DIR'], str(size), digest + '.png')
+        with index.lock:
+            if index.files is None:
+                self.load_index(index)
+            if path in index.files:
+                try:
+                    file = open(path, 'rb')
+                except FileNotFoundError:
+                    # deleted behind the index's back; generated again below
+                    del index.files[path]
+                else:
+                    index.files.move_to_end(path)
+                    return file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # a name of its own for every writer, threads and forked workers alike
+        descriptor, partial = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                file.write(identicon(digest, size))
+            os.replace(partial, path)
+        except OSError:
+            os.remove(partial)
+            raise
+        with index.lock:
+            file = open(path, 'rb')
+            index.files[path] = None
+            while len(index.files) > current_app.config['AVATAR_CACHE_MAX_FILES']:
+                evicted, _ = index.files.popitem(last=False)
+                try:
+                    os.remove(evicted)
+                except FileNotFoundError:
+                    pass
+        return file
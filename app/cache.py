@@ -0,0 +1,122 @@
+import threading
+from collections import OrderedDict
+from time import monotonic, time_ns
+from flask import current_app
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+'''
+cache for rendered fragments and pages. the default backend is an in-process LRU; with
+CACHE_TYPE = 'redis' entries go to a local Redis-compatible server shared by all workers.
+entries expire after CACHE_DEFAULT_TIMEOUT seconds. invalidation goes through versioned
+namespaces: keys embed the namespace version, so bumping it orphans every key at once
+'''
+
+
+class LRUBackend:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires <= monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires = monotonic() + timeout if timeout else None
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class RedisBackend:
+    def __init__(self, url, prefix):
+        if redis is None:
+            raise RuntimeError("CACHE_TYPE = 'redis' needs the redis package")
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, timeout=None):
+        self.client.set(self.prefix + key, value, ex=timeout or None)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+class Cache:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_TYPE', 'lru')
+        app.config.setdefault('CACHE_DEFAULT_TIMEOUT', 30)
+        app.config.setdefault('CACHE_MAX_ENTRIES', 10000)
+        app.config.setdefault('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+        app.config.setdefault('CACHE_KEY_PREFIX', 'microblog:')
+        if app.config['CACHE_TYPE'] == 'redis':
+            app.extensions['cache'] = RedisBackend(app.config['CACHE_REDIS_URL'], app.config['CACHE_KEY_PREFIX'])
+        else:
+            app.extensions['cache'] = LRUBackend(app.config['CACHE_MAX_ENTRIES'])
+
+    @property
+    def backend(self):
+        # every app has its own, so apps built side by side never share entries
+        return current_app.extensions['cache']
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = current_app.config['CACHE_DEFAULT_TIMEOUT']
+        self.backend.set(key, value, timeout)
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+    def clear(self):
+        self.backend.clear()
+
+    def version(self, namespace):
+        # a missing version gets a fresh one, never an old one, so an evicted version
+        # can't bring stale entries back
+        version = self.backend.get('version:' + namespace)
+        if version is None:
+            version = self.bump(namespace)
+        return version
+
+    def bump(self, namespace):
+        version = str(time_ns())
+        self.backend.set('version:' + namespace, version)
+        return version
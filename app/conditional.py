@@ -0,0 +1,43 @@
+from hashlib import sha1
+from time import time
+from flask import current_app, request, session, make_response
+from werkzeug.http import is_resource_modified
+
+'''
+conditional GETs for feed and profile pages: the validators are computed from the rows the
+page is about to show, so If-None-Match can be answered with a 304 before any template is
+rendered. there is deliberately no Last-Modified: the newest post's timestamp misses follows,
+backfilled older posts, profile and counter changes and posts made in the same second, all of
+which the ETag covers
+'''
+
+
+def make_etag(*parts):
+    return sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def feed_state(posts):
+    # read from the database rather than from a per-process cache version, so every worker
+    # computes the same validator; an author's profile_version changes when they edit it
+    return [(post.post_id, post.timestamp, post.author.profile_version) for post in posts]
+
+
+def form_epoch():
+    # pages with forms embed a CSRF token that expires, so their validators roll over
+    # well before the token does
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600
+    return int(time() // (limit / 2))
+
+
+def conditional(etag, render):
+    # pending flash messages are only shown (and consumed) by a full render
+    if request.method != 'GET' or '_flashes' in session:
+        return make_response(render())
+    if is_resource_modified(request.environ, etag=etag):
+        response = make_response(render())
+    else:
+        response = make_response('', 304)
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
@@ -1,23 +1,287 @@
-from flask_mail import Message
-from flask import render_template
-from app import mail, web_app
-from threading import Thread
+import atexit
+import functools
+import queue
+import quopri
+import re
+import smtplib
+import socket
+import threading
+import weakref
+from collections import OrderedDict
+from email.utils import formatdate, make_msgid
+from types import SimpleNamespace
+from time import monotonic, sleep
+from flask_mail import Message, sanitize_address, sanitize_subject
+from flask import render_template, request, has_request_context, current_app
+from markupsafe import escape
+from app import mail
+
+'''
+outbound mail goes through a bounded queue drained by a fixed pool of worker threads.
+each worker keeps its SMTP connection open between messages, sends whatever has piled up
+over it in one go, and retries failed messages with exponential backoff. the connection
+is closed after MAIL_IDLE_TIMEOUT seconds without mail. every app gets its own queue and
+workers, kept in app.extensions['mail_queue'], so building another app never strands the
+workers of the first one on a queue nobody fills
+'''
+
+
+class MailPool:
+    def __init__(self, app):
+        self.app = app
+        self.queue = queue.Queue(maxsize=app.config['MAIL_QUEUE_SIZE'])
+        self.workers = []
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.unfinished = 0
+        self.stats = {'sent': 0, 'failed': 0, 'retried': 0, 'rejected': 0}
+
+    def send(self, msg):
+        self.start()
+        with self.lock:
+            try:
+                self.queue.put_nowait(msg)
+            except queue.Full:
+                self.stats['rejected'] += 1
+                self.app.logger.error('Mail queue is full, dropping message to %s', msg.recipients)
+                return False
+            self.unfinished += 1
+        return True
+
+    def start(self):
+        # workers are started on first use, so processes that never send mail never spawn them
+        with self.lock:
+            if self.workers:
+                return
+            for i in range(self.app.config['MAIL_WORKERS']):
+                worker = threading.Thread(target=self.work, name=f'mail-worker-{i}', daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def metrics(self):
+        with self.lock:
+            return dict(self.stats, depth=self.queue.qsize(), in_flight=self.unfinished, workers=len(self.workers))
+
+    def join(self, timeout=None):
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.idle:
+            while self.unfinished:
+                remaining = None if deadline is None else deadline - monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.idle.wait(remaining)
+        return True
+
+    def work(self):
+        with self.app.app_context():
+            connection = None
+            while True:
+                try:
+                    batch = [self.queue.get(timeout=self.app.config['MAIL_IDLE_TIMEOUT'])]
+                except queue.Empty:
+                    connection = self.disconnect(connection)
+                    continue
+                while len(batch) < self.app.config['MAIL_BATCH_SIZE']:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                for msg in batch:
+                    connection = self.deliver(connection, msg)
+                    with self.idle:
+                        self.unfinished -= 1
+                        self.idle.notify_all()
+
+    def deliver(self, connection, msg):
+        retries = self.app.config['MAIL_MAX_RETRIES']
+        for attempt in range(retries + 1):
+            try:
+                if connection is None:
+                    connection = mail.connect()
+                    connection.__enter__()
+                connection.send(msg)
+                with self.lock:
+                    self.stats['sent'] += 1
+                return connection
+            except (smtplib.SMTPException, OSError):
+                connection = self.disconnect(connection)
+                if attempt == retries:
+                    self.app.logger.exception('Could not send mail to %s', msg.recipients)
+                    with self.lock:
+                        self.stats['failed'] += 1
+                    return connection
+                with self.lock:
+                    self.stats['retried'] += 1
+                sleep(self.app.config['MAIL_RETRY_BACKOFF'] * 2 ** attempt)
+            except Exception:
+                # a malformed message is not worth retrying, and must not take the worker down
+                self.app.logger.exception('Could not send mail to %s', msg.recipients)
+                with self.lock:
+                    self.stats['failed'] += 1
+                return connection
+
+    def disconnect(self, connection):
+        if connection is not None:
+            try:
+                connection.__exit__(None, None, None)
+            except (smtplib.SMTPException, OSError):
+                pass
+        return None
+
+
+
+class MailQueue:
+    def __init__(self, app=None):
+        self.pools = weakref.WeakSet()
+        # registered once, however many apps are built
+        atexit.register(self.join_all, 10)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MAIL_QUEUE_SIZE', 1000)
+        app.config.setdefault('MAIL_WORKERS', 2)
+        app.config.setdefault('MAIL_BATCH_SIZE', 20)
+        app.config.setdefault('MAIL_MAX_RETRIES', 3)
+        app.config.setdefault('MAIL_RETRY_BACKOFF', 1.0)
+        app.config.setdefault('MAIL_IDLE_TIMEOUT', 30)
+        pool = app.extensions['mail_queue'] = MailPool(app)
+        self.pools.add(pool)
+
+    def pool(self):
+        return current_app.extensions['mail_queue']
+
+    def send(self, msg):
+        return self.pool().send(msg)
+
+    def metrics(self):
+        return self.pool().metrics()
+
+    def join(self, timeout=None):
+        return self.pool().join(timeout)
+
+    def join_all(self, timeout):
+        deadline = monotonic() + timeout
+        for pool in list(self.pools):
+            pool.join(max(0, deadline - monotonic()))
+
+
+'''
+precompiled emails: each template is rendered through Jinja once (per host, because of the
+external links) with placeholders for the per-user fields, and the MIME headers and part
+headers that never change are assembled once as well. a message is then a few string
+substitutions plus the quoted-printable encoding of its two bodies
+'''
+
+SLOTS = {'MICROBLOGSLOTLOGIN': 'login', 'MICROBLOGSLOTTOKEN': 'token'}
+SLOT_PATTERN = re.compile('|'.join(SLOTS))
+
+
+def link_host():
+    # links are built from SERVER_NAME when it is set. without it they come from the Host
+    # header, which only TRUSTED_HOSTS keeps a client from choosing, so production should set
+    # one of the two
+    server_name = current_app.config['SERVER_NAME']
+    if server_name or not has_request_context():
+        return server_name or ''
+    return request.host_url
+
+
+class EmailTemplate:
+    # compiled copies kept per host and sender, so a stream of made-up Host headers
+    # can't grow the cache without bound
+    max_compiled = 8
+
+    def __init__(self, subject, text_template, html_template):
+        self.subject = subject
+        self.text_template = text_template
+        self.html_template = html_template
+        self.compiled = OrderedDict()
+        self.lock = threading.Lock()
+
+    def compile(self, sender):
+        key = (link_host(), sender)
+        with self.lock:
+            if key in self.compiled:
+                self.compiled.move_to_end(key)
+                return self.compiled[key]
+        placeholders = {'user': SimpleNamespace(login='MICROBLOGSLOTLOGIN'), 'token': 'MICROBLOGSLOTTOKEN'}
+        text = render_template(self.text_template, **placeholders)
+        html = render_template(self.html_template, **placeholders)
+        boundary = '===============' + make_msgid().strip('<>').replace('@', '.') + '=='
+        headers = (
+            f'Content-Type: multipart/alternative; boundary="{boundary}"\r\n'
+            'MIME-Version: 1.0\r\n'
+            f'Subject: {sanitize_subject(self.subject, "utf-8")}\r\n'
+            f'From: {sanitize_address(sender)}\r\n'
+        )
+        parts = [
+            f'--{boundary}\r\nContent-Type: text/{subtype}; charset="utf-8"\r\n'
+            'MIME-Version: 1.0\r\nContent-Transfer-Encoding: quoted-printable\r\n\r\n'
+            for subtype in ('plain', 'html')
+        ]
+        compiled = (headers, parts, f'\r\n--{boundary}--\r\n', text, html)
+        with self.lock:
+            self.compiled[key] = compiled
+            while len(self.compiled) > self.max_compiled:
+                self.compiled.popitem(last=False)
+        return compiled
+
+    def message(self, sender, recipient, **fields):
+        headers, parts, end, text, html = self.compile(sender)
+        text = SLOT_PATTERN.sub(lambda match: str(fields[SLOTS[match.group()]]), text)
+        html = SLOT_PATTERN.sub(lambda match: str(escape(fields[SLOTS[match.group()]])), html)
+        return PrerenderedMessage(self.subject, sender, recipient, headers, parts, end, text, html)
+
+
+@functools.cache
+def message_domain():
+    # looked up on the first message instead of at import, since getfqdn() can wait on DNS
+    return socket.getfqdn()
+
+
+class PrerenderedMessage(Message):
+    # Message.__init__ is skipped on purpose: its make_msgid() looks up the host name on every call
+
+    def __init__(self, subject, sender, recipient, headers, parts, end, text, html):
+        self.subject, self.sender, self.recipients = subject, sender, [recipient]
+        self.reply_to, self.cc, self.bcc, self.attachments = None, [], [], []
+        self.body, self.alts, self.charset, self.extra_headers = text, {'html': html}, 'utf-8', None
+        self.date, self.msgId = None, make_msgid(domain=message_domain())
+        self.mail_options, self.rcpt_options = [], []
+        self.parts = (headers, parts, end)
+
+    def as_string(self):
+        headers, parts, end = self.parts
+        bodies = [quopri.encodestring(body.encode('utf-8')).decode('ascii').replace('\n', '\r\n')
+                  for body in (self.body, self.html)]
+        return (
+            headers
+            + f'To: {sanitize_address(self.recipients[0])}\r\n'
+            + f'Date: {formatdate(self.date, localtime=True)}\r\n'
+            + f'Message-ID: {self.msgId}\r\n\r\n'
+            + parts[0] + bodies[0] + '\r\n' + parts[1] + bodies[1] + end
+        )
+
+    def as_bytes(self):
+        return self.as_string().encode('ascii')
+
+
+reset_password_email = EmailTemplate('[Microblog] Reset your Password',
+                                     'email/reset_password_request.txt',
+                                     'email/reset_password_request.html')
+
+
+mail_queue = MailQueue()
 
-def send_async_email(web_app, msg):
-    with web_app.context():
-        mail.send(msg)
 
 def send_email(subject, sender, recipients, text_body, html_body):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    mail.send(msg)
-    Thread(target=send_async_email, args=(web_app, msg)).start()
+    return mail_queue.send(msg)
 
 def send_password_reset_email(user):
     token = user.get_reset_password_token()
-    send_email('[Microblog] Reset your Password', 
-               sender=web_app.config['ADMINS'][0],
-               recipients=[user.email],
-               text_body=render_template('email/reset_password_request.txt', user=user, token=token),
-               html_body=render_template('email/reset_password_request.html', user=user, token=token))
\ No newline at end of file
+    return mail_queue.send(reset_password_email.message(
+        current_app.config['ADMINS'][0], user.email, login=user.login, token=token))
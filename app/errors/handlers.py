@@ -0,0 +1,40 @@
+from flask import render_template
+from werkzeug.exceptions import HTTPException
+from app import db
+from app.api.errors import api_request, error_response
+from app.errors import bp
+from app.hashing import HashingBusy
+from app.ratelimit import RateLimited
+from math import ceil
+from sqlalchemy.exc import IntegrityError
+
+@bp.app_errorhandler(404)
+def not_found_error(error):
+    if api_request():
+        return error_response(404)
+    return render_template('404.html'), 404
+
+@bp.app_errorhandler(500)
+def internal_error(error):
+    if api_request():
+        return error_response(500)
+    return render_template('500.html'), 500
+
+@bp.app_errorhandler(HashingBusy)
+def hashing_busy_error(error):
+    if api_request():
+        return error_response(503), {'Retry-After': '5'}
+    return render_template('503.html'), 503, {'Retry-After': '5'}
+
+@bp.app_errorhandler(RateLimited)
+def rate_limited_error(error):
+    if api_request():
+        return error_response(429), {'Retry-After': str(ceil(error.retry_after))}
+    return render_template('429.html'), 429, {'Retry-After': str(ceil(error.retry_after))}
+
+@bp.app_errorhandler(HTTPException)
+def http_error(error):
+    # the rest keep werkzeug's own pages, except under the API
+    if api_request():
+        return error_response(error.code, error.description)
+    return error
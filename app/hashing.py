@@ -0,0 +1,102 @@
+import atexit
+import multiprocessing
+import os
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+
+'''
+password hashing runs in a pool of worker processes, so a burst of logins burns their CPU
+instead of holding request threads and the GIL. at most PASSWORD_HASH_CONCURRENCY hashes
+are queued or running at once; a request that can't get a slot within
+PASSWORD_HASH_QUEUE_TIMEOUT seconds is rejected with HashingBusy rather than piling up.
+with PASSWORD_HASH_WORKERS = 0 hashing runs inline in the calling thread. workers are started
+through forkserver (spawn where that is missing), never forked from the threaded server
+'''
+
+
+class HashingBusy(Exception):
+    pass
+
+
+class HashingPool:
+    # one app's worker processes and the slots that bound how many hashes wait on them
+    def __init__(self, app):
+        self.executor = None
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(app.config['PASSWORD_HASH_CONCURRENCY'])
+
+    def start(self, workers):
+        with self.lock:
+            if self.executor is None and workers:
+                # the pool starts once the app is serving, with mail, flusher and request threads
+                # running, and a forked child can inherit one of their locks held
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+                self.executor = ProcessPoolExecutor(workers, mp_context=context)
+            return self.executor
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(cancel_futures=True)
+                self.executor = None
+
+
+class PasswordHasher:
+    def __init__(self, app=None):
+        self.pools = weakref.WeakSet()
+        atexit.register(self.shutdown_all)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PASSWORD_HASH_METHOD', 'pbkdf2:sha256')
+        app.config.setdefault('PASSWORD_HASH_WORKERS', min(4, os.cpu_count() or 1))
+        app.config.setdefault('PASSWORD_HASH_CONCURRENCY', 2 * app.config['PASSWORD_HASH_WORKERS'] or 1)
+        app.config.setdefault('PASSWORD_HASH_QUEUE_TIMEOUT', 2.0)
+        pool = app.extensions['hasher'] = HashingPool(app)
+        self.pools.add(pool)
+
+    def pool(self):
+        return current_app.extensions['hasher']
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, method=current_app.config['PASSWORD_HASH_METHOD'])
+
+    def verify(self, password_hash, password):
+        return self.run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        return password_hash.split('$', 1)[0] != full_method(current_app.config['PASSWORD_HASH_METHOD'])
+
+    def run(self, function, *args, **kwargs):
+        pool = self.pool()
+        if not pool.slots.acquire(timeout=current_app.config['PASSWORD_HASH_QUEUE_TIMEOUT']):
+            raise HashingBusy()
+        try:
+            executor = pool.start(current_app.config['PASSWORD_HASH_WORKERS'])
+            if executor is None:
+                return function(*args, **kwargs)
+            return executor.submit(function, *args, **kwargs).result()
+        finally:
+            pool.slots.release()
+
+    def shutdown(self):
+        self.pool().shutdown()
+
+    def shutdown_all(self):
+        for pool in list(self.pools):
+            pool.shutdown()
+
+
+def full_method(method):
+    # the method as werkzeug writes it into the hash, default parameters included
+    name, *parameters = method.split(':')
+    if name == 'pbkdf2' and len(parameters) < 2:
+        return ':'.join([name, *(parameters or ['sha256']), str(DEFAULT_PBKDF2_ITERATIONS)])
+    if name == 'scrypt' and not parameters:
+        return 'scrypt:32768:8:1'
+    return method
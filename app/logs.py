@@ -0,0 +1,203 @@
+import atexit
+import logging
+import os
+import queue
+import traceback
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, SMTPHandler
+from time import monotonic
+
+'''
+logging off the request path: web_app.logger only puts records on bounded queues, and
+background listeners do the I/O. the file listener drains up to LOG_BATCH_SIZE records at a
+time and writes them with a single flush; the mail listener sends ERROR records, but only the
+first of each kind per LOG_MAIL_DEDUPE_SECONDS, and at most LOG_MAIL_MAX_PER_WINDOW mails per
+LOG_MAIL_WINDOW_SECONDS. a full queue drops records instead of blocking the request. none of
+this is set up until the first record is logged, so processes that never log don't create
+the log directory or start the listener threads
+'''
+
+
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # prepare() folds the traceback into the message, so the frame that raised is noted first
+        if record.exc_info and record.exc_info[2] is not None:
+            frame = traceback.extract_tb(record.exc_info[2])[-1]
+            record.origin = (record.exc_info[0].__name__, frame.filename, frame.lineno)
+        return super().prepare(record)
+
+
+class BatchedRotatingFileHandler(RotatingFileHandler):
+    def handle_batch(self, records):
+        self.acquire()
+        try:
+            for record in records:
+                try:
+                    if self.shouldRollover(record):
+                        self.doRollover()
+                    if self.stream is None:
+                        self.stream = self._open()
+                    self.stream.write(self.format(record) + self.terminator)
+                except Exception:
+                    self.handleError(record)
+            if self.stream is not None:
+                self.stream.flush()
+        finally:
+            self.release()
+
+
+class BatchingQueueListener(QueueListener):
+    def __init__(self, log_queue, *handlers, batch_size=100):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.batch_size = batch_size
+
+    def _monitor(self):
+        # same contract as QueueListener._monitor, but whatever has piled up since the last
+        # write is handed over as one batch
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if self._sentinel in batch:
+                stopping = True
+                batch = [record for record in batch if record is not self._sentinel]
+            self.handle_batch([self.prepare(record) for record in batch])
+
+    def handle_batch(self, records):
+        for handler in self.handlers:
+            eligible = [record for record in records if record.levelno >= handler.level and handler.filter(record)]
+            if not eligible:
+                continue
+            if hasattr(handler, 'handle_batch'):
+                handler.handle_batch(eligible)
+            else:
+                for record in eligible:
+                    handler.handle(record)
+
+
+class ThrottledSMTPHandler(SMTPHandler):
+    def __init__(self, *args, dedupe_seconds=600, max_per_window=10, window_seconds=3600, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dedupe_seconds = dedupe_seconds
+        self.max_per_window = max_per_window
+        self.window_seconds = window_seconds
+        self.last_sent = {}
+        self.suppressed = {}
+        self.sent = deque()
+
+    def signature(self, record):
+        # unhandled exceptions are all logged from the same line in Flask, so they are told
+        # apart by where they were raised
+        return getattr(record, 'origin', None) or (record.pathname, record.lineno)
+
+    def emit(self, record):
+        now = monotonic()
+        key = self.signature(record)
+        while self.sent and now - self.sent[0] >= self.window_seconds:
+            self.sent.popleft()
+        last = self.last_sent.get(key)
+        if (last is not None and now - last < self.dedupe_seconds) or len(self.sent) >= self.max_per_window:
+            self.suppressed[key] = self.suppressed.get(key, 0) + 1
+            return
+        repeats = self.suppressed.pop(key, 0)
+        if repeats:
+            record.msg = f'{record.msg}\n\n({repeats} more like this were not mailed)'
+        self.last_sent[key] = now
+        self.sent.append(now)
+        super().emit(record)
+
+
+class DeferredHandler(logging.Handler):
+    # stands in on app.logger and sets up the real handlers when the first record arrives
+    def __init__(self, app):
+        super().__init__(logging.INFO)
+        self.app = app
+        self.handlers = None
+
+    def handle(self, record):
+        if self.handlers is None:
+            with self.lock:
+                if self.handlers is None:
+                    try:
+                        self.handlers = start_logging(self.app)
+                    except Exception:
+                        self.handlers = []
+                        self.handleError(record)
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+        return True
+
+
+def init_logging(app):
+    app.config.setdefault('LOG_DIR', 'logs')
+    app.config.setdefault('LOG_FILE_MAX_BYTES', 10 * 1024 * 1024)
+    app.config.setdefault('LOG_FILE_BACKUPS', 5)
+    app.config.setdefault('LOG_QUEUE_SIZE', 10000)
+    app.config.setdefault('LOG_BATCH_SIZE', 100)
+    app.config.setdefault('LOG_MAIL_DEDUPE_SECONDS', 600)
+    app.config.setdefault('LOG_MAIL_MAX_PER_WINDOW', 10)
+    app.config.setdefault('LOG_MAIL_WINDOW_SECONDS', 3600)
+    app.logger.addHandler(DeferredHandler(app))
+    app.logger.setLevel(logging.INFO)
+
+
+def start_logging(app):
+    # returns the handlers that put records on the queues; the listeners draining them are started here
+    handlers = []
+    listeners = []
+
+    if app.config['MAIL_SERVER']:
+        auth = None
+        if app.config['MAIL_USERNAME'] and app.config['MAIL_PASSWORD']:
+            auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
+        secure = None
+        if app.config['MAIL_USE_TLS']:
+            secure = ()
+        mail_handler = ThrottledSMTPHandler(
+            mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
+            fromaddr='no-reply@' + app.config['MAIL_SERVER'],
+            toaddrs=app.config['ADMINS'], subject='Microblog Failure',
+            credentials=auth, secure=secure,
+            dedupe_seconds=app.config['LOG_MAIL_DEDUPE_SECONDS'],
+            max_per_window=app.config['LOG_MAIL_MAX_PER_WINDOW'],
+            window_seconds=app.config['LOG_MAIL_WINDOW_SECONDS'])
+        mail_handler.setLevel(logging.ERROR)
+        # its own queue and thread, so a slow mail server never holds up the log file
+        mail_queue = queue.Queue(app.config['LOG_QUEUE_SIZE'])
+        queue_handler = DroppingQueueHandler(mail_queue)
+        queue_handler.setLevel(logging.ERROR)
+        handlers.append(queue_handler)
+        listeners.append(QueueListener(mail_queue, mail_handler, respect_handler_level=True))
+
+    os.makedirs(app.config['LOG_DIR'], exist_ok=True)
+    file_handler = BatchedRotatingFileHandler(
+        os.path.join(app.config['LOG_DIR'], 'sandbox.log'),
+        maxBytes=app.config['LOG_FILE_MAX_BYTES'], backupCount=app.config['LOG_FILE_BACKUPS'])
+    file_handler.setFormatter(logging.Formatter(
+        '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
+    file_handler.setLevel(logging.INFO)
+    file_queue = queue.Queue(app.config['LOG_QUEUE_SIZE'])
+    queue_handler = DroppingQueueHandler(file_queue)
+    queue_handler.setLevel(logging.INFO)
+    handlers.append(queue_handler)
+    listeners.append(BatchingQueueListener(file_queue, file_handler, batch_size=app.config['LOG_BATCH_SIZE']))
+
+    for listener in listeners:
+        listener.start()
+        atexit.register(listener.stop)
+    return handlers
@@ -0,0 +1,209 @@
+import sqlalchemy as sqla
+from flask import render_template, stream_template, flash, redirect, url_for, request, session, send_file, abort, \
+    current_app
+from markupsafe import Markup
+from app import db, tracker, cache, avatars
+from app.avatars import DIGEST
+from app.replicas import read_only
+from app.forms import EditProfileForm, EmptyForm, PostForm
+from app.models import User, Post, load_feed, follows, clear_request_caches
+from app.pagination import paginate_keyset
+from app.search import search_index
+from app.conditional import conditional, make_etag, feed_state, form_epoch
+from app.main import bp
+from flask_login import current_user, login_required
+from typing import cast
+
+def page_urls(posts, endpoint, **values):
+    next_url = url_for(endpoint, cursor=posts.next_cursor, **values) \
+        if posts.has_next else None
+    prev_url = url_for(endpoint, cursor=posts.prev_cursor, **values) \
+        if posts.has_prev else None
+    return next_url, prev_url
+
+
+def home_page_feed():
+    posts = paginate_keyset(load_feed(sqla.select(Post)), request.args.get('cursor'))
+    next_url, prev_url = page_urls(posts, 'main.home_page')
+    return posts, {'posts': posts.items, 'next_url': next_url, 'prev_url': prev_url}
+
+
+def render_cached_home_page(key, context):
+    page = cache.get(key)
+    if page is None:
+        page = render_template('home_page.html', **context)
+        cache.set(key, page)
+    return page
+
+
+@bp.route('/')
+@bp.route('/home_page', methods=['GET', 'POST'])
+@read_only
+def home_page():
+    posts, context = home_page_feed()
+    # anonymous visitors all get the same page, so it is served from the cache under the
+    # page's own validator: a new post or profile edit changes both, in every worker
+    if current_user.is_anonymous and '_flashes' not in session:
+        etag = make_etag(request.args.get('cursor', ''), feed_state(posts.items))
+        return conditional(etag, lambda: render_cached_home_page(f'view:home_page:{etag}', context))
+
+    etag = make_etag(current_user.id, current_user.login, feed_state(posts.items))
+    return conditional(etag, lambda: stream_template('home_page.html', **context))
+
+
+@bp.route('/explore')
+@read_only
+@login_required
+def explore():
+    posts = paginate_keyset(load_feed(sqla.select(Post)), request.args.get('cursor'))
+    next_url, prev_url = page_urls(posts, 'main.explore')
+
+    etag = make_etag(current_user.id, current_user.login, feed_state(posts.items))
+    return conditional(etag, lambda: render_template(
+        'index.html', title='Explore', posts=posts.items, next_url=next_url, prev_url=prev_url))
+
+
+@bp.route('/search')
+@read_only
+@login_required
+def search():
+    q = request.args.get('q', '').strip()
+    posts = search_index.search(q, request.args.get('cursor'))
+    next_url, prev_url = page_urls(posts, 'main.search', q=q)
+    return render_template('search.html', title='Search', q=q, posts=posts.items,
+                           next_url=next_url, prev_url=prev_url)
+
+
+@bp.route("/index", methods=['GET', 'POST'])
+@read_only
+@login_required
+def index():
+    form = PostForm()
+    if form.validate_on_submit():
+        cast(User, current_user).publish(str(form.post.data))
+        db.session.commit()
+        flash('Your post is in public, even tho nobody cares')
+    posts = paginate_keyset(load_feed(current_user.home_timeline()), request.args.get('cursor'))
+    next_url, prev_url = page_urls(posts, 'main.index')
+
+    etag = make_etag(current_user.id, current_user.login, feed_state(posts.items), form_epoch())
+    return conditional(etag, lambda: render_template(
+        'index.html', title="Home", posts=posts.items, form=form, next_url=next_url, prev_url=prev_url))
+
+
+@bp.app_context_processor
+def follow_helpers():
+    return {'follows': lambda user: follows(current_user, user)}
+
+
+@bp.app_context_processor
+def fragment_helpers():
+    return {'render_post': render_post}
+
+
+def render_post(post):
+    # the author's version changes when they edit their profile
+    key = f'fragment:post:{post.post_id}:{post.author.profile_version}'
+    html = cache.get(key)
+    if html is None:
+        # a macro from the template's module, which Jinja builds once, instead of a full
+        # template render with a fresh context for every post
+        html = str(current_app.jinja_env.get_template('#post.html').module.post_entry(post))
+        cache.set(key, html)
+    return Markup(html)
+
+
+@bp.before_app_request
+def before_request():
+    if current_user.is_authenticated:
+        tracker.seen(current_user)
+
+
+bp.teardown_app_request(clear_request_caches)
+
+
+@bp.route('/user/<login>')
+@read_only
+@login_required
+def user(login):
+    form = EmptyForm()
+    visitor = db.first_or_404(sqla.select(User).where(User.login == login))
+    query = load_feed(sqla.select(Post).where(Post.user_id == visitor.id))
+    posts = paginate_keyset(query, request.args.get('cursor'))
+    next_url, prev_url = page_urls(posts, 'main.user', login=visitor.login)
+    last_seen = tracker.last_seen(visitor)
+
+    profile = (visitor.login, visitor.about_me, visitor.followers_total, visitor.following_total,
+               visitor.posts_total, last_seen, follows(current_user, visitor))
+    etag = make_etag(current_user.id, current_user.login, profile, feed_state(posts.items), form_epoch())
+    return conditional(etag, lambda: stream_template(
+        'user.html', user=visitor, posts=posts.items, form=form, last_seen=last_seen,
+        next_url=next_url, prev_url=prev_url))
+
+
+@bp.route('/edit_profile', methods=['GET', 'POST'])
+@login_required
+def edit_profile():
+    form = EditProfileForm(current_user.login)
+    if form.validate_on_submit():
+        current_user.login = form.login.data
+        current_user.about_me = form.about_me.data
+        current_user.profile_version = User.profile_version + 1
+        db.session.commit()
+        flash('Your changes have been saved')
+        return redirect(url_for('main.edit_profile'))
+    elif request.method == 'GET':
+        form.login.data = current_user.login
+        form.about_me.data = current_user.about_me
+    return render_template('edit_profile.html', title='Edit Profile', form=form)
+
+@bp.route('/follow/<login>', methods=['POST'])
+@login_required
+def follow(login):
+    form = EmptyForm()
+    if form.validate_on_submit():
+        user = db.session.scalar(sqla.select(User).where(User.login == login))
+        if user is None:
+            flash(f'User {login} not found')
+            return redirect(url_for('main.index'))
+        if current_user.id == user.id: #user and current_user are represented as two different objects in Python,
+                                       #meanwhile user.id and current_user.id are specified to point to id of the user
+            flash('You can not follow yourself')
+            return redirect(url_for('main.user', login=login))
+        current_user.follow(user)
+        db.session.commit()
+        flash(f'You are following {login}')
+        return redirect(url_for('main.user', login=login))
+    else:
+        return redirect(url_for('main.index')) 
+
+@bp.route('/unfollow/<login>', methods=['POST'])
+@login_required
+def unfollow(login):
+    form = EmptyForm()
+    if form.validate_on_submit():
+        user = db.session.scalar(sqla.select(User).where(User.login == login))
+        if user is None:
+            flash (f'User {login} not found')
+            return redirect(url_for('main.index'))
+        if user == current_user:
+            flash('You can not unfollow yourself')
+            return(url_for('main.user', login=login))
+        current_user.unfollow(user)
+        db.session.commit()
+        flash(f'You unfollowed {login}')
+        return redirect(url_for('main.user', login=login))
+    else:
+        return redirect(url_for('main.index'))
+    
+@bp.route('/avatar/<digest>/<int:size>')
+def avatar(digest, size):
+    if not DIGEST.match(digest) or not 0 < size <= 1024:
+        abort(404)
+    # an open file has no path to derive an ETag from, but the digest in the URL identifies it
+    response = send_file(avatars.open(digest, size), mimetype='image/png', etag=digest,
+                         max_age=current_app.config['AVATAR_MAX_AGE'])
+    # the digest is in the URL, so the image behind it never changes
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
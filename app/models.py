@@ -1,14 +1,12 @@
 import sqlalchemy.orm as orm
 import sqlalchemy as sqla
-import jwt
 from typing import Optional 
+from flask import g, has_request_context, url_for, current_app
 from flask_login import UserMixin
-from app import db, login_manager, web_app
+from app import db, login_manager, hasher, reset_tokens, avatars, timelines
 from datetime import datetime, timezone
-from werkzeug.security import generate_password_hash, check_password_hash
 from hashlib import md5
 from dataclasses import dataclass
-from time import time
 
 '''
 responsible for managin whether the user is already in the system or not. 
@@ -17,24 +15,176 @@ if the user is logged in, load the corresponding data
 
 @login_manager.user_loader
 def load_user(user_id):
-    return db.session.get(User, int(user_id))
+    return cached_user(int(user_id))
+
+'''
+(follower_id, followed_id) is the primary key, which answers is_following and "who do I follow";
+the reverse index answers "who follows me" for counters, fan-out and the timeline join
+'''
 
 follower = sqla.Table(
     'followers',
     db.metadata,
-    sqla.Column('follower_id', sqla.Integer, sqla.ForeignKey('user.id')),
-    sqla.Column('followed_id', sqla.Integer, sqla.ForeignKey('user.id'))
+    sqla.Column('follower_id', sqla.Integer, sqla.ForeignKey('user.id'), primary_key=True),
+    sqla.Column('followed_id', sqla.Integer, sqla.ForeignKey('user.id'), primary_key=True),
+    sqla.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id')
+)
+
+'''
+materialized home timeline: one row per (reader, post), filled on write so /index
+can page through it with a range scan over the primary key instead of joining followers
+'''
+
+timeline = sqla.Table(
+    'timeline',
+    db.metadata,
+    sqla.Column('user_id', sqla.Integer, sqla.ForeignKey('user.id'), primary_key=True),
+    sqla.Column('timestamp', sqla.DateTime, primary_key=True),
+    sqla.Column('post_id', sqla.Integer, sqla.ForeignKey('post.post_id'), primary_key=True)
 )
 
+'''
+a single row the primary stamps with the time every REPLICA_CHECK_INTERVAL seconds; how old
+a replica's copy of it is tells how far that replica trails (see app.replicas)
+'''
+replica_heartbeat = sqla.Table(
+    'replica_heartbeat',
+    db.metadata,
+    sqla.Column('id', sqla.Integer, primary_key=True),
+    sqla.Column('beat', sqla.Float, nullable=False)
+)
+
+def trim_timelines(readers):
+    # keeps the newest TIMELINE_LENGTH rows of each reader in readers (ids or a select). only
+    # readers over the cap are touched, and their rows are ranked in one pass with ROW_NUMBER
+    # instead of walking TIMELINE_LENGTH rows of the index again for every row
+    length = current_app.config['TIMELINE_LENGTH']
+    over = (
+        sqla.select(timeline.c.user_id)
+        .where(timeline.c.user_id.in_(readers))
+        .group_by(timeline.c.user_id)
+        .having(sqla.func.count() > length)
+    )
+    rank = sqla.func.row_number().over(partition_by=timeline.c.user_id,
+                                       order_by=(timeline.c.timestamp.desc(), timeline.c.post_id.desc()))
+    ranked = (
+        sqla.select(timeline.c.user_id, timeline.c.timestamp, timeline.c.post_id, rank.label('rank'))
+        .where(timeline.c.user_id.in_(over))
+        .subquery()
+    )
+    excess = sqla.select(ranked.c.user_id, ranked.c.timestamp, ranked.c.post_id).where(ranked.c.rank > length)
+    db.session.execute(sqla.delete(timeline).where(
+        sqla.tuple_(timeline.c.user_id, timeline.c.timestamp, timeline.c.post_id).in_(excess)))
+
+def batches(ids):
+    size = current_app.config['TIMELINE_BATCH_SIZE']
+    return [ids[start:start + size] for start in range(0, len(ids), size)]
+
+def trim_readers_of(author_ids):
+    # the timelines the authors' fan-outs grew: their own and their followers', one
+    # transaction per TIMELINE_BATCH_SIZE readers
+    readers = set(author_ids)
+    for authors in batches(sorted(author_ids)):
+        readers.update(db.session.scalars(
+            sqla.select(follower.c.follower_id).where(follower.c.followed_id.in_(authors))))
+    for batch in batches(sorted(readers)):
+        trim_timelines(batch)
+        db.session.commit()
+
+def copy_posts(author_id, readers=None, after=0, until=None):
+    # the author's newest TIMELINE_LENGTH posts with after < post_id <= until into the timelines
+    # of its followers (only those in readers, when given) that don't have them
+    recent = sqla.select(Post.timestamp, Post.post_id).where(Post.user_id == author_id, Post.post_id > after)
+    if until is not None:
+        recent = recent.where(Post.post_id <= until)
+    recent = recent.order_by(Post.timestamp.desc()).limit(current_app.config['TIMELINE_LENGTH']).subquery()
+    stored = sqla.select(timeline.c.post_id).where(
+        timeline.c.user_id == follower.c.follower_id,
+        timeline.c.post_id == recent.c.post_id,
+    )
+    missing = (
+        sqla.select(follower.c.follower_id, recent.c.timestamp, recent.c.post_id)
+        .join(recent, sqla.true())
+        .where(follower.c.followed_id == author_id, ~stored.exists())
+    )
+    if readers is not None:
+        missing = missing.where(follower.c.follower_id.in_(readers))
+    db.session.execute(sqla.insert(timeline).from_select(['user_id', 'timestamp', 'post_id'], missing))
+
+def demote_celebrity(user_id):
+    # posts written while the user was a celebrity were never fanned out, so they are copied
+    # into the followers' timelines a batch at a time before the flag comes off. until then the
+    # followers keep reading through the join; posts published during the copy are caught up
+    # once fan-out has resumed
+    demote_below = current_app.config['TIMELINE_DEMOTE_THRESHOLD']
+    user = db.session.get(User, user_id)
+    if user is None or not user.celebrity or user.followers_total >= demote_below:
+        return False
+    newest = db.session.scalar(sqla.select(sqla.func.max(Post.post_id)).where(Post.user_id == user_id)) or 0
+    followers = db.session.scalars(
+        sqla.select(follower.c.follower_id).where(follower.c.followed_id == user_id).order_by(follower.c.follower_id)
+    ).all()
+    for batch in batches(followers):
+        copy_posts(user_id, batch, until=newest)
+        trim_timelines(batch)
+        db.session.commit()
+    demoted = db.session.execute(
+        sqla.update(User)
+        .where(User.id == user_id, User.celebrity, User.followers_total < demote_below)
+        .values(celebrity=False)
+    ).rowcount
+    if demoted:
+        copy_posts(user_id, after=newest)
+    db.session.commit()
+    return bool(demoted)
+
+def maintain_timelines():
+    # the background upkeep over the whole database, for what a restarted worker forgot:
+    # flags accounts past either threshold, demotes and trims. returns (demoted, trimmed)
+    config = current_app.config
+    db.session.execute(
+        sqla.update(User)
+        .where(~User.celebrity, User.followers_total > config['TIMELINE_CELEBRITY_THRESHOLD'])
+        .values(celebrity=True)
+    )
+    db.session.commit()
+    demotions = db.session.scalars(
+        sqla.select(User.id).where(User.celebrity, User.followers_total < config['TIMELINE_DEMOTE_THRESHOLD'])
+    ).all()
+    demoted = sum(demote_celebrity(user_id) for user_id in demotions)
+    readers = db.session.scalars(
+        sqla.select(timeline.c.user_id)
+        .group_by(timeline.c.user_id)
+        .having(sqla.func.count() > config['TIMELINE_LENGTH'])
+    ).all()
+    for batch in batches(readers):
+        trim_timelines(batch)
+        db.session.commit()
+    return demoted, len(readers)
+
+def avatar_url(email, email_digest, size):
+    # rows bulk-inserted without going through the validator have no digest yet
+    digest = email_digest or md5(email.lower().encode('utf-8')).hexdigest()
+    return url_for('main.avatar', digest=digest, size=avatars.bucket(size))
+
 @dataclass
 class User(db.Model, UserMixin):
 
     id: orm.Mapped[int] = orm.mapped_column(primary_key=True)
     login: orm.Mapped[str] = orm.mapped_column(sqla.String(64), unique=True, index=True)
     email: orm.Mapped[str] = orm.mapped_column(sqla.String(120), unique=True, index=True)
+    email_digest: orm.Mapped[Optional[str]] = orm.mapped_column(sqla.String(32))
     password_hash: orm.Mapped[str] = orm.mapped_column(sqla.String(128))
     about_me: orm.Mapped[Optional[str]] = orm.mapped_column(sqla.String(1256))
     last_seen: orm.Mapped[Optional[datetime]] = orm.mapped_column(default=lambda: datetime.now(timezone.utc))
+    followers_total: orm.Mapped[int] = orm.mapped_column(default=0, server_default='0')
+    following_total: orm.Mapped[int] = orm.mapped_column(default=0, server_default='0')
+    posts_total: orm.Mapped[int] = orm.mapped_column(default=0, server_default='0')
+    # set past TIMELINE_CELEBRITY_THRESHOLD followers, cleared below TIMELINE_DEMOTE_THRESHOLD
+    celebrity: orm.Mapped[bool] = orm.mapped_column(default=False, server_default=sqla.false())
+    # raised on every profile edit; feed validators and cached fragments are keyed on it, so
+    # every worker sees an edit as soon as it is committed
+    profile_version: orm.Mapped[int] = orm.mapped_column(default=0, server_default='0')
 
     following: orm.WriteOnlyMapped['User'] = orm.relationship(
         secondary=follower, 
@@ -56,62 +206,170 @@ class User(db.Model, UserMixin):
         return f"User {self.login}"
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password, method='pbkdf2:sha256') #adding method in shell too, so it works correctly
+        self.password_hash = hasher.hash(password)
 
     def check_password(self, password):
         if self.password_hash is None: # in case password is not set
             return False
-        return check_password_hash(self.password_hash, password)
+        if not hasher.verify(self.password_hash, password):
+            return False
+        if hasher.needs_rehash(self.password_hash): # PASSWORD_HASH_METHOD changed since it was set
+            self.set_password(password)
+        return True
     
+    @orm.validates('email')
+    def update_email_digest(self, key, email):
+        # hashed once here, so rendering an avatar never does
+        self.email_digest = md5(email.lower().encode('utf-8')).hexdigest() if email else None
+        return email
+
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return f"https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}"
+        return avatar_url(self.email, self.email_digest, size)
     
     def follow(self, user):
         if not self.is_following(user):
             self.following.add(user)
+            remember_following(self, user, True)
+            bump_counter(self, User.following_total, 1)
+            bump_counter(user, User.followers_total, 1)
+            self.backfill_timeline(user)
+            # promotion only stops fan-out, so it is cheap enough to do right here
+            db.session.execute(
+                sqla.update(User)
+                .where(User.id == user.id, ~User.celebrity,
+                       User.followers_total > current_app.config['TIMELINE_CELEBRITY_THRESHOLD'])
+                .values(celebrity=True)
+            )
 
     def is_following(self, user):
         query = self.following.select().where(User.id == user.id)
         return db.session.scalar(query) is not None
+
+    def following_among(self, user_ids):
+        user_ids = set(user_ids)
+        if not user_ids:
+            return set()
+        query = sqla.select(follower.c.followed_id).where(
+            follower.c.follower_id == self.id,
+            follower.c.followed_id.in_(user_ids),
+        )
+        return set(db.session.scalars(query))
     
     def unfollow(self, user):
         if self.is_following(user):
             self.following.remove(user)
+            remember_following(self, user, False)
+            bump_counter(self, User.following_total, -1)
+            bump_counter(user, User.followers_total, -1)
+            self.trim_timeline(user)
+            followers, celebrity = db.session.execute(
+                sqla.select(User.followers_total, User.celebrity).where(User.id == user.id)).one()
+            if celebrity and followers < current_app.config['TIMELINE_DEMOTE_THRESHOLD']:
+                timelines.demote_later(user.id) # copying its posts to every follower is no job for a request
     
     def followers_count(self):
-        query = sqla.select(sqla.func.count()).select_from(self.followers.select().subquery())
-        return db.session.scalar(query)
+        return self.followers_total
     
     def following_count(self):
-        query = sqla.select(sqla.func.count()).select_from(self.following.select().subquery())
-        return db.session.scalar(query)
+        return self.following_total
+
+    def posts_count(self):
+        return self.posts_total
 
     def following_posts(self):
-        Author = orm.aliased(User)
-        Follower = orm.aliased(User)
+        # a semi-join on the followers primary key instead of joining every edge and grouping
+        followed = sqla.select(follower.c.followed_id).where(follower.c.follower_id == self.id)
         return (
             sqla.select(Post)
-            .join(Post.author.of_type(Author))
-            .join(Author.followers.of_type(Follower), isouter=True)
             .where(sqla.or_(
-                    Follower.id == self.id,
-                    Author.id == self.id,
+                    Post.user_id.in_(followed),
+                    Post.user_id == self.id,
                 ))
-            .group_by(Post.post_id)
             .order_by(Post.timestamp.desc())
         )
+
+    def is_celebrity(self):
+        return self.celebrity
+
+    def follows_celebrity(self):
+        query = (
+            sqla.select(follower.c.followed_id)
+            .join(User, User.id == follower.c.followed_id)
+            .where(follower.c.follower_id == self.id)
+            .where(User.celebrity)
+            .limit(1)
+        )
+        return db.session.scalar(query) is not None
+
+    def home_timeline(self):
+        # posts of celebrities are not fanned out, so their followers read through the join
+        if self.follows_celebrity():
+            return self.following_posts()
+        return (
+            sqla.select(Post)
+            .join(timeline, timeline.c.post_id == Post.post_id)
+            .where(timeline.c.user_id == self.id)
+            .order_by(timeline.c.timestamp.desc(), timeline.c.post_id.desc())
+            .execution_options(keyset=(timeline.c.timestamp, timeline.c.post_id))
+        )
+
+    def backfill_timeline(self, user):
+        stored = sqla.select(timeline.c.post_id).where(
+            timeline.c.user_id == self.id,
+            timeline.c.post_id == Post.post_id,
+        )
+        recent = (
+            sqla.select(sqla.literal(self.id), Post.timestamp, Post.post_id)
+            .where(Post.user_id == user.id, ~stored.exists())
+            .order_by(Post.timestamp.desc())
+            .limit(current_app.config['TIMELINE_LENGTH'])
+        )
+        db.session.execute(sqla.insert(timeline).from_select(['user_id', 'timestamp', 'post_id'], recent))
+        trim_timelines([self.id])
+
+    def trim_timeline(self, user):
+        db.session.execute(
+            sqla.delete(timeline).where(
+                timeline.c.user_id == self.id,
+                timeline.c.post_id.in_(sqla.select(Post.post_id).where(Post.user_id == user.id)),
+            )
+        )
+
+    def publish(self, body):
+        post = Post(body=body, author=self)
+        db.session.add(post)
+        db.session.flush() # post_id and timestamp are needed for the fan-out
+        bump_counter(self, User.posts_total, 1)
+        post.fan_out()
+        return post
     
-    def get_reset_password_token(self, expiresIn=600):
-        return jwt.encode({'user_id': self.id, 'exp': time() + expiresIn}, web_app.config['SECRET_KEY'], algorithm='HS256')
+    def get_reset_password_token(self, expiresIn=None):
+        return reset_tokens.issue(self, expiresIn)
     
     @staticmethod
     def verify_reset_password_token(token):
-        try:
-            id = jwt.decode(token, web_app.config['SECRET_KEY'], algorithms=['HS256'])['user_id']
-        except:
+        claims = reset_tokens.verify(token)
+        if claims is None:
             return
-        return db.session.get(User, id)
+        user = db.session.get(User, claims['user_id'])
+        if user is None or not reset_tokens.matches(claims, user.password_hash):
+            return
+        return user
+
+    def reset_password(self, claims, password):
+        # the new hash is computed before the token is spent, so a HashingBusy leaves it usable.
+        # the UPDATE only applies while the hash the token was issued against is still stored,
+        # so of two concurrent resets with one token, in any processes, exactly one wins
+        old_hash = self.password_hash
+        if not reset_tokens.matches(claims, old_hash):
+            return False
+        new_hash = hasher.hash(password)
+        result = db.session.execute(
+            sqla.update(User)
+            .where(User.id == self.id, User.password_hash == old_hash)
+            .values(password_hash=new_hash)
+        )
+        return result.rowcount == 1
 
 
 @dataclass    
@@ -125,3 +383,131 @@ class Post(db.Model):
 
     def __repr__(self) -> str:
         return f"Post {self.body}" #this method is defined for developers to easier debug and test the models in the shell
+
+    def fan_out(self):
+        readers = sqla.select(sqla.literal(self.user_id))
+        if not self.author.is_celebrity():
+            readers = sqla.union(readers, sqla.select(follower.c.follower_id).where(
+                follower.c.followed_id == self.user_id))
+        readers = readers.subquery()
+        rows = sqla.select(
+            readers.c[0],
+            sqla.literal(self.timestamp, sqla.DateTime),
+            sqla.literal(self.post_id),
+        )
+        db.session.execute(sqla.insert(timeline).from_select(['user_id', 'timestamp', 'post_id'], rows))
+        # every reader is now a row over the cap until the background upkeep trims them
+        timelines.trim_later(self.user_id)
+
+
+'''
+follower, following and post counters are denormalized onto User so profiles read them
+as plain columns. they are bumped with an UPDATE ... SET x = x + 1 so concurrent follows
+don't lose increments, and reconcile_counters() recounts them from the source tables
+'''
+
+def bump_counter(user, counter, delta):
+    db.session.execute(sqla.update(User).where(User.id == user.id).values({counter: counter + delta}))
+
+
+def reconcile_counters():
+    followers = (
+        sqla.select(sqla.func.count()).select_from(follower)
+        .where(follower.c.followed_id == User.id).scalar_subquery()
+    )
+    following = (
+        sqla.select(sqla.func.count()).select_from(follower)
+        .where(follower.c.follower_id == User.id).scalar_subquery()
+    )
+    posts = sqla.select(sqla.func.count()).select_from(Post).where(Post.user_id == User.id).scalar_subquery()
+    drifted = sqla.or_(User.followers_total != followers, User.following_total != following, User.posts_total != posts)
+    result = db.session.execute(
+        sqla.update(User).where(drifted)
+        .values(followers_total=followers, following_total=following, posts_total=posts)
+        .execution_options(synchronize_session='fetch')
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+'''
+feed loading: a page of posts gets its authors with one SELECT ... IN, skipping the ones
+already in the session. every User loaded while handling a request is also kept in a
+per-request identity cache, so helpers can look users up by id without a query
+'''
+
+def load_feed(query):
+    return query.options(orm.selectinload(Post.author))
+
+
+def identity_cache():
+    if 'identity_cache' not in g:
+        g.identity_cache = {}
+    return g.identity_cache
+
+
+def cached_user(user_id):
+    cache = identity_cache()
+    if user_id not in cache:
+        cache[user_id] = db.session.get(User, user_id)
+    return cache[user_id]
+
+
+@sqla.event.listens_for(User, 'load')
+def remember_user(user, context):
+    if has_request_context():
+        identity_cache().setdefault(user.id, user)
+
+
+'''
+follow state is memoized per request as {(follower_id, followed_id): bool}; pages that show
+follow buttons prime it for all their users at once with a single following_among() query
+'''
+
+def following_memo():
+    if 'following_memo' not in g:
+        g.following_memo = {}
+    return g.following_memo
+
+
+def prime_following(viewer, users):
+    memo = following_memo()
+    missing = {user.id for user in users if (viewer.id, user.id) not in memo}
+    if missing:
+        followed = viewer.following_among(missing)
+        for user_id in missing:
+            memo[viewer.id, user_id] = user_id in followed
+
+
+def follows(viewer, user):
+    prime_following(viewer, [user])
+    return following_memo()[viewer.id, user.id]
+
+
+def remember_following(viewer, user, state):
+    if has_request_context():
+        following_memo()[viewer.id, user.id] = state
+
+
+def clear_request_caches(exception=None):
+    g.pop('identity_cache', None)
+    g.pop('following_memo', None)
+
+
+def rebuild_timelines(users=None):
+    if users is None:
+        users = db.session.scalars(sqla.select(User)).all()
+    for user in users:
+        db.session.execute(sqla.delete(timeline).where(timeline.c.user_id == user.id))
+        authors = sqla.union(
+            sqla.select(sqla.literal(user.id)),
+            sqla.select(follower.c.followed_id).where(follower.c.follower_id == user.id),
+        )
+        recent = (
+            sqla.select(sqla.literal(user.id), Post.timestamp, Post.post_id)
+            .where(Post.user_id.in_(authors))
+            .order_by(Post.timestamp.desc())
+            .limit(current_app.config['TIMELINE_LENGTH'])
+        )
+        db.session.execute(sqla.insert(timeline).from_select(['user_id', 'timestamp', 'post_id'], recent))
+    db.session.commit()
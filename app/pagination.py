@@ -0,0 +1,87 @@
+import sqlalchemy as sqla
+from datetime import datetime
+from flask import current_app
+from itsdangerous import URLSafeSerializer, BadSignature
+from app import db
+from app.models import Post
+
+'''
+keyset pagination over (timestamp, post_id): every page is a range scan that starts
+right after the cursor, so deep pages cost the same as the first one and no COUNT is run.
+queries can carry their own key columns through the `keyset` execution option
+(see User.home_timeline), otherwise the Post columns are used. with rows=True the page holds
+the query's result rows instead of entities, for selects of plain columns; they need
+timestamp and post_id among them for the cursors
+'''
+
+NEWER, OLDER = 'newer', 'older'
+
+
+class CursorPage:
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+def _serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='feed-cursor')
+
+
+def encode_cursor(post, direction):
+    return _serializer().dumps([post.timestamp.isoformat(), post.post_id, direction])
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp, post_id, direction = _serializer().loads(cursor)
+        return datetime.fromisoformat(timestamp), int(post_id), direction
+    except (BadSignature, TypeError, ValueError):
+        return None
+
+
+def paginate_keyset(query, cursor=None, per_page=None, rows=False):
+    per_page = per_page or current_app.config['POSTS_PER_PAGE']
+    keys = query.get_execution_options().get('keyset', (Post.timestamp, Post.post_id))
+    position = decode_cursor(cursor) if cursor else None
+
+    query = query.order_by(None)
+    if position is None:
+        direction = OLDER
+        query = query.order_by(*[key.desc() for key in keys])
+    else:
+        timestamp, post_id, direction = position
+        if direction == NEWER:
+            query = query.where(sqla.tuple_(*keys) > (timestamp, post_id)).order_by(*[key.asc() for key in keys])
+        else:
+            query = query.where(sqla.tuple_(*keys) < (timestamp, post_id)).order_by(*[key.desc() for key in keys])
+
+    result = db.session.execute(query.limit(per_page + 1))
+    items = result.all() if rows else result.scalars().all()
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    if direction == NEWER:
+        items.reverse()
+    if not items:
+        return CursorPage(items)
+
+    if direction == NEWER:
+        has_newer, has_older = has_more, True
+    else:
+        has_newer, has_older = position is not None, has_more
+    return CursorPage(
+        items,
+        next_cursor=encode_cursor(items[-1], OLDER) if has_older else None,
+        prev_cursor=encode_cursor(items[0], NEWER) if has_newer else None,
+    )
@@ -0,0 +1,189 @@
+import bisect
+import heapq
+import random
+import threading
+from time import perf_counter
+import sqlalchemy as sqla
+import sqlalchemy.orm as orm
+from flask import g, has_app_context, current_app, request, jsonify, abort, request_started, request_finished, \
+    before_render_template, template_rendered
+
+'''
+per-request profiling: a sampled request (PROFILE_SAMPLE_RATE of them) records its query
+count, SQL time, slowest statements, template render time and session commit time. the
+numbers collected by the time the response leaves are sent in an X-Server-Timing header;
+the final ones, which also cover templates streamed after the headers, are added to
+per-endpoint histograms served as JSON from /debug/perf. requests that are not sampled
+only pay for a random() call and a few attribute lookups
+'''
+
+MS_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+QUERY_BUCKETS = [0, 1, 2, 3, 5, 10, 20, 50, 100]
+
+
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+
+    def report(self):
+        requests = sum(self.counts)
+        labels = [f'<={bound}' for bound in self.bounds] + [f'>{self.bounds[-1]}']
+        return {'mean': round(self.total / requests, 2) if requests else None,
+                'buckets': dict(zip(labels, self.counts))}
+
+
+class Profile:
+    def __init__(self):
+        self.started = perf_counter()
+        self.queries = 0
+        self.sql = 0.0
+        self.slowest = []
+        self.render = 0.0
+        self.commit = 0.0
+        self.marks = {}
+
+    def timings(self):
+        return {'total': (perf_counter() - self.started) * 1000, 'sql': self.sql * 1000,
+                'render': self.render * 1000, 'commit': self.commit * 1000}
+
+
+def current_profile():
+    return g.get('profile') if has_app_context() else None
+
+
+class ProfileAggregates:
+    # one app's per-endpoint histograms and slowest queries
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.slowest = []
+
+    def record(self, endpoint, profile, keep):
+        timings = profile.timings()
+        with self.lock:
+            histograms = self.endpoints.get(endpoint)
+            if histograms is None:
+                histograms = self.endpoints[endpoint] = {
+                    'total_ms': Histogram(MS_BUCKETS), 'sql_ms': Histogram(MS_BUCKETS),
+                    'render_ms': Histogram(MS_BUCKETS), 'commit_ms': Histogram(MS_BUCKETS),
+                    'queries': Histogram(QUERY_BUCKETS)}
+            for name in ('total', 'sql', 'render', 'commit'):
+                histograms[f'{name}_ms'].add(timings[name])
+            histograms['queries'].add(profile.queries)
+            for elapsed, statement in profile.slowest:
+                entry = (elapsed, statement, endpoint)
+                if len(self.slowest) < keep:
+                    heapq.heappush(self.slowest, entry)
+                else:
+                    heapq.heappushpop(self.slowest, entry)
+
+    def report(self):
+        with self.lock:
+            return {
+                'endpoints': {endpoint: dict(requests=sum(histograms['total_ms'].counts),
+                                             **{name: histogram.report() for name, histogram in histograms.items()})
+                              for endpoint, histograms in self.endpoints.items()},
+                'slowest_queries': [{'ms': round(elapsed * 1000, 2), 'endpoint': endpoint, 'statement': statement}
+                                    for elapsed, statement, endpoint in sorted(self.slowest, reverse=True)],
+            }
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+            self.slowest = []
+
+
+class RequestProfiler:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILE_SAMPLE_RATE', 0.01)
+        app.config.setdefault('PROFILE_SLOW_QUERIES', 5)
+        app.config.setdefault('PROFILE_ENDPOINT', app.debug)
+        app.extensions['profiler'] = ProfileAggregates()
+        request_started.connect(self.start, app)
+        request_finished.connect(self.finish, app)
+        before_render_template.connect(self.render_started, app)
+        template_rendered.connect(self.render_finished, app)
+        # these hooks are global, so a second app must not add them again
+        if not sqla.event.contains(sqla.engine.Engine, 'before_cursor_execute', self.query_started):
+            sqla.event.listen(sqla.engine.Engine, 'before_cursor_execute', self.query_started)
+            sqla.event.listen(sqla.engine.Engine, 'after_cursor_execute', self.query_finished)
+            sqla.event.listen(orm.Session, 'before_commit', self.commit_started)
+            sqla.event.listen(orm.Session, 'after_commit', self.commit_finished)
+        app.add_url_rule('/debug/perf', 'debug_perf', self.report_view)
+
+    def start(self, sender, **extra):
+        if random.random() < sender.config['PROFILE_SAMPLE_RATE']:
+            g.profile = Profile()
+
+    def query_started(self, conn, cursor, statement, parameters, context, executemany):
+        profile = current_profile()
+        if profile is not None:
+            profile.marks[id(cursor)] = perf_counter()
+
+    def query_finished(self, conn, cursor, statement, parameters, context, executemany):
+        profile = current_profile()
+        if profile is None or id(cursor) not in profile.marks:
+            return
+        elapsed = perf_counter() - profile.marks.pop(id(cursor))
+        profile.queries += 1
+        profile.sql += elapsed
+        entry = (elapsed, statement)
+        if len(profile.slowest) < current_app.config['PROFILE_SLOW_QUERIES']:
+            heapq.heappush(profile.slowest, entry)
+        else:
+            heapq.heappushpop(profile.slowest, entry)
+
+    def render_started(self, sender, template, context, **extra):
+        profile = current_profile()
+        if profile is not None:
+            profile.marks[id(template)] = perf_counter()
+
+    def render_finished(self, sender, template, context, **extra):
+        profile = current_profile()
+        if profile is not None and id(template) in profile.marks:
+            profile.render += perf_counter() - profile.marks.pop(id(template))
+
+    def commit_started(self, session):
+        profile = current_profile()
+        if profile is not None:
+            profile.marks['commit'] = perf_counter()
+
+    def commit_finished(self, session):
+        profile = current_profile()
+        if profile is not None and 'commit' in profile.marks:
+            profile.commit += perf_counter() - profile.marks.pop('commit')
+
+    def finish(self, sender, response, **extra):
+        profile = current_profile()
+        if profile is None:
+            return
+        timings = profile.timings()
+        response.headers['X-Server-Timing'] = ', '.join(
+            [f'db;dur={timings["sql"]:.2f};desc="{profile.queries} queries"'] +
+            [f'{name};dur={timings[name]:.2f}' for name in ('render', 'commit', 'total')])
+        # a streamed body is rendered after this point, so the aggregates wait for it
+        endpoint = request.endpoint or 'unmatched'
+        aggregates, keep = sender.extensions['profiler'], sender.config['PROFILE_SLOW_QUERIES']
+        response.call_on_close(lambda: aggregates.record(endpoint, profile, keep))
+
+    def report(self):
+        return dict(sample_rate=current_app.config['PROFILE_SAMPLE_RATE'],
+                    **current_app.extensions['profiler'].report())
+
+    def reset(self):
+        current_app.extensions['profiler'].reset()
+
+    def report_view(self):
+        if not current_app.config['PROFILE_ENDPOINT']:
+            abort(404)
+        return jsonify(self.report())
@@ -0,0 +1,135 @@
+import threading
+from collections import OrderedDict
+from time import monotonic, time
+from flask import current_app
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+'''
+token buckets for the credential-checking endpoints. every client IP and every submitted
+login gets a bucket of RATELIMIT_<kind>_CAPACITY tokens that refills at
+RATELIMIT_<kind>_PER_MINUTE tokens a minute; a submission costs one token from each, and is
+turned away with RateLimited before any password is checked or any mail is sent once either
+bucket is empty. buckets live in a bounded in-process LRU by default, or with
+RATELIMIT_STORAGE = 'redis' on a local Redis-compatible server shared by all workers
+'''
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+def refill(tokens, updated, now, capacity, rate):
+    return min(capacity, tokens + (now - updated) * rate)
+
+
+class MemoryBucketStore:
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        # returns 0 when a token was taken, otherwise the seconds until one is available
+        now = monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (capacity, now))
+            tokens = refill(tokens, updated, now, capacity, rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            self.buckets[key] = (tokens - 1 if not wait else tokens, now)
+            self.buckets.move_to_end(key)
+            # evicting a bucket forgives it, so the least recently hit ones go first
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class RedisBucketStore:
+    # same arithmetic as MemoryBucketStore.take, run atomically on the server
+    SCRIPT = '''
+local capacity, rate, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+'''
+
+    def __init__(self, url, prefix):
+        if redis is None:
+            raise RuntimeError("RATELIMIT_STORAGE = 'redis' needs the redis package")
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.script = self.client.register_script(self.SCRIPT)
+        self.prefix = prefix
+
+    def take(self, key, capacity, rate):
+        return float(self.script(keys=[self.prefix + key], args=[capacity, rate, time()]))
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+class RateLimiter:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RATELIMIT_ENABLED', True)
+        app.config.setdefault('RATELIMIT_STORAGE', 'memory')
+        app.config.setdefault('RATELIMIT_MAX_KEYS', 100000)
+        app.config.setdefault('RATELIMIT_REDIS_URL', 'redis://localhost:6379/0')
+        app.config.setdefault('RATELIMIT_KEY_PREFIX', 'microblog:ratelimit:')
+        app.config.setdefault('RATELIMIT_IP_CAPACITY', 30)
+        app.config.setdefault('RATELIMIT_IP_PER_MINUTE', 10)
+        app.config.setdefault('RATELIMIT_LOGIN_CAPACITY', 5)
+        app.config.setdefault('RATELIMIT_LOGIN_PER_MINUTE', 1)
+        for kind in ('IP', 'LOGIN'):
+            # a bucket that never refills would divide by zero working out how long to wait
+            if not app.config[f'RATELIMIT_{kind}_PER_MINUTE'] > 0:
+                raise RuntimeError(f'RATELIMIT_{kind}_PER_MINUTE must be greater than 0')
+            if not app.config[f'RATELIMIT_{kind}_CAPACITY'] >= 1:
+                raise RuntimeError(f'RATELIMIT_{kind}_CAPACITY must be at least 1')
+        if app.config['RATELIMIT_STORAGE'] == 'redis':
+            app.extensions['limiter'] = RedisBucketStore(app.config['RATELIMIT_REDIS_URL'],
+                                                         app.config['RATELIMIT_KEY_PREFIX'])
+        else:
+            app.extensions['limiter'] = MemoryBucketStore(app.config['RATELIMIT_MAX_KEYS'])
+
+    @property
+    def store(self):
+        return current_app.extensions['limiter']
+
+    def take(self, kind, key):
+        config = current_app.config
+        return self.store.take(f'{kind}:{key}', config[f'RATELIMIT_{kind.upper()}_CAPACITY'],
+                               config[f'RATELIMIT_{kind.upper()}_PER_MINUTE'] / 60)
+
+    def check(self, endpoint, ip, login=None):
+        if not current_app.config['RATELIMIT_ENABLED']:
+            return
+        # the login bucket is only charged for submissions the IP bucket let through, so
+        # requests that are already being turned away don't keep an account locked
+        wait = self.take('ip', f'{endpoint}:{ip}')
+        if not wait and login:
+            wait = self.take('login', f'{endpoint}:{login.lower()}')
+        if wait:
+            raise RateLimited(wait)
+
+    def clear(self):
+        self.store.clear()
@@ -0,0 +1,158 @@
+import random
+import threading
+import weakref
+from time import sleep, time
+import sqlalchemy as sqla
+from flask import g, has_request_context, current_app, request, session
+from flask_sqlalchemy.session import Session
+
+'''
+read/write routing. GET requests to views marked @read_only run their queries on one of the
+DATABASE_REPLICA_URLS engines, picked once per request; every other request, and any flush
+or INSERT/UPDATE/DELETE, uses the primary. once a request has written, its remaining reads
+go to the primary too, and the time is kept in the visitor's session so their read-only
+requests stick to the primary for REPLICA_STICKY_SECONDS, long enough for any replica still
+in use to have their write.
+
+replication lag is measured with a heartbeat: every REPLICA_CHECK_INTERVAL seconds a
+background thread stamps the time into the replica_heartbeat row on the primary, then reads
+the row back from each replica. a replica whose copy is more than REPLICA_MAX_LAG_SECONDS
+old, or that can't be reached, gets no reads until it catches up. this assumes the app
+servers' clocks agree to well within REPLICA_MAX_LAG_SECONDS
+'''
+
+# replica_heartbeat is created with the other tables (see app.models); this is just enough
+# of it to query without importing the models
+heartbeat = sqla.table('replica_heartbeat', sqla.column('id'), sqla.column('beat'))
+
+
+def read_only(view):
+    view.read_only = True
+    return view
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context():
+            if self._flushing or getattr(clause, 'is_dml', False):
+                g.db_written = True
+                g.db_replica = None
+            elif g.get('db_replica') is not None:
+                return g.db_replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class ReplicaEngines:
+    # one app's replica engines, created on its first request, and the ones fresh enough to read
+    def __init__(self):
+        self.engines = None
+        self.healthy = []
+        self.monitor = None
+        self.lock = threading.Lock()
+
+
+class ReplicaRouter:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('DATABASE_REPLICA_URLS', [])
+        app.config.setdefault('REPLICA_MAX_LAG_SECONDS', 5)
+        app.config.setdefault('REPLICA_STICKY_SECONDS', app.config['REPLICA_MAX_LAG_SECONDS'])
+        app.config.setdefault('REPLICA_CHECK_INTERVAL', 1)
+        app.extensions['replicas'] = ReplicaEngines()
+        app.before_request(self.route)
+        app.after_request(self.remember_write)
+
+    def state(self):
+        return current_app.extensions['replicas']
+
+    def load_engines(self):
+        state = self.state()
+        options = current_app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+        state.engines = [sqla.create_engine(url, **options) for url in current_app.config['DATABASE_REPLICA_URLS']]
+        return state.engines
+
+    def reset(self):
+        state = self.state()
+        with state.lock:
+            for engine in state.engines or ():
+                engine.dispose()
+            state.engines = None
+            state.healthy = []
+            state.monitor = None
+
+    def check(self):
+        # beats on the primary, then keeps the replicas whose copy of the beat is recent
+        state = self.state()
+        now = time()
+        try:
+            with current_app.extensions['sqlalchemy'].engine.begin() as connection:
+                if not connection.execute(sqla.update(heartbeat).where(heartbeat.c.id == 1).values(beat=now)).rowcount:
+                    connection.execute(sqla.insert(heartbeat).values(id=1, beat=now))
+        except sqla.exc.IntegrityError:
+            pass  # another process inserted the row first, with a beat just as recent
+        healthy = []
+        for engine in state.engines or ():
+            try:
+                with engine.connect() as connection:
+                    beat = connection.scalar(sqla.select(heartbeat.c.beat).where(heartbeat.c.id == 1))
+            except sqla.exc.SQLAlchemyError:
+                continue
+            if beat is not None and now - beat <= current_app.config['REPLICA_MAX_LAG_SECONDS']:
+                healthy.append(engine)
+        state.healthy = healthy
+
+    def run_monitor(self, app_ref):
+        while True:
+            app = app_ref()
+            if app is None:
+                return
+            state, interval = app.extensions['replicas'], app.config['REPLICA_CHECK_INTERVAL']
+            del app
+            sleep(interval)
+            app = app_ref()
+            # reset() retires the thread along with the engines it was checking
+            if app is None or state.monitor is not threading.current_thread():
+                return
+            with app.app_context():
+                try:
+                    self.check()
+                except sqla.exc.SQLAlchemyError:
+                    app.logger.exception('Could not check replication lag')
+                    state.healthy = []
+            del app
+
+    def start_monitor(self, state):
+        # the first check runs here, so the first read-only request already knows which
+        # replicas are usable; later ones run in the background
+        try:
+            self.check()
+        except sqla.exc.SQLAlchemyError:
+            current_app.logger.exception('Could not check replication lag')
+        app_ref = weakref.ref(current_app._get_current_object())
+        state.monitor = threading.Thread(target=self.run_monitor, args=(app_ref,),
+                                         name='replica-lag-monitor', daemon=True)
+        state.monitor.start()
+
+    def route(self):
+        g.db_replica = None
+        state = self.state()
+        with state.lock:
+            if state.engines is None:
+                self.load_engines()
+            if state.engines and state.monitor is None:
+                self.start_monitor(state)
+        if not state.healthy or request.method not in ('GET', 'HEAD'):
+            return
+        if not getattr(current_app.view_functions.get(request.endpoint), 'read_only', False):
+            return
+        if time() - session.get('db_written_at', 0) < current_app.config['REPLICA_STICKY_SECONDS']:
+            return
+        g.db_replica = random.choice(state.healthy)
+
+    def remember_write(self, response):
+        if g.get('db_written') and self.state().engines:
+            session['db_written_at'] = time()
+        return response
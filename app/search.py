@@ -0,0 +1,275 @@
+import itertools
+import math
+import re
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+import sqlalchemy as sqla
+import sqlalchemy.orm as orm
+from flask import current_app, has_app_context
+from app import db
+from app.models import Post, load_feed
+from app.pagination import CursorPage
+
+'''
+full-text search over posts. on SQLite the index is an FTS5 table kept in sync with post by
+triggers, and ranked with bm25. anywhere else (or on a SQLite build without FTS5) each
+process keeps an inverted index in memory: it is built from the post table on the first
+search and then follows committed inserts, updates and deletes made through the ORM. it is
+meant for a single process: posts other processes insert are picked up by id on each
+search, but their edits and deletes are not seen until a restart, so deployments running
+several workers should use FTS5.
+either way a match scores its relevance divided by (1 + age / SEARCH_RECENCY_DAYS), so a
+post that many days old counts half as much as a fresh one with the same terms. only the
+newest SEARCH_MAX_CANDIDATES matches are scored, which keeps a query for a common word from
+ranking a large part of the table
+'''
+
+WORD = re.compile(r'\w+')
+
+FTS_SCHEMA = [
+    "CREATE VIRTUAL TABLE post_fts USING fts5(body, content='post', content_rowid='post_id')",
+    'CREATE TRIGGER post_fts_insert AFTER INSERT ON post BEGIN '
+    'INSERT INTO post_fts (rowid, body) VALUES (new.post_id, new.body); END',
+    'CREATE TRIGGER post_fts_delete AFTER DELETE ON post BEGIN '
+    "INSERT INTO post_fts (post_fts, rowid, body) VALUES ('delete', old.post_id, old.body); END",
+    'CREATE TRIGGER post_fts_update AFTER UPDATE OF body ON post BEGIN '
+    "INSERT INTO post_fts (post_fts, rowid, body) VALUES ('delete', old.post_id, old.body); "
+    'INSERT INTO post_fts (rowid, body) VALUES (new.post_id, new.body); END',
+]
+
+
+def terms(text):
+    return [word.lower() for word in WORD.findall(text or '')]
+
+
+def has_fts5(connection):
+    if connection.dialect.name != 'sqlite':
+        return False
+    options = connection.exec_driver_sql('PRAGMA compile_options').scalars().all()
+    return 'ENABLE_FTS5' in options
+
+
+def create_fts(target, connection, **kw):
+    if has_fts5(connection):
+        for statement in FTS_SCHEMA:
+            connection.exec_driver_sql(statement)
+
+
+def drop_fts(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.exec_driver_sql('DROP TABLE IF EXISTS post_fts')
+
+
+# create_all / drop_all (tests, fresh databases); existing ones get it from the migration
+sqla.event.listen(Post.__table__, 'after_create', create_fts)
+sqla.event.listen(Post.__table__, 'before_drop', drop_fts)
+
+
+class InvertedIndex:
+    def __init__(self):
+        self.postings = {}
+        self.lengths = {}
+        self.timestamps = {}
+        self.words = {}
+        # kept up to date by add and remove, so a search doesn't sum every length
+        self.total_length = 0
+        self.newest = 0
+        self.built = False
+        self.lock = threading.Lock()
+
+    def build(self, connection):
+        posts = Post.__table__
+        with self.lock:
+            self.postings, self.lengths, self.timestamps, self.words = {}, {}, {}, {}
+            self.total_length = self.newest = 0
+            rows = connection.execute(sqla.select(posts.c.post_id, posts.c.body, posts.c.timestamp))
+            for post_id, body, timestamp in rows:
+                self.add(post_id, body, timestamp)
+            self.built = True
+
+    def catch_up(self, connection):
+        # posts committed since the newest one seen, including other processes' inserts
+        posts = Post.__table__
+        rows = connection.execute(
+            sqla.select(posts.c.post_id, posts.c.body, posts.c.timestamp)
+            .where(posts.c.post_id > self.newest)
+            .order_by(posts.c.post_id)
+        ).all()
+        with self.lock:
+            for post_id, body, timestamp in rows:
+                if post_id not in self.lengths:
+                    self.add(post_id, body, timestamp)
+
+    def add(self, post_id, body, timestamp):
+        words = Counter(terms(body))
+        for word, count in words.items():
+            self.postings.setdefault(word, {})[post_id] = count
+        self.lengths[post_id] = sum(words.values())
+        self.total_length += self.lengths[post_id]
+        self.timestamps[post_id] = timestamp
+        self.words[post_id] = tuple(words)
+        self.newest = max(self.newest, post_id)
+
+    def remove(self, post_id):
+        self.total_length -= self.lengths.pop(post_id)
+        del self.timestamps[post_id]
+        for word in self.words.pop(post_id):
+            postings = self.postings[word]
+            del postings[post_id]
+            if not postings:
+                del self.postings[word]
+
+    def apply(self, changes):
+        with self.lock:
+            if not self.built:
+                return
+            for post_id, body, timestamp in changes:
+                if post_id in self.lengths:
+                    self.remove(post_id)
+                if body is not None:
+                    self.add(post_id, body, timestamp)
+
+    def search(self, words, now, recency_days, candidates=0):
+        # bm25 over the posts that contain every word
+        with self.lock:
+            postings = sorted((self.postings.get(word, {}) for word in set(words)), key=len)
+            if not postings:
+                return []
+            # postings are filled in post order (the build scans by post_id, new posts are
+            # appended), so walking the rarest word's backwards meets the newest matches first
+            matches = (post_id for post_id in reversed(postings[0])
+                       if all(post_id in posting for posting in postings[1:]))
+            matches = list(itertools.islice(matches, candidates or None))
+            total = len(self.lengths)
+            average = self.total_length / total if total else 1
+            scores = []
+            for post_id in matches:
+                relevance = 0
+                for posting in postings:
+                    idf = math.log(1 + (total - len(posting) + 0.5) / (len(posting) + 0.5))
+                    frequency = posting[post_id]
+                    relevance += idf * frequency * 2.2 / (
+                        frequency + 1.2 * (0.25 + 0.75 * self.lengths[post_id] / average))
+                scores.append((relevance / (1 + age_days(self.timestamps[post_id], now) / recency_days), post_id))
+        scores.sort(reverse=True)
+        return scores
+
+
+def age_days(timestamp, now):
+    if timestamp is None:
+        return 0
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return max(0, (now - timestamp).total_seconds() / 86400)
+
+
+class SearchState:
+    # per app, since each app may point at another database
+    def __init__(self):
+        self.fts = None
+        self.index = InvertedIndex()
+
+
+class SearchIndex:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SEARCH_RECENCY_DAYS', 30)
+        app.config.setdefault('SEARCH_MAX_CANDIDATES', 10000)
+        app.config.setdefault('SEARCH_RESULTS_PER_PAGE', app.config.get('POSTS_PER_PAGE') or 10)
+        app.extensions['search'] = SearchState()
+
+    def state(self):
+        return current_app.extensions['search']
+
+    def use_fts(self):
+        state = self.state()
+        if state.fts is None:
+            with db.engine.connect() as connection:
+                state.fts = has_fts5(connection) and sqla.inspect(connection).has_table('post_fts')
+        return state.fts
+
+    def search(self, text, cursor=None):
+        # cursor is the page number; relevance ranking has no stable key to seek on
+        page = int(cursor) if str(cursor or '').isdigit() and int(cursor) > 0 else 1
+        per_page = current_app.config['SEARCH_RESULTS_PER_PAGE']
+        words = terms(text)
+        if not words:
+            return CursorPage([])
+        if self.use_fts():
+            posts = self.fts_search(words, (page - 1) * per_page, per_page + 1)
+        else:
+            posts = self.memory_search(words, (page - 1) * per_page, per_page + 1)
+        return CursorPage(posts[:per_page],
+                          next_cursor=str(page + 1) if len(posts) > per_page else None,
+                          prev_cursor=str(page - 1) if page > 1 else None)
+
+    def fts_search(self, words, offset, limit):
+        fts = sqla.literal_column('post_fts')
+        match = ' '.join(f'"{word}"' for word in words)
+        # bm25 is only available inside the FTS query, so the candidates carry it out
+        candidates = (
+            sqla.select(sqla.literal_column('rowid').label('post_id'), (-sqla.func.bm25(fts)).label('relevance'))
+            .select_from(sqla.table('post_fts'))
+            .where(fts.op('MATCH')(match))
+            .order_by(sqla.literal_column('rowid').desc())
+        )
+        if current_app.config['SEARCH_MAX_CANDIDATES']:
+            candidates = candidates.limit(current_app.config['SEARCH_MAX_CANDIDATES'])
+        candidates = candidates.subquery()
+        age = sqla.func.julianday('now') - sqla.func.julianday(Post.timestamp)
+        score = candidates.c.relevance / \
+            (1 + sqla.func.coalesce(age, 0) / current_app.config['SEARCH_RECENCY_DAYS'])
+        query = (
+            sqla.select(Post)
+            .join(candidates, candidates.c.post_id == Post.post_id)
+            .order_by(score.desc(), Post.post_id.desc())
+            .offset(offset)
+            .limit(limit)
+        )
+        return db.session.scalars(load_feed(query)).all()
+
+    def memory_search(self, words, offset, limit):
+        index = self.state().index
+        with db.engine.connect() as connection:
+            if index.built:
+                index.catch_up(connection)
+            else:
+                index.build(connection)
+        scores = index.search(words, datetime.now(timezone.utc), current_app.config['SEARCH_RECENCY_DAYS'],
+                                   current_app.config['SEARCH_MAX_CANDIDATES'])
+        ids = [post_id for score, post_id in scores[offset:offset + limit]]
+        posts = {post.post_id: post for post in
+                 db.session.scalars(load_feed(sqla.select(Post).where(Post.post_id.in_(ids))))}
+        return [posts[id] for id in ids if id in posts]
+
+
+search_index = SearchIndex()
+
+
+@sqla.event.listens_for(Post, 'after_insert')
+@sqla.event.listens_for(Post, 'after_update')
+def remember_post_change(mapper, connection, post):
+    orm.object_session(post).info.setdefault('search_changes', []).append(
+        (post.post_id, post.body, post.timestamp))
+
+
+@sqla.event.listens_for(Post, 'after_delete')
+def remember_post_delete(mapper, connection, post):
+    orm.object_session(post).info.setdefault('search_changes', []).append(
+        (post.post_id, None, post.timestamp))
+
+
+@sqla.event.listens_for(orm.Session, 'after_commit')
+def apply_post_changes(session):
+    changes = session.info.pop('search_changes', None)
+    if changes and has_app_context() and 'search' in current_app.extensions:
+        search_index.state().index.apply(changes)
+
+
+@sqla.event.listens_for(orm.Session, 'after_rollback')
+def discard_post_changes(session):
+    session.info.pop('search_changes', None)
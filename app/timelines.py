@@ -0,0 +1,101 @@
+import threading
+import weakref
+import sqlalchemy as sqla
+from flask import current_app
+from app import db
+
+'''
+timeline upkeep kept off the request path. a fan-out leaves its readers' timelines a row
+longer than TIMELINE_LENGTH, and a celebrity that drops below TIMELINE_DEMOTE_THRESHOLD
+followers needs its recent posts copied into every follower's timeline. requests only note
+the author; a background thread per app trims the readers of the noted authors every
+TIMELINE_MAINTENANCE_INTERVAL seconds and runs demotions as soon as they are noted, in
+transactions of TIMELINE_BATCH_SIZE readers. the notes live in the process, so
+`flask maintain-timelines` sweeps the whole database for whatever a restart lost. with
+TIMELINE_MAINTENANCE_INTERVAL = 0 no thread is started and only the command does the work
+'''
+
+
+class PendingTimelines:
+    # one app's authors waiting on upkeep
+    def __init__(self):
+        self.fanned_out = set()
+        self.demoted = set()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.worker = None
+
+
+class TimelineMaintenance:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TIMELINE_MAINTENANCE_INTERVAL', 60)
+        app.config.setdefault('TIMELINE_BATCH_SIZE', 500)
+        app.extensions['timelines'] = PendingTimelines()
+
+    def state(self):
+        return current_app.extensions['timelines']
+
+    def trim_later(self, author_id):
+        state = self.state()
+        with state.lock:
+            state.fanned_out.add(author_id)
+            self.start_worker(state)
+
+    def demote_later(self, user_id):
+        state = self.state()
+        with state.lock:
+            state.demoted.add(user_id)
+            if self.start_worker(state):
+                state.wake.set()
+
+    def start_worker(self, state):
+        if state.worker is None and current_app.config['TIMELINE_MAINTENANCE_INTERVAL']:
+            app_ref = weakref.ref(current_app._get_current_object())
+            state.worker = threading.Thread(target=self.run_worker, args=(app_ref,),
+                                            name='timeline-maintenance', daemon=True)
+            state.worker.start()
+        return state.worker is not None
+
+    def run(self):
+        # one round over what is pending; authors whose work failed are noted again.
+        # imported here because app.models queues its work through this extension
+        from app.models import demote_celebrity, trim_readers_of
+        state = self.state()
+        with state.lock:
+            demoted, state.demoted = state.demoted, set()
+            fanned_out, state.fanned_out = state.fanned_out, set()
+        try:
+            for user_id in sorted(demoted):
+                demote_celebrity(user_id)
+                demoted.discard(user_id)
+            trim_readers_of(fanned_out)
+        except sqla.exc.SQLAlchemyError:
+            with state.lock:
+                state.demoted |= demoted
+                state.fanned_out |= fanned_out
+            raise
+
+    def run_worker(self, app_ref):
+        while True:
+            app = app_ref()
+            if app is None:
+                return
+            state, interval = app.extensions['timelines'], app.config['TIMELINE_MAINTENANCE_INTERVAL']
+            del app
+            state.wake.wait(interval)
+            state.wake.clear()
+            app = app_ref()
+            if app is None:
+                return
+            with app.app_context():
+                try:
+                    self.run()
+                except sqla.exc.SQLAlchemyError:
+                    app.logger.exception('Could not maintain timelines')
+                finally:
+                    db.session.remove()
+            del app
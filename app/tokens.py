@@ -0,0 +1,75 @@
+import hmac
+import threading
+from collections import OrderedDict
+from hashlib import sha256
+from time import time
+import jwt
+from flask import current_app
+
+'''
+password reset tokens. a token is a signed JWT, so checking one needs no database: decoded
+claims are kept in a small LRU keyed by the token's hash, and the user is only loaded once
+the new password is submitted. a token is good for one reset: it carries a digest of the
+password hash it was issued against, and stops matching once any process stores a new one
+'''
+
+
+def token_key(token):
+    return sha256(token.encode('utf-8')).digest()[:16]
+
+
+def password_nonce(password_hash):
+    return sha256((password_hash or '').encode('utf-8')).hexdigest()[:16]
+
+
+class TokenCache:
+    # one app's decoded claims; apps with different secrets must not share them
+    def __init__(self):
+        self.claims = OrderedDict()
+        self.lock = threading.Lock()
+
+
+class ResetTokenService:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RESET_TOKEN_EXPIRES', 600)
+        app.config.setdefault('RESET_TOKEN_CACHE_SIZE', 1024)
+        app.extensions['reset_tokens'] = TokenCache()
+
+    def cache(self):
+        return current_app.extensions['reset_tokens']
+
+    def issue(self, user, expires_in=None):
+        expires_in = expires_in or current_app.config['RESET_TOKEN_EXPIRES']
+        return jwt.encode({'user_id': user.id, 'nonce': password_nonce(user.password_hash),
+                           'exp': time() + expires_in},
+                          current_app.config['SECRET_KEY'], algorithm='HS256')
+
+    def verify(self, token):
+        # claims of a validly signed, unexpired token, or None; whether it was already used
+        # is only known once the user is loaded, see matches()
+        cache = self.cache()
+        key = token_key(token)
+        now = time()
+        with cache.lock:
+            claims = cache.claims.get(key)
+            if claims is not None:
+                cache.claims.move_to_end(key)
+                return claims if claims['exp'] > now else None
+        try:
+            claims = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'],
+                                options={'require': ['exp', 'user_id', 'nonce']})
+        except jwt.InvalidTokenError:
+            return None
+        with cache.lock:
+            cache.claims[key] = claims
+            while len(cache.claims) > current_app.config['RESET_TOKEN_CACHE_SIZE']:
+                cache.claims.popitem(last=False)
+        return claims
+
+    def matches(self, claims, password_hash):
+        # False once the password was reset with this token, or changed any other way
+        return hmac.compare_digest(claims['nonce'], password_nonce(password_hash))
@@ -0,0 +1,117 @@
+import atexit
+import threading
+import weakref
+import sqlalchemy as sqla
+from datetime import datetime, timedelta, timezone
+from flask import current_app
+from app import db
+from app.models import User
+
+'''
+write-behind for User.last_seen: requests only record the timestamp in memory, and a
+background thread per app writes the pending ones in one bulk UPDATE every
+LAST_SEEN_FLUSH_INTERVAL seconds, or as soon as LAST_SEEN_FLUSH_SIZE have piled up, so no
+request waits on the write. a user is recorded at most once per LAST_SEEN_GRANULARITY seconds
+'''
+
+
+class PendingSeen:
+    # one app's timestamps waiting to be written
+    def __init__(self):
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.flusher = None
+
+
+class LastSeenTracker:
+    def __init__(self, app=None):
+        self.apps = weakref.WeakSet()
+        # registered once, however many apps are built
+        atexit.register(self.flush_on_exit)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('LAST_SEEN_GRANULARITY', 60)
+        app.config.setdefault('LAST_SEEN_FLUSH_INTERVAL', 30)
+        app.config.setdefault('LAST_SEEN_FLUSH_SIZE', 100)
+        app.extensions['tracker'] = PendingSeen()
+        self.apps.add(app)
+
+    def state(self):
+        return current_app.extensions['tracker']
+
+    def seen(self, user, now=None):
+        now = now or datetime.now(timezone.utc)
+        config = current_app.config
+        state = self.state()
+        with state.lock:
+            previous = state.pending.get(user.id, user.last_seen)
+            if previous is not None:
+                if previous.tzinfo is None:
+                    previous = previous.replace(tzinfo=timezone.utc)
+                if now - previous < timedelta(seconds=config['LAST_SEEN_GRANULARITY']):
+                    return
+            state.pending[user.id] = now
+            if state.flusher is None:
+                # started on first use, and holds the app weakly so a discarded app can go
+                app_ref = weakref.ref(current_app._get_current_object())
+                state.flusher = threading.Thread(target=self.run_flusher, args=(app_ref,),
+                                                 name='last-seen-flusher', daemon=True)
+                state.flusher.start()
+            if len(state.pending) >= config['LAST_SEEN_FLUSH_SIZE']:
+                state.wake.set()
+
+    def last_seen(self, user):
+        return self.state().pending.get(user.id, user.last_seen)
+
+    def flush(self):
+        state = self.state()
+        with state.lock:
+            batch, state.pending = state.pending, {}
+        if not batch:
+            return
+        users = User.__table__
+        query = (
+            sqla.update(users)
+            .where(users.c.id == sqla.bindparam('user_id'))
+            .values(last_seen=sqla.bindparam('seen_at'))
+        )
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(query, [{'user_id': id, 'seen_at': seen_at} for id, seen_at in batch.items()])
+        except sqla.exc.SQLAlchemyError:
+            # put the batch back for the next flush, unless a request has seen the user
+            # again in the meantime
+            with state.lock:
+                for id, seen_at in batch.items():
+                    state.pending[id] = max(seen_at, state.pending.get(id, seen_at))
+            raise
+
+    def run_flusher(self, app_ref):
+        while True:
+            app = app_ref()
+            if app is None:
+                return
+            state, interval = app.extensions['tracker'], app.config['LAST_SEEN_FLUSH_INTERVAL']
+            del app
+            state.wake.wait(interval)
+            state.wake.clear()
+            app = app_ref()
+            if app is None:
+                return
+            with app.app_context():
+                try:
+                    self.flush()
+                except sqla.exc.SQLAlchemyError:
+                    app.logger.exception('Could not flush last_seen updates')
+            del app
+
+    def flush_on_exit(self):
+        for app in list(self.apps):
+            with app.app_context():
+                try:
+                    self.flush()
+                except sqla.exc.SQLAlchemyError:
+                    app.logger.exception('Could not flush last_seen updates on exit')
@@ -0,0 +1,94 @@
+'''
+the JSON API against the HTML pages it replaces for mobile clients: a logged-in client
+fetches the first page of the explore feed, the home feed and a profile, --posts posts per
+page on both paths, and the median time per request and the response size are printed for
+each, with the API encoding through orjson and through the json module:
+
+    python benchmarks/api.py --posts 25 --requests 300
+'''
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+from contextlib import nullcontext
+from time import perf_counter
+from unittest import mock
+
+database = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE_URL'] = 'sqlite:///' + database
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqlalchemy as sqla
+from datetime import datetime, timedelta
+from app import create_app, db
+from app.models import User, Post, follower, rebuild_timelines
+
+web_app = create_app()
+USERS = 200
+
+PAGES = {
+    'explore': ('/explore', '/api/v1/explore'),
+    'feed': ('/index', '/api/v1/feed'),
+    'profile': ('/user/user2', '/api/v1/users/user2/posts'),
+}
+
+
+def seed(posts):
+    db.create_all()
+    db.session.execute(sqla.insert(User), [
+        {'id': i, 'login': f'user{i}', 'email': f'user{i}@example.com', 'password_hash': '-'}
+        for i in range(1, USERS + 1)
+    ])
+    db.session.execute(sqla.insert(follower), [
+        {'follower_id': 1, 'followed_id': i} for i in range(2, USERS + 1, 4)
+    ])
+    start = datetime(2025, 1, 1)
+    db.session.execute(sqla.insert(Post), [
+        {'body': f'post number {i} ' + 'x' * 80, 'user_id': i % USERS + 1, 'timestamp': start + timedelta(seconds=i)}
+        for i in range(posts)
+    ])
+    db.session.commit()
+    rebuild_timelines()
+    db.session.commit()
+
+
+def measure(client, path, requests):
+    times = []
+    for _ in range(requests):
+        started = perf_counter()
+        response = client.get(path)
+        size = len(response.data)
+        times.append((perf_counter() - started) * 1000)
+        assert response.status_code == 200, (path, response.status_code)
+    return statistics.median(times), size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', type=int, default=25, help='posts per page')
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=20000, help='posts in the database')
+    args = parser.parse_args()
+
+    web_app.config.update(POSTS_PER_PAGE=args.posts, API_POSTS_PER_PAGE=args.posts)
+    with web_app.app_context():
+        seed(args.seed)
+    client = web_app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = '1'
+
+    print(f'{"page":<8} {"path":<7} {"ms":>7} {"bytes":>7}')
+    for name, (html, api) in PAGES.items():
+        for label, path, encoder in (('html', html, nullcontext()), ('orjson', api, nullcontext()),
+                                     ('json', api, mock.patch('app.api.routes.orjson', None))):
+            with encoder:
+                ms, size = measure(client, path, args.requests)
+            print(f'{name:<8} {label:<7} {ms:7.2f} {size:7}')
+    with web_app.app_context():
+        db.engine.dispose()
+    os.remove(database)
+
+
+if __name__ == '__main__':
+    main()
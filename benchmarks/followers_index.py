@@ -0,0 +1,101 @@
+'''
+is_following / following_posts latency with and without the followers primary key
+and reverse index, at growing edge counts:
+
+    python benchmarks/followers_index.py --edges 10000 100000 1000000
+'''
+import argparse
+import os
+import random
+import sys
+import tempfile
+from time import perf_counter
+
+database = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE_URL'] = 'sqlite:///' + database
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqlalchemy as sqla
+from datetime import datetime, timedelta
+from app import create_app, db
+from app.models import User, Post, follower
+
+web_app = create_app()
+
+# the followers table as it was created by migration 26a30d6a1b23
+UNINDEXED_FOLLOWERS = '''
+CREATE TABLE followers (
+    follower_id INTEGER REFERENCES user (id),
+    followed_id INTEGER REFERENCES user (id)
+)
+'''
+
+
+def seed(edges, indexed):
+    db.drop_all()
+    db.create_all()
+    if not indexed:
+        db.session.execute(sqla.text('DROP TABLE followers'))
+        db.session.execute(sqla.text(UNINDEXED_FOLLOWERS))
+
+    users = max(1000, edges // 50)
+    db.session.execute(sqla.insert(User), [
+        {'id': i, 'login': f'user{i}', 'email': f'user{i}@example.com', 'password_hash': '-'}
+        for i in range(1, users + 1)
+    ])
+    start = datetime(2025, 1, 1)
+    db.session.execute(sqla.insert(Post), [
+        {'body': f'post {i}', 'user_id': i % users + 1, 'timestamp': start + timedelta(seconds=i)}
+        for i in range(users * 5)
+    ])
+    rng = random.Random(edges)
+    pairs = set()
+    while len(pairs) < edges:
+        a, b = rng.randint(1, users), rng.randint(1, users)
+        if a != b:
+            pairs.add((a, b))
+    db.session.execute(sqla.insert(follower), [{'follower_id': a, 'followed_id': b} for a, b in pairs])
+    db.session.commit()
+    return users, sorted(pairs)
+
+
+def timed(function, arguments):
+    start = perf_counter()
+    for argument in arguments:
+        function(*argument)
+    return (perf_counter() - start) / len(arguments) * 1000
+
+
+def run(edges, indexed, lookups):
+    users, pairs = seed(edges, indexed)
+    rng = random.Random(0)
+    people = {id: db.session.get(User, id) for id in range(1, users + 1)}
+    hits = [(people[a], people[b]) for a, b in rng.sample(pairs, lookups // 2)]
+    misses = [(people[rng.randint(1, users)], people[rng.randint(1, users)]) for _ in range(lookups // 2)]
+    readers = [(people[rng.randint(1, users)],) for _ in range(max(10, lookups // 20))]
+    return {
+        'is_following_ms': timed(lambda a, b: a.is_following(b), hits + misses),
+        'following_posts_ms': timed(
+            lambda u: db.session.scalars(u.following_posts().limit(web_app.config['POSTS_PER_PAGE'])).all(),
+            readers),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--edges', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--lookups', type=int, default=200)
+    args = parser.parse_args()
+
+    print(f'{"edges":>9} {"schema":>10} {"is_following ms":>16} {"following_posts ms":>19}')
+    with web_app.app_context():
+        for edges in args.edges:
+            for indexed in (False, True):
+                result = run(edges, indexed, args.lookups)
+                print(f'{edges:>9} {"pk+index" if indexed else "none":>10} '
+                      f'{result["is_following_ms"]:>16.3f} {result["following_posts_ms"]:>19.3f}')
+    os.remove(database)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+'''
+load test for the main routes: seeds a synthetic network with bulk inserts (power-law
+follower counts and posting rates), then replays a weighted mix of requests from
+concurrent clients and prints p50/p95/p99 latency and queries per request for every
+route as JSON, so two runs can be diffed:
+
+    python benchmarks/load.py --users 100000 --posts 10000000 --requests 20000 --concurrency 8 > after.json
+
+requests go through the Flask test client by default, or with --server over HTTP to a
+threaded local WSGI server. set BENCH_DATABASE to a file path to keep the seeded database
+between runs; an existing one is reused as it is
+'''
+import argparse
+import http.client
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+from collections import defaultdict
+from time import perf_counter
+from urllib.parse import urlencode
+
+database = os.environ.get('BENCH_DATABASE') or os.path.join(tempfile.mkdtemp(), 'bench.db')
+fresh = not os.path.exists(database)
+os.environ['DATABASE_URL'] = 'sqlite:///' + database
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqlalchemy as sqla
+from datetime import datetime, timedelta
+from werkzeug.serving import make_server
+from app import create_app, db, hasher
+from app.models import User, Post, follower, rebuild_timelines, reconcile_counters
+
+web_app = create_app()
+
+MIX = {'index': 40, 'explore': 20, 'user': 25, 'post': 5, 'follow': 5, 'unfollow': 5}
+CHUNK = 50000
+
+
+def power_law(count, rng, exponent=1.0):
+    # cumulative weights for rng.choices over shuffled ids, so popularity isn't tied to id order
+    ids = list(range(1, count + 1))
+    rng.shuffle(ids)
+    return ids, list(itertools.accumulate(1 / rank ** exponent for rank in range(1, count + 1)))
+
+
+def seed(users, posts, follows, rng):
+    db.drop_all()
+    db.create_all()
+    password_hash = hasher.hash('password')
+    with db.engine.begin() as connection:
+        for start in range(1, users + 1, CHUNK):
+            connection.execute(sqla.insert(User), [
+                {'id': i, 'login': f'user{i}', 'email': f'user{i}@example.com', 'password_hash': password_hash}
+                for i in range(start, min(users, start + CHUNK - 1) + 1)
+            ])
+
+        celebrities, popularity = power_law(users, rng)
+        edges = []
+        for user_id in range(1, users + 1):
+            # out-degrees are heavy-tailed too: most users follow a few, some follow hundreds
+            degree = min(users - 1, int(follows * rng.paretovariate(2) / math.sqrt(2)))
+            targets = set(rng.choices(celebrities, cum_weights=popularity, k=degree))
+            targets.discard(user_id)
+            edges.extend({'follower_id': user_id, 'followed_id': target} for target in targets)
+            if len(edges) >= CHUNK:
+                connection.execute(sqla.insert(follower), edges)
+                edges = []
+        if edges:
+            connection.execute(sqla.insert(follower), edges)
+
+        authors, activity = power_law(users, rng)
+        start = datetime(2025, 1, 1)
+        step = timedelta(days=365) / max(posts, 1)
+        for first in range(0, posts, CHUNK):
+            batch = range(first, min(posts, first + CHUNK))
+            author_ids = rng.choices(authors, cum_weights=activity, k=len(batch))
+            connection.execute(sqla.insert(Post), [
+                {'body': f'post {i} from user {author}', 'user_id': author, 'timestamp': start + step * i}
+                for i, author in zip(batch, author_ids)
+            ])
+    reconcile_counters()
+    rebuild_timelines()
+
+
+class QueryCounter:
+    # WSGI middleware: counts the statements a request runs, including ones issued while a
+    # streamed response is being generated, and files them under the route the client named
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+        self.counts = defaultdict(list)
+        self.lock = threading.Lock()
+        sqla.event.listen(db.engine, 'before_cursor_execute', self.count)
+
+    def count(self, *args):
+        self.local.queries = getattr(self.local, 'queries', 0) + 1
+
+    def __call__(self, environ, start_response):
+        self.local.queries = 0
+        body = self.app(environ, start_response)
+        try:
+            yield from body
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            with self.lock:
+                self.counts[environ.get('HTTP_X_BENCH_ROUTE', 'other')].append(self.local.queries)
+
+
+def session_cookie(user_id):
+    serializer = web_app.session_interface.get_signing_serializer(web_app)
+    return web_app.config['SESSION_COOKIE_NAME'], serializer.dumps({'_user_id': str(user_id), '_fresh': True})
+
+
+def plan(route, users, rng):
+    other = f'user{rng.randint(1, users)}'
+    return {
+        'index': ('GET', '/index', None),
+        'explore': ('GET', '/explore', None),
+        'user': ('GET', f'/user/{other}', None),
+        'post': ('POST', '/index', {'post': f'load test post {rng.random()}'}),
+        'follow': ('POST', f'/follow/{other}', {}),
+        'unfollow': ('POST', f'/unfollow/{other}', {}),
+    }[route]
+
+
+class TestClientDriver:
+    def __init__(self, user_id):
+        self.client = web_app.test_client()
+        name, value = session_cookie(user_id)
+        self.client.set_cookie(name, value)
+
+    def request(self, route, method, path, form):
+        response = self.client.open(path, method=method, data=form, headers={'X-Bench-Route': route})
+        response.get_data()
+        response.close()
+        return response.status_code
+
+
+class HTTPDriver:
+    def __init__(self, user_id, port):
+        self.port = port
+        self.cookie = '='.join(session_cookie(user_id))
+
+    def request(self, route, method, path, form):
+        headers = {'Cookie': self.cookie, 'X-Bench-Route': route}
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        connection = http.client.HTTPConnection('127.0.0.1', self.port)
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        finally:
+            connection.close()
+
+
+def percentile(values, p):
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def run(args, users):
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+    routes = list(MIX)
+    weights = [MIX[route] for route in routes]
+    server = None
+    if args.server:
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        server = make_server('127.0.0.1', 0, web_app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def client(number, count):
+        rng = random.Random(number)
+        user_id = rng.randint(1, users)
+        driver = HTTPDriver(user_id, server.server_port) if server else TestClientDriver(user_id)
+        for _ in range(count):
+            route = rng.choices(routes, weights)[0]
+            started = perf_counter()
+            status = driver.request(route, *plan(route, users, rng))
+            elapsed = (perf_counter() - started) * 1000
+            with lock:
+                latencies[route].append(elapsed)
+                if status >= 400:
+                    errors[route] += 1
+
+    threads = [threading.Thread(target=client, args=(i, args.requests // args.concurrency))
+               for i in range(args.concurrency)]
+    started = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - started
+    if server:
+        server.shutdown()
+    return latencies, errors, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--posts', type=int, default=1000000)
+    parser.add_argument('--follows', type=int, default=20, help='median number of users a user follows')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--server', action='store_true', help='send requests over HTTP to a local server')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    web_app.config['WTF_CSRF_ENABLED'] = False
+    with web_app.app_context():
+        started = perf_counter()
+        if fresh:
+            seed(args.users, args.posts, args.follows, random.Random(0))
+        seeded = perf_counter() - started
+        users = db.session.scalar(sqla.select(sqla.func.count(User.id)))
+        counter = QueryCounter(web_app.wsgi_app)
+        web_app.wsgi_app = counter
+        latencies, errors, elapsed = run(args, users)
+
+    report = {
+        'config': {
+            'users': users,
+            'posts': args.posts if fresh else None,
+            'requests': sum(map(len, latencies.values())),
+            'concurrency': args.concurrency,
+            'driver': 'http' if args.server else 'test_client',
+            'seed_seconds': round(seeded, 1) if fresh else None,
+            'requests_per_second': round(sum(map(len, latencies.values())) / elapsed, 1),
+        },
+        'routes': {},
+    }
+    for route in MIX:
+        timings = sorted(latencies[route])
+        queries = counter.counts[route]
+        if not timings:
+            continue
+        report['routes'][route] = {
+            'requests': len(timings),
+            'errors': errors[route],
+            'p50_ms': round(percentile(timings, 50), 2),
+            'p95_ms': round(percentile(timings, 95), 2),
+            'p99_ms': round(percentile(timings, 99), 2),
+            'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+            'max_queries': max(queries, default=None),
+        }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+    if not os.environ.get('BENCH_DATABASE'):
+        os.remove(database)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+'''
+password reset emails built per second, rendering both templates and the MIME tree for
+every message versus the precompiled reset_password_email:
+
+    python benchmarks/reset_email.py --messages 5000
+'''
+import argparse
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+database = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE_URL'] = 'sqlite:///' + database
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import render_template
+from flask_mail import Message
+from app import create_app
+from app.email import reset_password_email
+from app.models import User
+
+web_app = create_app()
+
+SENDER = 'admin@example.com'
+
+
+def rendered(user, token):
+    msg = Message('[Microblog] Reset your Password', sender=SENDER, recipients=[user.email])
+    msg.body = render_template('email/reset_password_request.txt', user=user, token=token)
+    msg.html = render_template('email/reset_password_request.html', user=user, token=token)
+    msg.date = 0
+    return msg.as_bytes()
+
+
+def precompiled(user, token):
+    msg = reset_password_email.message(SENDER, user.email, login=user.login, token=token)
+    msg.date = 0
+    return msg.as_bytes()
+
+
+def rate(build, users, tokens):
+    start = perf_counter()
+    for user, token in zip(users, tokens):
+        build(user, token)
+    return len(users) / (perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=5000)
+    args = parser.parse_args()
+
+    users = [User(id=i, login=f'user{i}', email=f'user{i}@example.com') for i in range(args.messages)]
+    with web_app.test_request_context():
+        tokens = [user.get_reset_password_token() for user in users]
+        precompiled(users[0], tokens[0])
+        print(f'{"path":>12} {"msgs/sec":>10}')
+        for name, build in (('rendered', rendered), ('precompiled', precompiled)):
+            print(f'{name:>12} {rate(build, users, tokens):>10.0f}')
+
+
+if __name__ == '__main__':
+    main()
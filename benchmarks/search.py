@@ -0,0 +1,94 @@
+'''
+/search query latency over a generated corpus, FTS5 against the in-memory inverted index,
+for a frequent word, a rare word and a two-word query:
+
+    python benchmarks/search.py --posts 1000000
+'''
+import argparse
+import itertools
+import os
+import random
+import sys
+import tempfile
+from time import perf_counter
+
+database = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE_URL'] = 'sqlite:///' + database
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqlalchemy as sqla
+from datetime import datetime, timedelta
+from app import create_app, db
+from app.models import User, Post
+from app.search import search_index
+
+web_app = create_app()
+
+VOCABULARY = 20000
+
+
+def word(rank):
+    return f'w{rank}'
+
+
+def seed(posts):
+    db.drop_all()
+    db.create_all()
+    users = max(100, posts // 100)
+    db.session.execute(sqla.insert(User), [
+        {'id': i, 'login': f'user{i}', 'email': f'user{i}@example.com', 'password_hash': '-'}
+        for i in range(1, users + 1)
+    ])
+    # word frequencies follow a power law, like real text
+    rng = random.Random(posts)
+    weights = list(itertools.accumulate(1 / rank for rank in range(1, VOCABULARY + 1)))
+    start = datetime(2025, 1, 1)
+    started = perf_counter()
+    for offset in range(0, posts, 50000):
+        batch = range(offset, min(posts, offset + 50000))
+        bodies = [' '.join(map(word, rng.choices(range(1, VOCABULARY + 1), cum_weights=weights, k=rng.randint(4, 16))))
+                  for _ in batch]
+        db.session.execute(sqla.insert(Post), [
+            {'body': body, 'user_id': i % users + 1, 'timestamp': start + timedelta(seconds=i * 30)}
+            for i, body in zip(batch, bodies)
+        ])
+    db.session.commit()
+    return perf_counter() - started
+
+
+def timed(queries, repeat):
+    start = perf_counter()
+    for _ in range(repeat):
+        for query in queries:
+            search_index.search(query)
+            db.session.remove()
+    return (perf_counter() - start) / (repeat * len(queries)) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    queries = {'frequent': [word(1)], 'rare': [word(5000), word(9000)], 'two words': [f'{word(3)} {word(40)}']}
+    with web_app.app_context():
+        seconds = seed(args.posts)
+        print(f'seeded {args.posts} posts with the FTS5 triggers in {seconds:.1f}s')
+        started = perf_counter()
+        with db.engine.connect() as connection:
+            search_index.state().index.build(connection)
+        print(f'built the in-memory index in {perf_counter() - started:.1f}s')
+
+        print(f'{"query":>10} {"fts5 ms":>9} {"memory ms":>10}')
+        for name, texts in queries.items():
+            search_index.state().fts = True
+            fts = timed(texts, args.repeat)
+            search_index.state().fts = False
+            memory = timed(texts, args.repeat)
+            print(f'{name:>10} {fts:>9.2f} {memory:>10.2f}')
+    os.remove(database)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+'''
+SQLite throughput under concurrent writers, with the default rollback journal against the
+WAL / synchronous=NORMAL / mmap / busy_timeout settings from app/__init__.py. each run has
+a fixed set of reader threads loading the explore feed while 1 to 16 writer threads publish
+posts and update last_seen, each in its own short transaction:
+
+    python benchmarks/sqlite_concurrency.py --writers 1 2 4 8 16 --seconds 5
+'''
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+from time import perf_counter, sleep
+
+database = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE_URL'] = 'sqlite:///' + database
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqlalchemy as sqla
+from datetime import datetime, timedelta, timezone
+from app import create_app, db
+from app.models import User, Post, load_feed
+
+web_app = create_app()
+
+SETTINGS = {
+    # python's sqlite3 still waits up to 5 seconds on a locked database by default
+    'default': {'SQLITE_JOURNAL_MODE': 'DELETE', 'SQLITE_SYNCHRONOUS': 'FULL', 'SQLITE_MMAP_SIZE': 0,
+                'SQLITE_BUSY_TIMEOUT': 5000},
+    'tuned': {key: web_app.config[key] for key in
+              ('SQLITE_JOURNAL_MODE', 'SQLITE_SYNCHRONOUS', 'SQLITE_MMAP_SIZE', 'SQLITE_BUSY_TIMEOUT')},
+}
+USERS = 1000
+
+
+def seed(posts):
+    db.session.remove()
+    db.engine.dispose()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(database + suffix):
+            os.remove(database + suffix)
+    db.create_all()
+    db.session.execute(sqla.insert(User), [
+        {'id': i, 'login': f'user{i}', 'email': f'user{i}@example.com', 'password_hash': '-'}
+        for i in range(1, USERS + 1)
+    ])
+    start = datetime(2025, 1, 1)
+    db.session.execute(sqla.insert(Post), [
+        {'body': f'post {i}', 'user_id': i % USERS + 1, 'timestamp': start + timedelta(seconds=i)}
+        for i in range(posts)
+    ])
+    db.session.commit()
+    db.session.remove()
+
+
+def run(writers, readers, seconds):
+    counts = {'reads': 0, 'writes': 0, 'errors': 0}
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def work(write, number):
+        rng = random.Random(number)
+        with web_app.app_context():
+            while not stop.is_set():
+                try:
+                    if write:
+                        user = db.session.get(User, rng.randint(1, USERS))
+                        user.publish(f'benchmark post {rng.random()}')
+                        user.last_seen = datetime.now(timezone.utc)
+                        db.session.commit()
+                    else:
+                        db.session.scalars(load_feed(sqla.select(Post).order_by(Post.timestamp.desc()).limit(25))).all()
+                        db.session.commit()
+                    kind = 'writes' if write else 'reads'
+                except sqla.exc.OperationalError:
+                    db.session.rollback()
+                    kind = 'errors'
+                finally:
+                    db.session.remove()
+                with lock:
+                    counts[kind] += 1
+
+    threads = [threading.Thread(target=work, args=(True, i)) for i in range(writers)] + \
+        [threading.Thread(target=work, args=(False, 100 + i)) for i in range(readers)]
+    started = perf_counter()
+    for thread in threads:
+        thread.start()
+    sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - started
+    return {key: value / elapsed for key, value in counts.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--writers', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--posts', type=int, default=100000)
+    args = parser.parse_args()
+
+    print(f'{"settings":>9} {"writers":>8} {"writes/s":>9} {"reads/s":>8} {"errors/s":>9}')
+    with web_app.app_context():
+        for name, settings in SETTINGS.items():
+            web_app.config.update(settings)
+            for writers in args.writers:
+                seed(args.posts)
+                result = run(writers, args.readers, args.seconds)
+                print(f'{name:>9} {writers:>8} {result["writes"]:>9.0f} {result["reads"]:>8.0f} '
+                      f'{result["errors"]:>9.1f}')
+        db.engine.dispose()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(database + suffix):
+            os.remove(database + suffix)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+'''
+cold start cost: each run starts a fresh interpreter that imports the app, calls
+create_app() and serves its first request (the anonymous home page) through the test
+client, and reports how long each step took along with the wall time of the whole process.
+one extra run under python -X importtime lists the imports that cost the most. append the
+results to a JSON lines file to follow them from commit to commit:
+
+    python benchmarks/startup.py --runs 10 --history startup.jsonl
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+database = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE_URL'] = 'sqlite:///' + database
+
+CHILD = f'''
+import json, sys
+from time import perf_counter
+started = perf_counter()
+sys.path.insert(0, {ROOT!r})
+from app import create_app
+imported = perf_counter()
+app = create_app()
+created = perf_counter()
+client = app.test_client()
+client.get('/').close()
+first = perf_counter()
+client.get('/').close()
+second = perf_counter()
+print(json.dumps({{'import_ms': (imported - started) * 1000, 'create_app_ms': (created - imported) * 1000,
+                  'first_response_ms': (first - created) * 1000, 'second_response_ms': (second - first) * 1000}}))
+'''
+
+
+def seed():
+    sys.path.insert(0, ROOT)
+    import sqlalchemy as sqla
+    from app import create_app, db
+    from app.models import User, Post
+    with create_app().app_context():
+        db.create_all()
+        db.session.execute(sqla.insert(User), [
+            {'id': i, 'login': f'user{i}', 'email': f'user{i}@example.com', 'password_hash': '-'}
+            for i in range(1, 51)
+        ])
+        db.session.execute(sqla.insert(Post), [
+            {'body': f'post {i}', 'user_id': i % 50 + 1, 'timestamp': datetime(2025, 1, 1, 0, i)}
+            for i in range(50)
+        ])
+        db.session.commit()
+        db.engine.dispose()
+
+
+def run(*options):
+    started = perf_counter()
+    result = subprocess.run([sys.executable, *options, '-c', CHILD], cwd=ROOT, capture_output=True, text=True)
+    wall = (perf_counter() - started) * 1000
+    if result.returncode:
+        sys.exit(result.stderr)
+    return dict(json.loads(result.stdout.splitlines()[-1]), process_ms=wall), result.stderr
+
+
+def slowest_imports(report, count):
+    # -X importtime lines look like "import time: self [us] | cumulative | imported package",
+    # nested imports indented under the one that pulled them in
+    top = []
+    for line in report.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if len(name) - len(name.lstrip()) <= 3:
+            top.append((int(cumulative) / 1000, name.strip()))
+    return [{'module': name, 'ms': round(ms, 1)} for ms, name in sorted(top, reverse=True)[:count]]
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--imports', type=int, default=15, help='how many of the slowest imports to list')
+    parser.add_argument('--history', help='append the results to this JSON lines file')
+    args = parser.parse_args()
+
+    seed()
+    runs = [run()[0] for _ in range(args.runs)]
+    report = {
+        'commit': commit(),
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'runs': args.runs,
+        'median': {key: round(statistics.median(run[key] for run in runs), 1) for key in runs[0]},
+        'slowest_imports': slowest_imports(run('-X', 'importtime')[1], args.imports),
+    }
+    print(json.dumps(report, indent=2))
+    if args.history:
+        with open(args.history, 'a') as file:
+            file.write(json.dumps(report) + '\n')
+    os.remove(database)
+
+
+if __name__ == '__main__':
+    main()
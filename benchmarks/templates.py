@@ -0,0 +1,98 @@
+'''
+template rendering cost. renders the 50 posts of a page with the fragment cache out of the
+way, once through the old per-post template render of #post.html and once through the
+post_entry macro, then times loading every template into a fresh app with an empty
+bytecode cache against one already filled by `flask compile-templates`:
+
+    python benchmarks/templates.py --repeat 200
+'''
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+from time import perf_counter
+
+database = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE_URL'] = 'sqlite:///' + database
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+from app.models import User, Post
+from config import Config
+
+# #post.html as it was before it became a macro
+OLD_POST = '''<table>
+    <tr valign="top">
+        <td> <img src="{{ post.author.avatar(48) }}"> </td>
+        <td> 
+            <a href="{{ url_for('main.user', login=post.author.login) }}">
+                {{ post.author.login }}
+            </a>
+            says: <br>{{ post.body }}
+        </td>
+    </tr>
+</table>'''
+
+
+def timed(function, repeat):
+    times = []
+    for _ in range(repeat):
+        started = perf_counter()
+        function()
+        times.append((perf_counter() - started) * 1000)
+    return statistics.median(times)
+
+
+def page_posts(count):
+    users = [User(id=i, login=f'user{i}', email=f'user{i}@example.com') for i in range(1, 11)]
+    return [Post(post_id=i, body=f'post number {i} <with markup>', user_id=i % 10 + 1, author=users[i % 10])
+            for i in range(count)]
+
+
+def render_page(app, posts, repeat):
+    with app.test_request_context():
+        old = app.jinja_env.from_string(OLD_POST)
+        new = app.jinja_env.get_template('#post.html').module.post_entry
+        assert ''.join(old.render(post=post) for post in posts) == ''.join(str(new(post)) for post in posts)
+        return {
+            'template render': timed(lambda: ''.join(old.render(post=post) for post in posts), repeat),
+            'macro': timed(lambda: ''.join(str(new(post)) for post in posts), repeat),
+        }
+
+
+def load_templates(directory, repeat, warm):
+    config = type('BenchConfig', (Config,), {'TEMPLATE_BYTECODE_CACHE_DIR': directory})
+    times = []
+    for _ in range(repeat):
+        if not warm:
+            shutil.rmtree(directory, ignore_errors=True)
+        app = create_app(config)
+        started = perf_counter()
+        for name in app.jinja_env.list_templates():
+            app.jinja_env.get_template(name)
+        times.append((perf_counter() - started) * 1000)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--loads', type=int, default=20, help='fresh apps to load the templates into')
+    args = parser.parse_args()
+
+    app = create_app()
+    for name, ms in render_page(app, page_posts(args.posts), args.repeat).items():
+        print(f'{args.posts} posts, {name:<20} {ms:8.3f} ms')
+    directory = tempfile.mkdtemp()
+    print(f'all templates, {"cold compile":<14} {load_templates(directory, args.loads, False):8.3f} ms')
+    print(f'all templates, {"bytecode cache":<14} {load_templates(directory, args.loads, True):8.3f} ms')
+    shutil.rmtree(directory, ignore_errors=True)
+    if os.path.exists(database):
+        os.remove(database)
+
+
+if __name__ == '__main__':
+    main()
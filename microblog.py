@@ -1,8 +1,38 @@
-from app import web_app, db
+from app import create_app, db
+import click
 import sqlalchemy as sqla
 import sqlalchemy.orm as orm
-from app.models import User, Post
+from app.models import User, Post, rebuild_timelines, reconcile_counters, maintain_timelines
+
+web_app = create_app()
 
 @web_app.shell_context_processor
 def make_shell_context():
-    return {'db': db, 'User': User, 'Post': Post, 'sqla': sqla, 'orm': orm}
+    return {'db': db, 'User': User, 'Post': Post, 'sqla': sqla, 'orm': orm,
+            'rebuild_timelines': rebuild_timelines, 'reconcile_counters': reconcile_counters}
+
+@web_app.cli.command('rebuild-timelines')
+def rebuild_timelines_command():
+    """Rebuild the materialized home timeline of every user."""
+    rebuild_timelines()
+
+@web_app.cli.command('maintain-timelines')
+def maintain_timelines_command():
+    """Demote celebrities and trim timelines over the cap across the whole database."""
+    demoted, trimmed = maintain_timelines()
+    click.echo(f'{demoted} celebrities demoted, {trimmed} timelines trimmed')
+
+@web_app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Recount follower, following and post counters that drifted."""
+    click.echo(f'{reconcile_counters()} users repaired')
+
+@web_app.cli.command('compile-templates')
+def compile_templates_command():
+    """Compile every template into the bytecode cache."""
+    if web_app.jinja_env.bytecode_cache is None:
+        raise click.ClickException('TEMPLATE_BYTECODE_CACHE_DIR is not set')
+    names = web_app.jinja_env.list_templates()
+    for name in names:
+        web_app.jinja_env.get_template(name)
+    click.echo(f'{len(names)} templates compiled into {web_app.config["TEMPLATE_BYTECODE_CACHE_DIR"]}')
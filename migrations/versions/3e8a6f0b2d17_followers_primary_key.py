@@ -0,0 +1,58 @@
+"""followers primary key
+
+Revision ID: 3e8a6f0b2d17
+Revises: 9b7e2d4c1a05
+Create Date: 2026-10-18 19:41:05.278391
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3e8a6f0b2d17'
+down_revision = '9b7e2d4c1a05'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # SQLite cannot add a primary key in place, so the edges are copied into a new table,
+    # which also drops duplicate and half-empty rows
+    op.create_table('followers_new',
+    sa.Column('follower_id', sa.Integer(), nullable=False),
+    sa.Column('followed_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('follower_id', 'followed_id')
+    )
+    op.execute(
+        'INSERT INTO followers_new (follower_id, followed_id) '
+        'SELECT DISTINCT follower_id, followed_id FROM followers '
+        'WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL'
+    )
+    op.drop_table('followers')
+    op.rename_table('followers_new', 'followers')
+    with op.batch_alter_table('followers', schema=None) as batch_op:
+        batch_op.create_index('ix_followers_followed_id_follower_id', ['followed_id', 'follower_id'], unique=False)
+
+    # duplicate edges were counted twice
+    op.execute(
+        'UPDATE "user" SET '
+        'followers_total = (SELECT count(*) FROM followers WHERE followers.followed_id = "user".id), '
+        'following_total = (SELECT count(*) FROM followers WHERE followers.follower_id = "user".id)'
+    )
+
+
+def downgrade():
+    op.create_table('followers_old',
+    sa.Column('follower_id', sa.Integer(), nullable=True),
+    sa.Column('followed_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], )
+    )
+    op.execute('INSERT INTO followers_old (follower_id, followed_id) SELECT follower_id, followed_id FROM followers')
+    with op.batch_alter_table('followers', schema=None) as batch_op:
+        batch_op.drop_index('ix_followers_followed_id_follower_id')
+    op.drop_table('followers')
+    op.rename_table('followers_old', 'followers')
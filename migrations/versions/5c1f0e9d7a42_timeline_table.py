@@ -0,0 +1,32 @@
+"""timeline table
+
+Revision ID: 5c1f0e9d7a42
+Revises: 26a30d6a1b23
+Create Date: 2026-10-18 18:20:14.512730
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1f0e9d7a42'
+down_revision = '26a30d6a1b23'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('timeline',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['post_id'], ['post.post_id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'timestamp', 'post_id')
+    )
+    # existing posts are backfilled by `flask rebuild-timelines`
+
+
+def downgrade():
+    op.drop_table('timeline')
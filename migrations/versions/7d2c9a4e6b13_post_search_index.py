@@ -0,0 +1,47 @@
+"""post search index
+
+Revision ID: 7d2c9a4e6b13
+Revises: 3e8a6f0b2d17
+Create Date: 2026-10-18 21:14:05.532190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d2c9a4e6b13'
+down_revision = '3e8a6f0b2d17'
+branch_labels = None
+depends_on = None
+
+
+# only SQLite gets a stored index; other databases are searched through an in-memory one
+def has_fts5():
+    bind = op.get_bind()
+    if bind.dialect.name != 'sqlite':
+        return False
+    return 'ENABLE_FTS5' in bind.exec_driver_sql('PRAGMA compile_options').scalars().all()
+
+
+def upgrade():
+    if not has_fts5():
+        return
+    op.execute("CREATE VIRTUAL TABLE post_fts USING fts5(body, content='post', content_rowid='post_id')")
+    op.execute('CREATE TRIGGER post_fts_insert AFTER INSERT ON post BEGIN '
+               'INSERT INTO post_fts (rowid, body) VALUES (new.post_id, new.body); END')
+    op.execute('CREATE TRIGGER post_fts_delete AFTER DELETE ON post BEGIN '
+               "INSERT INTO post_fts (post_fts, rowid, body) VALUES ('delete', old.post_id, old.body); END")
+    op.execute('CREATE TRIGGER post_fts_update AFTER UPDATE OF body ON post BEGIN '
+               "INSERT INTO post_fts (post_fts, rowid, body) VALUES ('delete', old.post_id, old.body); "
+               'INSERT INTO post_fts (rowid, body) VALUES (new.post_id, new.body); END')
+    op.execute("INSERT INTO post_fts (post_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute('DROP TRIGGER IF EXISTS post_fts_update')
+    op.execute('DROP TRIGGER IF EXISTS post_fts_delete')
+    op.execute('DROP TRIGGER IF EXISTS post_fts_insert')
+    op.execute('DROP TABLE IF EXISTS post_fts')
@@ -0,0 +1,37 @@
+"""user counters
+
+Revision ID: 9b7e2d4c1a05
+Revises: 5c1f0e9d7a42
+Create Date: 2026-10-18 19:02:47.113864
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b7e2d4c1a05'
+down_revision = '5c1f0e9d7a42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('followers_total', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('following_total', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('posts_total', sa.Integer(), server_default='0', nullable=False))
+
+    op.execute(
+        'UPDATE "user" SET '
+        'followers_total = (SELECT count(*) FROM followers WHERE followers.followed_id = "user".id), '
+        'following_total = (SELECT count(*) FROM followers WHERE followers.follower_id = "user".id), '
+        'posts_total = (SELECT count(*) FROM post WHERE post.user_id = "user".id)'
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('posts_total')
+        batch_op.drop_column('following_total')
+        batch_op.drop_column('followers_total')
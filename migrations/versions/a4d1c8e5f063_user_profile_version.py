@@ -0,0 +1,26 @@
+"""user profile version
+
+Revision ID: a4d1c8e5f063
+Revises: f2b8d5a7c391
+Create Date: 2026-10-18 23:58:04.119273
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d1c8e5f063'
+down_revision = 'f2b8d5a7c391'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('profile_version', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('profile_version')
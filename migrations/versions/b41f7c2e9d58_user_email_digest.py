@@ -0,0 +1,38 @@
+"""user email digest
+
+Revision ID: b41f7c2e9d58
+Revises: 7d2c9a4e6b13
+Create Date: 2026-10-18 22:40:12.904417
+
+"""
+from hashlib import md5
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b41f7c2e9d58'
+down_revision = '7d2c9a4e6b13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('email_digest', sa.String(length=32), nullable=True))
+
+    # md5 isn't available in SQL on every backend, so the backfill runs here
+    user = sa.table('user', sa.column('id', sa.Integer), sa.column('email', sa.String),
+                    sa.column('email_digest', sa.String))
+    bind = op.get_bind()
+    rows = bind.execute(sa.select(user.c.id, user.c.email)).all()
+    if rows:
+        bind.execute(
+            user.update().where(user.c.id == sa.bindparam('user_id')).values(email_digest=sa.bindparam('digest')),
+            [{'user_id': id, 'digest': md5(email.lower().encode('utf-8')).hexdigest()}
+             for id, email in rows if email])
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('email_digest')
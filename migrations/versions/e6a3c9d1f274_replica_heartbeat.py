@@ -0,0 +1,28 @@
+"""replica heartbeat
+
+Revision ID: e6a3c9d1f274
+Revises: b41f7c2e9d58
+Create Date: 2026-10-18 21:14:05.381902
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e6a3c9d1f274'
+down_revision = 'b41f7c2e9d58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('replica_heartbeat',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('beat', sa.Float(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('replica_heartbeat')
@@ -0,0 +1,29 @@
+"""user celebrity flag
+
+Revision ID: f2b8d5a7c391
+Revises: e6a3c9d1f274
+Create Date: 2026-10-18 22:41:17.502316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2b8d5a7c391'
+down_revision = 'e6a3c9d1f274'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('celebrity', sa.Boolean(), server_default=sa.false(), nullable=False))
+
+    # the default TIMELINE_CELEBRITY_THRESHOLD; `flask maintain-timelines` applies another one
+    op.execute('UPDATE "user" SET celebrity = (followers_total > 10000)')
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('celebrity')
@@ -1,15 +1,50 @@
 import os
-os.environ['DATABASE_URL'] = 'sqlite://'
-
 from datetime import timezone, datetime, timedelta
+import logging
+import queue
+import socket
+import tempfile
+import time
 import unittest
-from app import db, web_app
-from app.models import User, Post
+import sqlalchemy as sqla
+from app import create_app, db, cache, limiter, profiler, avatars, replicas, reset_tokens, timelines
+from app.cache import LRUBackend
+from app.email import MailQueue, EmailTemplate, mail_queue, reset_password_email
+from app.hashing import PasswordHasher, HashingBusy
+from app.ratelimit import MemoryBucketStore, RedisBucketStore
+from app.tokens import ResetTokenService
+from app.logs import DroppingQueueHandler, BatchingQueueListener, BatchedRotatingFileHandler, ThrottledSMTPHandler, \
+    DeferredHandler
+from app.search import search_index, InvertedIndex
+from unittest import mock
+from email import message_from_bytes
+from hashlib import md5
+from flask import render_template, g
+from flask_mail import Message
+try:
+    from aiosmtpd.controller import Controller
+except ImportError:
+    Controller = None
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+from app.models import User, Post, timeline, replica_heartbeat, maintain_timelines, rebuild_timelines, reconcile_counters, follows, prime_following
+from app.pagination import paginate_keyset
+from app.tracking import LastSeenTracker
+from app.main.routes import render_post
+from config import Config
+
+
+class TestConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
 
 
 class UserModelCase(unittest.TestCase):
     def setUp(self):
-        self.web_app_context = web_app.app_context()
+        self.app = create_app(TestConfig)
+        self.web_app_context = self.app.app_context()
         self.web_app_context.push()
         db.create_all()
     
@@ -25,10 +60,11 @@ class UserModelCase(unittest.TestCase):
         self.assertTrue(u.check_password('cat'))
 
     def testAvatar(self):
-        u = User(login='john', email='john@example.com')
-        self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
-                                         'd4c74594d841139328695756648b6bd6'
-                                         '?d=identicon&s=128'))
+        u = User(login='john', email='John@Example.com')
+        self.assertEqual(u.email_digest, 'd4c74594d841139328695756648b6bd6')
+        with self.app.test_request_context():
+            self.assertEqual(u.avatar(128), '/avatar/d4c74594d841139328695756648b6bd6/128')
+            self.assertEqual(u.avatar(100), '/avatar/d4c74594d841139328695756648b6bd6/128')
 
     def test_follow(self):
         u1 = User(login='anakin', email='anakin@example.com')
@@ -94,6 +130,1175 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4, p2])
 
+    def test_home_timeline(self):
+        u1 = User(login='john', email='john@example.com')
+        u1.set_password('pass')
+        u2 = User(login='susan', email='susan@example.com')
+        u2.set_password('word')
+        u3 = User(login='mary', email='mary@example.com')
+        u3.set_password('some')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+
+        p1 = u2.publish('post from susan')
+        db.session.commit()
+        u1.follow(u2)
+        u3.follow(u1)
+        db.session.commit()
+        p2 = u1.publish('post from john')
+        p3 = u3.publish('post from mary')
+        db.session.commit()
+
+        for u in [u1, u2, u3]:
+            self.assertEqual(db.session.scalars(u.home_timeline()).all(),
+                             db.session.scalars(u.following_posts()).all())
+        self.assertEqual(db.session.scalars(u1.home_timeline()).all(), [p2, p1])
+        self.assertEqual(db.session.scalars(u3.home_timeline()).all(), [p3, p2])
+
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.home_timeline()).all(), [p2])
+
+        u1.follow(u2)
+        db.session.execute(sqla.delete(timeline))
+        rebuild_timelines()
+        self.assertEqual(db.session.scalars(u1.home_timeline()).all(), [p2, p1])
+
+    def test_home_timeline_celebrity(self):
+        u1 = User(login='john', email='john@example.com')
+        u1.set_password('pass')
+        u2 = User(login='susan', email='susan@example.com')
+        u2.set_password('word')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.app.config.update(TIMELINE_CELEBRITY_THRESHOLD=0, TIMELINE_DEMOTE_THRESHOLD=0)
+        u1.follow(u2)
+        db.session.commit()
+
+        self.assertTrue(u2.is_celebrity())
+        self.assertTrue(u1.follows_celebrity())
+        p1 = u2.publish('post from a celebrity')
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.home_timeline()).all(), [p1])
+
+    def test_timeline_length_cap(self):
+        self.app.config.update(TIMELINE_LENGTH=3, TIMELINE_MAINTENANCE_INTERVAL=0, TIMELINE_BATCH_SIZE=1)
+        u1 = User(login='john', email='john@example.com', password_hash='-')
+        u2 = User(login='susan', email='susan@example.com', password_hash='-')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        now = datetime.now(timezone.utc)
+        posts = [Post(body=f'post {i}', author=u2, timestamp=now + timedelta(seconds=i)) for i in range(5)]
+        db.session.add_all(posts)
+        db.session.flush()
+        for post in posts:
+            post.fan_out()
+        db.session.commit()
+        counts = lambda: dict(db.session.execute(
+            sqla.select(timeline.c.user_id, sqla.func.count()).group_by(timeline.c.user_id)).all())
+        # the posting requests leave the trimming to the background upkeep
+        self.assertEqual(counts(), {u1.id: 5, u2.id: 5})
+        self.assertEqual(self.app.extensions['timelines'].fanned_out, {u2.id})
+        timelines.run()
+        self.assertEqual(counts(), {u1.id: 3, u2.id: 3})
+        self.assertEqual(db.session.scalars(u1.home_timeline()).all(), posts[:1:-1])
+
+        db.session.execute(sqla.insert(timeline).values(user_id=u1.id, timestamp=now - timedelta(days=1),
+                                                        post_id=posts[0].post_id))
+        db.session.commit()
+        self.assertEqual(maintain_timelines(), (0, 1))
+        self.assertEqual(counts(), {u1.id: 3, u2.id: 3})
+
+    def test_celebrity_demotion_backfills_followers(self):
+        self.app.config.update(TIMELINE_CELEBRITY_THRESHOLD=2, TIMELINE_DEMOTE_THRESHOLD=2,
+                               TIMELINE_MAINTENANCE_INTERVAL=0)
+        star = User(login='susan', email='susan@example.com', password_hash='-')
+        fans = [User(login=f'fan{i}', email=f'fan{i}@example.com', password_hash='-') for i in range(3)]
+        db.session.add_all([star, *fans])
+        db.session.commit()
+        for fan in fans:
+            fan.follow(star)
+        db.session.commit()
+        db.session.refresh(star)
+        self.assertTrue(star.is_celebrity())
+        p1 = star.publish('post from a celebrity')
+        db.session.commit()
+        self.assertNotIn(p1.post_id, db.session.scalars(sqla.select(timeline.c.post_id).where(
+            timeline.c.user_id == fans[0].id)).all())
+
+        # at the promotion threshold it stays a celebrity; only below the demotion one it stops
+        fans[2].unfollow(star)
+        db.session.commit()
+        self.assertEqual(self.app.extensions['timelines'].demoted, set())
+        fans[1].unfollow(star)
+        db.session.commit()
+        self.assertEqual(self.app.extensions['timelines'].demoted, {star.id})
+        self.assertTrue(fans[0].follows_celebrity())
+        timelines.run()
+        self.assertFalse(fans[0].follows_celebrity())
+        self.assertEqual(db.session.scalars(fans[0].home_timeline()).all(), [p1])
+
+    def test_keyset_pagination(self):
+        u1 = User(login='john', email='john@example.com')
+        u1.set_password('pass')
+        db.session.add(u1)
+        db.session.commit()
+        now = datetime.now(timezone.utc)
+        posts = [Post(body=f'post {i}', author=u1, timestamp=now + timedelta(seconds=i // 2))
+                 for i in range(7)]
+        db.session.add_all(posts)
+        db.session.commit()
+        rebuild_timelines()
+        expected = sorted(posts, key=lambda p: (p.timestamp, p.post_id), reverse=True)
+
+        for query in [sqla.select(Post), u1.home_timeline()]:
+            pages = [paginate_keyset(query, per_page=3)]
+            while pages[-1].has_next:
+                pages.append(paginate_keyset(query, pages[-1].next_cursor, per_page=3))
+            self.assertEqual([p for page in pages for p in page.items], expected)
+            self.assertEqual([len(page.items) for page in pages], [3, 3, 1])
+            self.assertFalse(pages[0].has_prev)
+
+            back = paginate_keyset(query, pages[2].prev_cursor, per_page=3)
+            self.assertEqual(back.items, pages[1].items)
+            back = paginate_keyset(query, back.prev_cursor, per_page=3)
+            self.assertEqual(back.items, pages[0].items)
+            self.assertFalse(back.has_prev)
+
+        self.assertEqual(paginate_keyset(sqla.select(Post), 'forged', per_page=3).items, expected[:3])
+
+    def test_following_among(self):
+        users = [User(login=f'user{i}', email=f'user{i}@example.com', password_hash='-') for i in range(5)]
+        db.session.add_all(users)
+        db.session.commit()
+        users[0].follow(users[1])
+        users[0].follow(users[3])
+        db.session.commit()
+        self.assertEqual(users[0].following_among([u.id for u in users]), {users[1].id, users[3].id})
+        self.assertEqual(users[0].following_among([]), set())
+
+        queries = []
+        count = lambda *args: queries.append(args[2])
+        with self.app.test_request_context():
+            sqla.event.listen(db.engine, 'before_cursor_execute', count)
+            try:
+                prime_following(users[0], users[1:])
+                states = [follows(users[0], u) for u in users[1:]]
+            finally:
+                sqla.event.remove(db.engine, 'before_cursor_execute', count)
+            self.assertEqual(states, [True, False, True, False])
+            self.assertEqual(len(queries), 1)
+
+            users[0].unfollow(users[1])
+            self.assertFalse(follows(users[0], users[1]))
+
+    def test_counters(self):
+        u1 = User(login='john', email='john@example.com')
+        u1.set_password('pass')
+        u2 = User(login='susan', email='susan@example.com')
+        u2.set_password('word')
+        u3 = User(login='mary', email='mary@example.com')
+        u3.set_password('some')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+
+        u1.follow(u2)
+        u3.follow(u2)
+        u2.follow(u1)
+        u2.publish('post from susan')
+        u2.publish('another post from susan')
+        db.session.commit()
+        self.assertEqual((u2.followers_count(), u2.following_count(), u2.posts_count()), (2, 1, 2))
+        u3.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u2.followers_count(), 1)
+        self.assertEqual(reconcile_counters(), 0)
+
+        db.session.execute(sqla.update(User).values(followers_total=7, posts_total=0))
+        db.session.commit()
+        self.assertEqual(reconcile_counters(), 3)
+        self.assertEqual([(u.followers_count(), u.following_count(), u.posts_count()) for u in [u1, u2, u3]],
+                         [(1, 1, 0), (1, 1, 2), (0, 0, 0)])
+
+    def test_last_seen_write_behind(self):
+        u1 = User(login='john', email='john@example.com')
+        u1.set_password('pass')
+        u2 = User(login='susan', email='susan@example.com')
+        u2.set_password('word')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        tracker = LastSeenTracker(self.app)
+        now = datetime.now(timezone.utc) + timedelta(minutes=5)
+        self.app.config['LAST_SEEN_FLUSH_SIZE'] = 2
+        tracker.seen(u1, now)
+        tracker.seen(u1, now + timedelta(seconds=10))
+        self.assertEqual(tracker.last_seen(u1), now)
+        self.assertNotEqual(db.session.scalar(sqla.select(User.last_seen).where(User.id == u1.id)),
+                            now.replace(tzinfo=None))
+
+        # the second user fills the batch and wakes the flusher instead of writing inline
+        tracker.seen(u2, now)
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            seen = db.session.scalars(sqla.select(User.last_seen).order_by(User.id)).all()
+            if seen == [now.replace(tzinfo=None)] * 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.app.extensions['tracker'].pending, {})
+        self.assertEqual(seen, [now.replace(tzinfo=None)] * 2)
+
+    def test_last_seen_kept_when_flush_fails(self):
+        u1 = User(login='john', email='john@example.com', password_hash='-')
+        u2 = User(login='susan', email='susan@example.com', password_hash='-')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        tracker = LastSeenTracker(self.app)
+        now = datetime.now(timezone.utc) + timedelta(minutes=5)
+        later = now + timedelta(minutes=5)
+        tracker.seen(u1, now)
+        tracker.seen(u2, now)
+
+        def locked(*args, **kwargs):
+            # john makes another request while the batch is out
+            tracker.seen(u1, later)
+            raise sqla.exc.OperationalError('UPDATE user', {}, Exception('database is locked'))
+
+        with mock.patch.object(sqla.engine.Connection, 'execute', side_effect=locked):
+            with self.assertRaises(sqla.exc.OperationalError):
+                tracker.flush()
+        self.assertEqual(self.app.extensions['tracker'].pending, {u1.id: later, u2.id: now})
+
+        tracker.flush()
+        self.assertEqual(db.session.scalars(sqla.select(User.last_seen).order_by(User.id)).all(),
+                         [later.replace(tzinfo=None), now.replace(tzinfo=None)])
+
+
+class FeedQueryCountCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['POSTS_PER_PAGE'] = 25
+        self.web_app_context = self.app.app_context()
+        self.web_app_context.push()
+        db.create_all()
+        cache.clear()
+        self.queries = []
+        sqla.event.listen(db.engine, 'before_cursor_execute', self.count_query)
+
+    def tearDown(self):
+        sqla.event.remove(db.engine, 'before_cursor_execute', self.count_query)
+        db.session.remove()
+        db.drop_all()
+        self.web_app_context.pop()
+
+    def count_query(self, conn, cursor, statement, parameters, context, executemany):
+        self.queries.append(statement)
+
+    def test_feed_query_count(self):
+        users = [User(login=f'user{i}', email=f'user{i}@example.com', password_hash='-')
+                 for i in range(26)]
+        db.session.add_all(users)
+        db.session.commit()
+        for author in users[1:]:
+            users[0].follow(author)
+        db.session.commit()
+        for author in users[1:]:
+            author.publish(f'post from {author.login}')
+        db.session.commit()
+
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(users[0].id)
+        for url in ['/index', '/explore', '/']:
+            db.session.remove()
+            self.queries.clear()
+            response = client.get(url)
+            body = response.get_data()
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(body.count(b'post from user'), 25)
+            self.assertLessEqual(len(self.queries), 6, url)
+
+
+class CacheCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.web_app_context = self.app.app_context()
+        self.web_app_context.push()
+        db.create_all()
+        cache.clear()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.web_app_context.pop()
+
+    def test_lru_backend(self):
+        backend = LRUBackend(max_entries=2)
+        backend.set('a', '1')
+        backend.set('b', '2')
+        self.assertEqual(backend.get('a'), '1')
+        backend.set('c', '3')
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(backend.get('a'), '1')
+        backend.set('d', '4', timeout=-1)
+        self.assertIsNone(backend.get('d'))
+
+    def test_versioned_namespace(self):
+        version = cache.version('feed')
+        self.assertEqual(cache.version('feed'), version)
+        self.assertNotEqual(cache.bump('feed'), version)
+
+    def test_home_page_invalidation(self):
+        # two apps on one database file stand in for two workers, each with its own cache
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        class SharedConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory.name, 'shared.db')
+            WTF_CSRF_ENABLED = False
+
+        workers = [create_app(SharedConfig) for _ in range(2)]
+        with workers[0].app_context():
+            db.create_all()
+            u = User(login='john', email='john@example.com', password_hash='-')
+            db.session.add(u)
+            db.session.commit()
+            u.publish('first post')
+            db.session.commit()
+            db.session.remove()
+        clients = [worker.test_client() for worker in workers]
+        etags = []
+        for client in clients:
+            response = client.get('/')
+            self.assertIn(b'first post', response.get_data())
+            etags.append(response.headers['ETag'])
+
+        # a post made through the first worker changes the second worker's page too
+        with clients[0].session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        clients[0].post('/index', data={'post': 'second post'})
+        response = clients[1].get('/', headers={'If-None-Match': etags[1]})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'second post', response.get_data())
+
+        # and so does a profile edit, which changes no post
+        etag = response.headers['ETag']
+        clients[0].post('/edit_profile', data={'login': 'johnny', 'about_me': ''})
+        response = clients[1].get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'johnny', response.get_data())
+        for worker in workers:
+            with worker.app_context():
+                db.engine.dispose()
+
+    def test_conditional_get(self):
+        u1 = User(login='john', email='john@example.com', password_hash='-')
+        u2 = User(login='susan', email='susan@example.com', password_hash='-')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u2.publish('post from susan')
+        db.session.commit()
+
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u1.id)
+        for url in ['/explore', '/user/susan', '/']:
+            db.session.remove()
+            response = client.get(url)
+            etag = response.headers['ETag']
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('Last-Modified', response.headers)
+            response = client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.get_data(), b'')
+            # only the ETag validates: a date says nothing about follows or profile edits
+            response = client.get(url, headers={'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+            self.assertEqual(response.status_code, 200)
+
+        etag = client.get('/user/susan').headers['ETag']
+        db.session.remove()
+        u2 = db.session.get(User, u2.id)
+        u2.publish('another post from susan')
+        db.session.commit()
+        db.session.remove()
+        self.assertEqual(client.get('/user/susan', headers={'If-None-Match': etag}).status_code, 200)
+
+
+def fake_redis_server(case):
+    # an in-process Redis-compatible server behind redis.Redis.from_url for the test's duration
+    server = fakeredis.FakeServer()
+    patcher = mock.patch('redis.Redis.from_url',
+                         lambda url, **options: fakeredis.FakeRedis(server=server, **options))
+    patcher.start()
+    case.addCleanup(patcher.stop)
+    return server
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+class RedisCacheCase(unittest.TestCase):
+    def setUp(self):
+        fake_redis_server(self)
+        self.config = type('RedisConfig', (TestConfig,), {'CACHE_TYPE': 'redis'})
+        self.app = create_app(self.config)
+        self.web_app_context = self.app.app_context()
+        self.web_app_context.push()
+
+    def tearDown(self):
+        self.web_app_context.pop()
+
+    def test_get_set_and_timeout(self):
+        client = cache.backend.client
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', '1')
+        self.assertEqual(cache.get('a'), '1')
+        self.assertEqual(client.get('microblog:a'), '1')
+        self.assertTrue(0 < client.ttl('microblog:a') <= self.app.config['CACHE_DEFAULT_TIMEOUT'])
+        cache.set('b', '2', timeout=5)
+        self.assertTrue(0 < client.ttl('microblog:b') <= 5)
+        cache.backend.set('c', '3')
+        self.assertEqual(client.ttl('microblog:c'), -1)
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+
+    def test_versions_are_shared(self):
+        # a second app on the same server stands in for another worker
+        other = create_app(self.config)
+        version = cache.version('feed')
+        with other.app_context():
+            self.assertEqual(cache.version('feed'), version)
+            bumped = cache.bump('feed')
+        self.assertNotEqual(bumped, version)
+        self.assertEqual(cache.version('feed'), bumped)
+
+    def test_clear_keeps_other_prefixes(self):
+        cache.set('a', '1')
+        cache.backend.client.set('elsewhere', 'x')
+        cache.clear()
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.backend.client.get('elsewhere'), 'x')
+
+
+class SinkHandler:
+    def __init__(self):
+        self.messages = []
+        self.sessions = set()
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope)
+        self.sessions.add(id(session))
+        return '250 OK'
+
+
+@unittest.skipIf(Controller is None, 'aiosmtpd is not installed')
+class MailQueueCase(unittest.TestCase):
+    def setUp(self):
+        self.handler = SinkHandler()
+        self.controller = Controller(self.handler, hostname='127.0.0.1', port=find_free_port())
+        self.controller.start()
+        self.app = create_app(TestConfig)
+        self.state = self.app.extensions['mail']
+        self.state.server, self.state.port, self.state.suppress = '127.0.0.1', self.controller.port, False
+
+    def tearDown(self):
+        self.controller.stop()
+
+    def message(self, i):
+        return Message(f'message {i}', sender='admin@example.com', recipients=[f'user{i}@example.com'], body='hi')
+
+    def test_delivery_over_reused_connections(self):
+        queue = MailQueue(self.app)
+        with self.app.app_context():
+            for i in range(10):
+                self.assertTrue(queue.send(self.message(i)))
+            self.assertTrue(queue.join(timeout=10))
+            metrics = queue.metrics()
+        self.assertEqual(len(self.handler.messages), 10)
+        self.assertLessEqual(len(self.handler.sessions), self.app.config['MAIL_WORKERS'])
+        self.assertEqual((metrics['sent'], metrics['failed'], metrics['depth']), (10, 0, 0))
+
+    def test_retry_and_give_up(self):
+        self.app.config.update(MAIL_MAX_RETRIES=2, MAIL_RETRY_BACKOFF=0)
+        self.state.port = find_free_port()
+        queue = MailQueue(self.app)
+        with self.app.app_context():
+            queue.send(self.message(0))
+            self.assertTrue(queue.join(timeout=10))
+            metrics = queue.metrics()
+        self.assertEqual((metrics['sent'], metrics['retried'], metrics['failed']), (0, 2, 1))
+
+    def test_module_queue_survives_another_app(self):
+        with self.app.app_context():
+            self.assertTrue(mail_queue.send(self.message(0)))
+            self.assertTrue(mail_queue.join(timeout=10))
+        other = create_app(TestConfig)
+        with self.app.app_context():
+            self.assertTrue(mail_queue.send(self.message(1)))
+            self.assertTrue(mail_queue.join(timeout=10))
+        with other.app_context():
+            self.assertTrue(mail_queue.send(self.message(2)))
+            self.assertTrue(mail_queue.join(timeout=10))
+            self.assertEqual(mail_queue.metrics()['sent'], 1)
+        self.assertEqual([envelope.rcpt_tos for envelope in self.handler.messages],
+                         [['user0@example.com'], ['user1@example.com']])
+
+
+class PasswordHasherCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+
+    def test_process_pool(self):
+        hasher = PasswordHasher(self.app)
+        with self.app.app_context():
+            password_hash = hasher.hash('cat')
+            self.assertTrue(hasher.verify(password_hash, 'cat'))
+            self.assertFalse(hasher.verify(password_hash, 'dog'))
+            executor = self.app.extensions['hasher'].executor
+            self.assertIn(executor._mp_context.get_start_method(), ('forkserver', 'spawn'))
+            hasher.shutdown()
+
+    def test_rejects_when_saturated(self):
+        self.app.config.update(PASSWORD_HASH_WORKERS=0, PASSWORD_HASH_CONCURRENCY=1, PASSWORD_HASH_QUEUE_TIMEOUT=0.01)
+        hasher = PasswordHasher(self.app)
+        slots = self.app.extensions['hasher'].slots
+        with self.app.app_context():
+            slots.acquire()
+            with self.assertRaises(HashingBusy):
+                hasher.hash('cat')
+            slots.release()
+            self.assertTrue(hasher.verify(hasher.hash('cat'), 'cat'))
+
+    def test_rehash_on_login(self):
+        with self.app.app_context():
+            u = User(login='susan', email='susan@example.com')
+            self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+            u.set_password('cat')
+            old_hash = u.password_hash
+            self.assertTrue(u.check_password('cat'))
+            self.assertEqual(u.password_hash, old_hash)
+            self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:2000'
+            self.assertFalse(u.check_password('dog'))
+            self.assertEqual(u.password_hash, old_hash)
+            self.assertTrue(u.check_password('cat'))
+            self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:2000$'))
+            self.assertTrue(u.check_password('cat'))
+
+
+class RateLimitCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.web_app_context = self.app.app_context()
+        self.web_app_context.push()
+        db.create_all()
+        self.app.config.update(WTF_CSRF_ENABLED=False, RATELIMIT_LOGIN_CAPACITY=2)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.web_app_context.pop()
+
+    def test_bucket_store(self):
+        store = MemoryBucketStore(max_keys=2)
+        self.assertEqual([store.take('a', 2, 1) for _ in range(2)], [0, 0])
+        self.assertGreater(store.take('a', 2, 1), 0)
+        store.take('b', 2, 1)
+        store.take('c', 2, 1)
+        self.assertEqual(list(store.buckets), ['b', 'c'])
+        self.assertEqual(store.take('a', 2, 1), 0)
+
+    @unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+    def test_redis_store_matches_memory_store(self):
+        fake_redis_server(self)
+        memory, shared = MemoryBucketStore(max_keys=100), RedisBucketStore('redis://localhost:6379/0', 'test:')
+        # (key, capacity, rate, seconds since the previous call): drain a bucket, wait for
+        # part of a token, then for a full one, then long enough to overflow the capacity
+        calls = [('a', 2, 0.5, 0), ('a', 2, 0.5, 0), ('a', 2, 0.5, 0), ('a', 2, 0.5, 1),
+                 ('b', 3, 1, 0), ('a', 2, 0.5, 1), ('a', 2, 0.5, 0), ('a', 2, 0.5, 60),
+                 ('a', 2, 0.5, 0), ('a', 2, 0.5, 0), ('b', 3, 1, 0.25)]
+        now = 1000.0
+        for key, capacity, rate, elapsed in calls:
+            now += elapsed
+            with mock.patch('app.ratelimit.monotonic', return_value=now), \
+                    mock.patch('app.ratelimit.time', return_value=now):
+                self.assertAlmostEqual(shared.take(key, capacity, rate), memory.take(key, capacity, rate),
+                                       places=6, msg=(key, now))
+
+        shared.client.set('elsewhere', 'x')
+        shared.clear()
+        self.assertEqual(shared.client.keys('test:*'), [])
+        self.assertEqual(shared.client.get('elsewhere'), 'x')
+        with mock.patch('app.ratelimit.time', return_value=now):
+            self.assertEqual(shared.take('a', 2, 0.5), 0)
+
+    def test_rates_must_refill(self):
+        for setting in ('RATELIMIT_IP_PER_MINUTE', 'RATELIMIT_LOGIN_PER_MINUTE'):
+            with self.assertRaisesRegex(RuntimeError, setting):
+                create_app(type('ZeroRateConfig', (TestConfig,), {setting: 0}))
+
+    def test_login_rejected_before_password_check(self):
+        client = self.app.test_client()
+        form = {'login': 'susan', 'password': 'cat'}
+        with mock.patch.object(User, 'check_password', return_value=False) as check:
+            statuses = [client.post('/login', data=form).status_code for _ in range(3)]
+        self.assertEqual(statuses, [302, 302, 429])
+        self.assertEqual(check.call_count, 0)
+        self.assertEqual(client.post('/login', data={'login': 'john', 'password': 'cat'}).status_code, 302)
+
+    def test_reset_request_rejected_before_mail(self):
+        u = User(login='susan', email='susan@example.com', password_hash='-')
+        db.session.add(u)
+        db.session.commit()
+        client = self.app.test_client()
+        with mock.patch('app.auth.routes.send_password_reset_email') as send:
+            statuses = [client.post('/reset_password_request', data={'email': u.email}).status_code
+                        for _ in range(3)]
+        self.assertEqual(statuses, [302, 302, 429])
+        self.assertEqual(send.call_count, 2)
+
+
+class ResetTokenCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.web_app_context = self.app.app_context()
+        self.web_app_context.push()
+        db.create_all()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.web_app_context.pop()
+
+    def test_token_service(self):
+        tokens = ResetTokenService(self.app)
+        cache = tokens.cache()
+        u = User(id=7, login='susan', email='susan@example.com')
+        token = tokens.issue(u)
+        self.assertEqual(tokens.verify(token)['user_id'], 7)
+        self.assertEqual(len(cache.claims), 1)
+        self.assertIsNone(tokens.verify(token + 'x'))
+        self.assertIsNone(tokens.verify(tokens.issue(u, expires_in=-1)))
+        claims = tokens.verify(token)
+        self.assertTrue(tokens.matches(claims, u.password_hash))
+        self.assertFalse(tokens.matches(claims, 'pbkdf2:sha256:1000$new$hash'))
+
+    def test_reset_password_single_use(self):
+        u = User(login='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        token = u.get_reset_password_token()
+        db.session.remove()
+        client = self.app.test_client()
+        statements = []
+        counter = lambda *args: statements.append(args[2])
+        sqla.event.listen(db.engine, 'before_cursor_execute', counter)
+        try:
+            self.assertEqual(client.get(f'/reset_password/{token}').status_code, 200)
+        finally:
+            sqla.event.remove(db.engine, 'before_cursor_execute', counter)
+        self.assertEqual(statements, [])
+        form = {'password': 'dog', 'password2': 'dog'}
+        self.assertEqual(client.post(f'/reset_password/{token}', data=form).headers['Location'], '/home_page')
+        self.assertTrue(db.session.get(User, u.id).check_password('dog'))
+        # another worker knows nothing about this one, but the stored hash has moved on
+        reset_tokens.cache().claims.clear()
+        form = {'password': 'fox', 'password2': 'fox'}
+        self.assertEqual(client.post(f'/reset_password/{token}', data=form).headers['Location'], '/index')
+        self.assertTrue(db.session.get(User, u.id).check_password('dog'))
+        self.assertIsNone(User.verify_reset_password_token(token))
+
+    def test_busy_hasher_keeps_token(self):
+        u = User(login='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        token = u.get_reset_password_token()
+        client = self.app.test_client()
+        form = {'password': 'dog', 'password2': 'dog'}
+        with mock.patch.object(PasswordHasher, 'hash', side_effect=HashingBusy):
+            self.assertEqual(client.post(f'/reset_password/{token}', data=form).status_code, 503)
+        db.session.remove()
+        self.assertEqual(client.post(f'/reset_password/{token}', data=form).headers['Location'], '/home_page')
+        self.assertTrue(db.session.get(User, u.id).check_password('dog'))
+
+
+class SearchCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.web_app_context = self.app.app_context()
+        self.web_app_context.push()
+        db.create_all()
+        self.author = User(login='susan', email='susan@example.com', password_hash='-')
+        db.session.add(self.author)
+        now = datetime.now(timezone.utc)
+        self.posts = [
+            Post(body='flask tips', author=self.author, timestamp=now - timedelta(days=300)),
+            Post(body='flask flask tips', author=self.author, timestamp=now - timedelta(days=1)),
+            Post(body='more flask tips', author=self.author, timestamp=now),
+            Post(body='sqlite tuning', author=self.author, timestamp=now),
+        ]
+        db.session.add_all(self.posts)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.web_app_context.pop()
+
+    def ids(self, page):
+        return [post.post_id for post in page]
+
+    def test_fts_ranking_and_deletes(self):
+        self.assertTrue(search_index.use_fts())
+        old, double, fresh, other = self.posts
+        self.assertEqual(self.ids(search_index.search('Flask TIPS')), [double.post_id, fresh.post_id, old.post_id])
+        self.assertEqual(self.ids(search_index.search('tuning')), [other.post_id])
+        self.assertEqual(self.ids(search_index.search('"; DROP')), [])
+        self.app.config['SEARCH_MAX_CANDIDATES'] = 2
+        self.assertEqual(self.ids(search_index.search('flask')), [double.post_id, fresh.post_id])
+        self.app.config['SEARCH_MAX_CANDIDATES'] = 10000
+        db.session.delete(fresh)
+        db.session.commit()
+        self.assertEqual(self.ids(search_index.search('flask')), [double.post_id, old.post_id])
+
+    def test_inverted_index(self):
+        index = InvertedIndex()
+        with db.engine.connect() as connection:
+            index.build(connection)
+        old, double, fresh, other = self.posts
+        now = datetime.now(timezone.utc)
+        self.assertEqual([id for score, id in index.search(['flask', 'tips'], now, 30)],
+                         [double.post_id, fresh.post_id, old.post_id])
+        index.apply([(fresh.post_id, None, fresh.timestamp), (other.post_id, 'flask', other.timestamp)])
+        self.assertEqual({id for score, id in index.search(['flask'], now, 30)},
+                         {old.post_id, double.post_id, other.post_id})
+        self.assertNotIn('tuning', index.postings)
+        self.assertEqual([id for score, id in index.search(['flask'], now, 30, candidates=1)], [other.post_id])
+        self.assertEqual(index.total_length, sum(index.lengths.values()))
+
+    def test_memory_fallback_sees_other_processes_posts(self):
+        search_index.state().fts = False
+        self.assertEqual(len(search_index.search('tuning').items), 1)
+        # written without the ORM, the way another worker's insert looks from here
+        with db.engine.begin() as connection:
+            connection.execute(sqla.insert(Post.__table__).values(
+                body='more sqlite tuning', user_id=self.author.id, timestamp=datetime.now(timezone.utc)))
+        self.assertEqual({post.body for post in search_index.search('tuning').items},
+                         {'more sqlite tuning', 'sqlite tuning'})
+        index = search_index.state().index
+        self.assertEqual(index.total_length, sum(index.lengths.values()))
+
+    def test_search_page(self):
+        self.app.config['SEARCH_RESULTS_PER_PAGE'] = 2
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(self.author.id)
+        first = client.get('/search?q=flask').get_data(as_text=True)
+        self.assertIn('flask flask tips', first)
+        self.assertIn('/search?cursor=2&amp;q=flask', first)
+        self.assertIn('flask tips', client.get('/search?q=flask&cursor=2').get_data(as_text=True))
+
+
+class ProfilerCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.web_app_context = self.app.app_context()
+        self.web_app_context.push()
+        db.create_all()
+        self.app.config.update(PROFILE_SAMPLE_RATE=1.0, PROFILE_ENDPOINT=True, WTF_CSRF_ENABLED=False)
+        profiler.reset()
+        u = User(login='susan', email='susan@example.com', password_hash='-')
+        db.session.add(u)
+        db.session.commit()
+        u.publish('hello')
+        db.session.commit()
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+
+    def tearDown(self):
+        profiler.reset()
+        db.session.remove()
+        db.drop_all()
+        self.web_app_context.pop()
+
+    def test_server_timing_and_report(self):
+        response = self.client.get('/explore')
+        timing = response.headers['X-Server-Timing']
+        self.assertRegex(timing, r'^db;dur=[\d.]+;desc="\d+ queries", render;dur=[\d.]+, commit;dur=[\d.]+, total;dur=')
+        response.close()
+        self.client.post('/index', data={'post': 'again'}).close()
+        report = self.client.get('/debug/perf').get_json()
+        explore = report['endpoints']['main.explore']
+        self.assertEqual(explore['requests'], 1)
+        self.assertGreater(explore['queries']['mean'], 0)
+        self.assertGreater(explore['render_ms']['mean'], 0)
+        self.assertGreater(report['endpoints']['main.index']['commit_ms']['mean'], 0)
+        self.assertTrue(report['slowest_queries'])
+
+    def test_sampling_and_endpoint_switch(self):
+        self.app.config.update(PROFILE_SAMPLE_RATE=0.0, PROFILE_ENDPOINT=False)
+        self.assertNotIn('X-Server-Timing', self.client.get('/explore').headers)
+        self.assertEqual(self.client.get('/debug/perf').status_code, 404)
+        self.assertEqual(profiler.report()['endpoints'], {})
+
+
+class LoggingCase(unittest.TestCase):
+    def logger(self, handler):
+        logger = logging.getLogger(f'tests.{self.id()}')
+        logger.propagate = False
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        return logger
+
+    def test_batched_file_writes(self):
+        directory = tempfile.mkdtemp()
+        file_handler = BatchedRotatingFileHandler(os.path.join(directory, 'test.log'), maxBytes=20, backupCount=1)
+        file_handler.setLevel(logging.INFO)
+        log_queue = queue.Queue(5)
+        queue_handler = DroppingQueueHandler(log_queue)
+        logger = self.logger(queue_handler)
+        for i in range(8):
+            logger.error('line %d', i)
+        self.assertEqual(queue_handler.dropped, 3)
+        with mock.patch.object(file_handler, 'handle_batch', wraps=file_handler.handle_batch) as handle_batch:
+            listener = BatchingQueueListener(log_queue, file_handler, batch_size=100)
+            listener.start()
+            listener.stop()
+        self.assertEqual(handle_batch.call_count, 1)
+        file_handler.close()
+        with open(os.path.join(directory, 'test.log')) as log, open(os.path.join(directory, 'test.log.1')) as old:
+            self.assertEqual((old.read() + log.read()).splitlines(), ['line 2', 'line 3', 'line 4'])
+
+    def test_error_mails_are_deduplicated_and_capped(self):
+        handler = ThrottledSMTPHandler('localhost', 'from@example.com', ['to@example.com'], 'failure',
+                                       dedupe_seconds=600, max_per_window=2, window_seconds=3600)
+        logger = self.logger(DroppingQueueHandler(queue.Queue()))
+        log_queue = logger.handlers[-1].queue
+
+        def fail(kind):
+            try:
+                raise kind('boom')
+            except Exception:
+                logger.exception('request failed')
+
+        for kind in (ValueError, ValueError, ValueError, KeyError, TypeError):
+            fail(kind)
+        with mock.patch('logging.handlers.SMTPHandler.emit') as send:
+            while not log_queue.empty():
+                handler.handle(log_queue.get())
+        self.assertEqual([call.args[0].origin[0] for call in send.call_args_list], ['ValueError', 'KeyError'])
+        self.assertEqual(sorted(handler.suppressed.values()), [1, 2])
+
+    def test_handlers_set_up_on_first_record(self):
+        directory = os.path.join(tempfile.mkdtemp(), 'logs')
+        config = type('LoggingConfig', (TestConfig,), {'TESTING': False, 'LOG_DIR': directory, 'MAIL_SERVER': None})
+        app = create_app(config)
+        deferred = app.logger.handlers[-1]
+        self.addCleanup(app.logger.removeHandler, deferred)
+        self.assertIsInstance(deferred, DeferredHandler)
+        self.assertFalse(os.path.exists(directory))
+        app.logger.info('first record')
+        self.assertTrue(os.path.exists(os.path.join(directory, 'sandbox.log')))
+        self.assertEqual(len(deferred.handlers), 1)
+
+
+class SQLiteTuningCase(unittest.TestCase):
+    def test_connect_pragmas(self):
+        app = create_app(TestConfig)
+        engine = sqla.create_engine('sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db'))
+        with app.app_context(), engine.connect() as connection:
+            pragmas = [connection.exec_driver_sql(f'PRAGMA {name}').scalar()
+                       for name in ('journal_mode', 'synchronous', 'busy_timeout', 'mmap_size')]
+        engine.dispose()
+        self.assertEqual(pragmas, ['wal', 1, app.config['SQLITE_BUSY_TIMEOUT'], app.config['SQLITE_MMAP_SIZE']])
+
+
+class EmailTemplateCase(unittest.TestCase):
+    def test_precompiled_reset_email(self):
+        user = User(login='<bob>', email='bob@example.com')
+        with create_app(TestConfig).test_request_context():
+            msg = reset_password_email.message('admin@example.com', user.email, login=user.login, token='t0k3n')
+            expected = [render_template(f'email/reset_password_request.{kind}', user=user, token='t0k3n')
+                        for kind in ('txt', 'html')]
+        msg.date = 0
+        parsed = message_from_bytes(msg.as_bytes())
+        self.assertEqual(parsed['To'], 'bob@example.com')
+        self.assertEqual(parsed['Subject'], '[Microblog] Reset your Password')
+        self.assertEqual(parsed['Message-ID'], msg.msgId)
+        bodies = [part.get_payload(decode=True).decode('utf-8').replace('\r\n', '\n')
+                  for part in parsed.get_payload()]
+        self.assertEqual(bodies, expected)
+        self.assertIn('&lt;bob&gt;', bodies[1])
+
+    def test_links_ignore_forged_hosts(self):
+        template = EmailTemplate('[Microblog] Reset your Password', 'email/reset_password_request.txt',
+                                 'email/reset_password_request.html')
+        app = create_app(TestConfig)
+        for number in range(20):
+            with app.test_request_context(base_url=f'http://evil{number}.example.com/'):
+                template.message('admin@example.com', 'bob@example.com', login='bob', token='t0k3n')
+        self.assertEqual(len(template.compiled), template.max_compiled)
+
+        app.config['SERVER_NAME'] = 'microblog.example.com'
+        with app.test_request_context(base_url='http://evil.example.com/'):
+            msg = template.message('admin@example.com', 'bob@example.com', login='bob', token='t0k3n')
+        self.assertIn('http://microblog.example.com/reset_password/t0k3n', msg.body)
+        self.assertNotIn('evil', msg.body)
+
+
+class AvatarCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = create_app(TestConfig)
+        self.app.config.update(AVATAR_CACHE_DIR=self.directory.name, AVATAR_CACHE_MAX_FILES=2)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_served_from_disk_with_long_cache_headers(self):
+        digest = 'd4c74594d841139328695756648b6bd6'
+        response = self.client.get(f'/avatar/{digest}/100')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'image/png')
+        self.assertTrue(response.data.startswith(b'\x89PNG'))
+        self.assertTrue(response.cache_control.public)
+        self.assertTrue(response.cache_control.immutable)
+        self.assertEqual(response.cache_control.max_age, 365 * 24 * 3600)
+        response.close()
+        revalidated = self.client.get(f'/avatar/{digest}/100', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(revalidated.status_code, 304)
+        revalidated.close()
+        cached = os.path.join(self.directory.name, '128', digest + '.png')
+        with open(cached, 'rb') as file:
+            self.assertEqual(file.read(), response.data)
+        self.assertEqual(self.client.get(f'/avatar/{digest.upper()}/128').status_code, 404)
+        self.assertEqual(self.client.get(f'/avatar/{digest}/0').status_code, 404)
+
+    def test_least_recently_served_evicted(self):
+        first, second, third = (md5(name.encode()).hexdigest() for name in ('a', 'b', 'c'))
+        with self.app.app_context():
+            files = [avatars.open(digest, 32) for digest in (first, second, first, third)]
+        folder = os.path.join(self.directory.name, '32')
+        self.assertEqual(sorted(os.listdir(folder)), sorted([first + '.png', third + '.png']))
+        # the handle opened before the eviction still reads the whole image
+        self.assertTrue(files[1].read().startswith(b'\x89PNG'))
+        for file in files:
+            file.close()
+
+
+class ReplicaCase(unittest.TestCase):
+    # the in-memory database is the primary and a SQLite file stands in for the replica
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = create_app(TestConfig)
+        # the background lag checks are left out; setUp stamps the replica's heartbeat instead
+        self.app.config.update(WTF_CSRF_ENABLED=False, REPLICA_CHECK_INTERVAL=3600, DATABASE_REPLICA_URLS=[
+            'sqlite:///' + os.path.join(self.directory.name, 'replica.db')])
+        self.web_app_context = self.app.app_context()
+        self.web_app_context.push()
+        db.create_all()
+        cache.clear()
+        self.replica = replicas.load_engines()[0]
+        db.metadata.create_all(self.replica)
+        now = datetime.now(timezone.utc)
+        for engine, body, post_id in ((db.engine, 'on the primary', 1), (self.replica, 'on the replica', 100)):
+            with engine.begin() as connection:
+                connection.execute(sqla.insert(User), [{'id': 1, 'login': 'ann', 'email': 'ann@example.com',
+                                                        'password_hash': '-', 'last_seen': now}])
+                connection.execute(sqla.insert(Post), [{'post_id': post_id, 'body': body, 'user_id': 1,
+                                                        'timestamp': now}])
+        self.replicate_heartbeat(time.time())
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = '1'
+
+    def replicate_heartbeat(self, beat):
+        with self.replica.begin() as connection:
+            connection.execute(sqla.delete(replica_heartbeat))
+            connection.execute(sqla.insert(replica_heartbeat).values(id=1, beat=beat))
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        replicas.reset()
+        self.web_app_context.pop()
+        self.directory.cleanup()
+
+    def test_read_only_views_use_replica_until_a_write(self):
+        response = self.client.get('/explore')
+        self.assertIn(b'on the replica', response.data)
+        self.assertNotIn(b'on the primary', response.data)
+        response = self.client.post('/index', data={'post': 'fresh post'})
+        self.assertIn(b'fresh post', response.data)
+        # within REPLICA_STICKY_SECONDS of the write, the replica may not have the new post yet
+        response = self.client.get('/explore')
+        self.assertIn(b'fresh post', response.data)
+        self.assertIn(b'on the primary', response.data)
+        self.app.config['REPLICA_STICKY_SECONDS'] = 0
+        self.assertIn(b'on the replica', self.client.get('/explore').data)
+
+    def test_lagging_replica_skipped(self):
+        self.assertIn(b'on the replica', self.client.get('/explore').data)
+        self.replicate_heartbeat(time.time() - 60)
+        replicas.check()
+        self.assertIn(b'on the primary', self.client.get('/explore').data)
+        self.replicate_heartbeat(time.time())
+        replicas.check()
+        self.assertIn(b'on the replica', self.client.get('/explore').data)
+        self.assertIsNotNone(db.session.scalar(sqla.select(replica_heartbeat.c.beat)))
+
+    def test_reads_after_write_in_request_use_primary(self):
+        with self.app.test_request_context():
+            g.db_replica = self.replica
+            bodies = lambda: db.session.scalars(sqla.select(Post.body)).all()
+            self.assertEqual(bodies(), ['on the replica'])
+            db.session.add(Post(body='mine', user_id=1))
+            self.assertEqual(sorted(bodies()), ['mine', 'on the primary'])
+            db.session.rollback()
+
+
+class AppFactoryCase(unittest.TestCase):
+    def test_apps_keep_their_own_settings(self):
+        first = create_app(type('FirstConfig', (TestConfig,), {
+            'SECRET_KEY': 'first', 'RATELIMIT_ENABLED': False, 'WTF_CSRF_ENABLED': False}))
+        second = create_app(type('SecondConfig', (TestConfig,), {
+            'SECRET_KEY': 'second', 'RATELIMIT_LOGIN_CAPACITY': 1, 'WTF_CSRF_ENABLED': False}))
+        with first.app_context():
+            token = reset_tokens.issue(User(id=7, login='susan', email='susan@example.com', password_hash='-'))
+            self.assertEqual(reset_tokens.verify(token)['user_id'], 7)
+            db.create_all()
+            client = first.test_client()
+            statuses = [client.post('/login', data={'login': 'susan', 'password': 'cat'}).status_code
+                        for _ in range(3)]
+            db.drop_all()
+        self.assertEqual(statuses, [302, 302, 302])
+        with second.app_context():
+            self.assertIsNone(reset_tokens.verify(token))
+
+
+class TemplateCase(unittest.TestCase):
+    def test_post_macro_and_bytecode_cache(self):
+        directory = tempfile.mkdtemp()
+        config = type('TemplateConfig', (TestConfig,), {'TEMPLATE_BYTECODE_CACHE_DIR': directory})
+        app = create_app(config)
+        with app.test_request_context():
+            author = User(id=1, login='ann', email='ann@example.com')
+            html = render_post(Post(post_id=1, body='<b>hi</b>', user_id=1, author=author))
+        self.assertTrue(html.startswith('<table>'))
+        self.assertIn('&lt;b&gt;hi&lt;/b&gt;', html)
+        self.assertIn('href="/user/ann"', html)
+        self.assertEqual(len(os.listdir(directory)), 1)
+        # a restarted worker loads the compiled template instead of compiling it again
+        app = create_app(config)
+        with mock.patch.object(app.jinja_env, 'compile', side_effect=AssertionError('compiled again')):
+            app.jinja_env.get_template('#post.html')
+
+
+class ApiCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.web_app_context = self.app.app_context()
+        self.web_app_context.push()
+        db.create_all()
+        cache.clear()
+        ann = User(login='ann', email='ann@example.com', password_hash='-')
+        bob = User(login='bob', email='bob@example.com', password_hash='-')
+        db.session.add_all([ann, bob])
+        db.session.commit()
+        ann.follow(bob)
+        start = datetime(2025, 1, 1)
+        for i in range(5):
+            db.session.add(Post(body=f'bob {i}', author=bob, timestamp=start + timedelta(minutes=i)))
+        db.session.add(Post(body='ann <0>', author=ann, timestamp=start + timedelta(minutes=10)))
+        db.session.commit()
+        rebuild_timelines()
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(ann.id)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.web_app_context.pop()
+
+    def test_feed_pages_with_cursors(self):
+        response = self.client.get('/api/v1/feed?limit=4')
+        self.assertEqual(response.mimetype, 'application/json')
+        page = response.get_json()
+        self.assertEqual([post['body'] for post in page['posts']], ['ann <0>', 'bob 4', 'bob 3', 'bob 2'])
+        self.assertEqual(page['posts'][0], {
+            'id': 6, 'body': 'ann <0>', 'timestamp': '2025-01-01T00:10:00+00:00', 'author': 'ann',
+            'avatar': '/avatar/' + md5(b'ann@example.com').hexdigest() + '/48'})
+        self.assertIsNone(page['prev'])
+        page = self.client.get(page['next']).get_json()
+        self.assertEqual([post['body'] for post in page['posts']], ['bob 1', 'bob 0'])
+        self.assertIsNone(page['next'])
+        back = self.client.get(page['prev']).get_json()
+        self.assertEqual([post['body'] for post in back['posts']], ['ann <0>', 'bob 4', 'bob 3', 'bob 2'])
+
+    def test_fields_select_only_their_columns(self):
+        with mock.patch.object(db.session, 'execute', wraps=db.session.execute) as execute:
+            page = self.client.get('/api/v1/users/bob/posts?fields=id,body&limit=2').get_json()
+        self.assertEqual(page['posts'], [{'id': 5, 'body': 'bob 4'}, {'id': 4, 'body': 'bob 3'}])
+        self.assertIn('fields=id', page['next'])
+        sql = str(execute.call_args_list[-1].args[0])
+        self.assertNotIn('email', sql)
+        self.assertNotIn('JOIN', sql)
+        self.assertEqual(self.client.get('/api/v1/explore?fields=id,password_hash').status_code, 400)
+        self.assertEqual(self.client.get('/api/v1/explore?limit=1000').status_code, 400)
+        response = self.client.get('/api/v1/explore?limit=abc')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('limit', response.get_json()['message'])
+
+    def test_anonymous_gets_json_401(self):
+        response = self.app.test_client().get('/api/v1/explore')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.get_json()['error'], 'Unauthorized')
+
+    def test_unknown_user_gets_json_404(self):
+        response = self.client.get('/api/v1/users/nobody/posts')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.get_json()['error'], 'Not Found')
+
+    def test_errors_outside_views_are_json(self):
+        response = self.client.get('/api/v1/no-such-thing')
+        self.assertEqual((response.status_code, response.mimetype), (404, 'application/json'))
+        self.assertEqual(response.get_json()['error'], 'Not Found')
+        response = self.client.post('/api/v1/explore')
+        self.assertEqual((response.status_code, response.get_json()['error']), (405, 'Method Not Allowed'))
+        with mock.patch('app.api.routes.paginate_keyset', side_effect=RuntimeError('boom')):
+            self.app.config['PROPAGATE_EXCEPTIONS'] = False
+            response = self.client.get('/api/v1/explore')
+        self.assertEqual((response.status_code, response.get_json()['error']), (500, 'Internal Server Error'))
+        self.assertIn(b'<html', self.client.get('/no-such-page').data.lower())
+
+    def test_whole_page_with_length(self):
+        response = self.client.get('/api/v1/explore')
+        self.assertEqual(response.content_length, len(response.data))
+        self.assertFalse(response.is_streamed)
+
+    def test_not_modified(self):
+        with self.client.get('/api/v1/explore') as response:
+            etag = response.headers['ETag']
+        response = self.client.get('/api/v1/explore', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_stdlib_json_matches_orjson(self):
+        expected = self.client.get('/api/v1/explore').data
+        with mock.patch('app.api.routes.orjson', None):
+            self.assertEqual(self.client.get('/api/v1/explore').data, expected)
+
+
+def find_free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
         
\ No newline at end of file